@@ -0,0 +1,147 @@
+import os, json
+import numpy as np
+import pandas as pd
+
+#region ========================= COLLAR DATA GENERATOR =========================
+# Genera datos sintéticos con el formato de los collares NoFence para medir tiempos
+
+collar_columns = ['time', 'device_id', 'msg_type', 'position_time', 'lat', 'lon', 'mode', 'collar_status', 'fence_status']
+
+msg_types = ['poll_message_req', 'seq_message_req', 'warn_message_req', 'zap_message_req', 'pulse_message_req']
+modes = ['Teach', 'Fence', 'Trace']
+collar_statuses = ['CollarStatus_Normal', 'Sleep', 'PowerOff', 'OffAnimal']
+fence_statuses = ['FenceStatus_Normal', 'NotStarted', 'MaybeOutOfFence', 'Escaped']
+
+raw_date_format = '%Y-%m-%d %H:%M:%S+00:00'
+
+# Other formats of the dates found in the exports (mixed_dates)
+other_date_formats = ['%d/%m/%Y %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%d/%m/%Y %H:%M']
+
+# Spellings of the enum values built from the identifiers of enum_identifiers.json (enum_variants)
+enum_identifiers_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'enum_identifiers.json')
+enum_spellings = ['{}', '{}_message_req', '{}_MSG', 'Status_{}']
+
+# Garbage values of the invalid rows
+garbage_values = ['', 'null', '#N/A', 'ERROR', '-']
+
+minutes_per_month = 30 * 24 * 60
+
+def collar_rows(devices: int, interval_minutes: int, months: float) -> int:
+  """Rows of devices sending a position every interval_minutes during months (of 30 days)."""
+  return devices * int(months * minutes_per_month / interval_minutes)
+
+
+def generate_collar_data(rows: int | None = None, devices: int = 10, interval_minutes: int = 15, seed: int = 0,
+                         months: float | None = None, mixed_dates: float = 0.0, enum_variants: float = 0.0, invalid_rows: float = 0.0) -> pd.DataFrame:
+  """
+  Raw collar data: each device sends a position every interval_minutes (with some jitter),
+  starting from 2024-09-01, around the same point in Sierra Morena.
+
+  rows: number of rows, or the rows of months of data (collar_rows) if it's None.
+  The rest of the arguments are the share of rows (0 to 1) with:
+  - mixed_dates: dates in other_date_formats instead of the raw_date_format.
+  - enum_variants: enum values spelled like other identifiers of enum_identifiers.json ('poll', 'ZAP_MSG'...).
+  - invalid_rows: null or garbage positions and dates, and fixes sent twice.
+  With all of them 0, the data is the same as before they were added.
+
+  Same seed, same data.
+  """
+  if rows is None:
+    rows = collar_rows(devices, interval_minutes, months if months is not None else 1)
+
+  rng = np.random.default_rng(seed)
+
+  device_ids = rng.choice(np.arange(229000, 230000), size=devices, replace=False)
+  device_id = np.resize(device_ids, rows)
+  fix_index = np.arange(rows) // devices
+
+  start = pd.Timestamp('2024-09-01')
+  jitter = rng.integers(0, 60, size=rows)
+  position_time = start + pd.to_timedelta(fix_index * interval_minutes * 60 + jitter, unit='s')
+  time = position_time + pd.to_timedelta(rng.integers(0, 3600, size=rows), unit='s')
+
+  df = pd.DataFrame({
+    'time': time.strftime(raw_date_format),
+    'device_id': device_id,
+    'msg_type': rng.choice(msg_types, size=rows),
+    'position_time': position_time.strftime(raw_date_format),
+    'lat': np.round(38.38 + rng.normal(0, 0.005, size=rows), 7),
+    'lon': np.round(-2.69 + rng.normal(0, 0.005, size=rows), 7),
+    'mode': rng.choice(modes, size=rows),
+    'collar_status': rng.choice(collar_statuses, size=rows),
+    'fence_status': rng.choice(fence_statuses, size=rows),
+  }, columns=collar_columns)
+
+  # The variants only draw more random numbers after the data above, so it doesn't change
+  if mixed_dates > 0:
+    mix_date_formats(df, {'time': time, 'position_time': position_time}, mixed_dates, rng)
+  if enum_variants > 0:
+    spell_enum_variants(df, enum_variants, rng)
+  if invalid_rows > 0:
+    df = add_invalid_rows(df, invalid_rows, rng)
+
+  return df
+
+
+def sample_rows(rows: int, share: float, rng: np.random.Generator) -> np.ndarray:
+  return np.flatnonzero(rng.random(rows) < share)
+
+
+def mix_date_formats(df: pd.DataFrame, times: dict[str, pd.DatetimeIndex], share: float, rng: np.random.Generator):
+  """Dates of a share of the rows in other_date_formats."""
+  positions = sample_rows(len(df), share, rng)
+  date_formats = rng.integers(0, len(other_date_formats), size=len(positions))
+  for column, column_times in times.items():
+    values = df[column].to_numpy(dtype=object)
+    for index, date_format in enumerate(other_date_formats):
+      format_positions = positions[date_formats == index]
+      values[format_positions] = column_times[format_positions].strftime(date_format)
+    df[column] = values
+
+
+def spell_enum_variants(df: pd.DataFrame, share: float, rng: np.random.Generator):
+  """Enum values of a share of the rows spelled with other identifiers and cases."""
+  with open(enum_identifiers_path) as f:
+    identifiers: dict[str, dict[str, list[str]]] = json.load(f)
+
+  for column, enum_values in identifiers.items():
+    spellings = [spelling.format(identifier) for identifiers in enum_values.values() for identifier in identifiers for spelling in enum_spellings]
+    spellings += [spelling.upper() for spelling in spellings] + [spelling.lower() for spelling in spellings]
+
+    positions = sample_rows(len(df), share, rng)
+    values = df[column].to_numpy(dtype=object)
+    values[positions] = rng.choice(spellings, size=len(positions))
+    df[column] = values
+
+
+def add_invalid_rows(df: pd.DataFrame, share: float, rng: np.random.Generator) -> pd.DataFrame:
+  """
+  A share of the rows split in 3 kinds of invalid rows:
+  without position (null lat/lon), with garbage in the position or the date, and fixes sent twice
+  (the same row again a few rows later, like a poll message resending the last position).
+  """
+  positions = sample_rows(len(df), share, rng)
+  kinds = rng.integers(0, 3, size=len(positions))
+
+  df[['lat', 'lon']] = df[['lat', 'lon']].astype(object)
+  df.loc[df.index[positions[kinds == 0]], ['lat', 'lon']] = np.nan
+
+  garbage = positions[kinds == 1]
+  columns = rng.choice(['lat', 'lon', 'position_time'], size=len(garbage))
+  for column in ['lat', 'lon', 'position_time']:
+    column_garbage = garbage[columns == column]
+    df.loc[df.index[column_garbage], column] = rng.choice(garbage_values, size=len(column_garbage))
+
+  # Resent fixes after their row, in the position of a row a few rows later
+  resent = positions[kinds == 2]
+  order = np.r_[np.arange(len(df)), resent].astype(float)
+  order[len(df):] = np.minimum(resent + rng.integers(1, 10, size=len(resent)), len(df)) - 0.5
+  df = df.iloc[np.r_[np.arange(len(df)), resent]].iloc[np.argsort(order, kind='stable')]
+  return df.reset_index(drop=True)
+
+
+def write_collar_csv(file_path: str, rows: int | None = None, **kwargs) -> str:
+  generate_collar_data(rows, **kwargs).to_csv(file_path, index=False)
+  return file_path
+
+#endregion ===============================================================
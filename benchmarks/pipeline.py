@@ -0,0 +1,154 @@
+import os, sys, json, time, platform, subprocess, tempfile, argparse
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+import pandas as pd
+
+from utils.config import Config, Settings
+from utils.file_manager import read_csv, fast_csv_engine
+from utils.utils import print_colorized
+from data_operations.refactor import refactor
+from data_operations.filters import drop_invalid_positions, filter_fixes
+from data_operations.sort import sort_by
+from data_operations.creation import add_end_date
+from data_operations.merge import merge
+from data_operations.group_by import Grouper
+from benchmarks.collar_data import write_collar_csv
+
+# Tiempo de cada etapa del pipeline en memoria con datos de collares generados (con fechas, enums y filas sucias)
+# Guarda los resultados en JSON para comparar entre commits:
+#   python -m benchmarks.pipeline --rows 10000 1000000 --output results.json
+#   python -m benchmarks.pipeline --rows 10000 1000000 --compare results.json
+
+stages = ['read_csv', 'refactor', 'filters', 'sort_by', 'add_end_date', 'merge', 'Grouper', 'save_to_files']
+
+default_rows = [10_000, 1_000_000, 10_000_000]
+
+
+class StageTimer:
+  """Seconds spent in each stage, added up for all the files."""
+  def __init__(self):
+    self.seconds = {stage: 0.0 for stage in stages}
+
+  def __call__(self, stage: str, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    self.seconds[stage] += time.perf_counter() - start
+    return result
+
+
+def run_pipeline(in_file_paths: list[str], out_path: str, settings: Settings) -> dict[str, float]:
+  """The stages of run_all() for the files, timed."""
+  timer = StageTimer()
+  sort_columns, sort_orders = settings.sort_by_columns, settings.sort_by_orders
+
+  dfs = []
+  for file_path in in_file_paths:
+    df = timer('read_csv', read_csv, file_path)
+    df = timer('refactor', refactor, df, settings)
+    df = timer('filters', drop_invalid_positions, df, settings)
+    df = timer('sort_by', sort_by, df, sort_columns, sort_orders)
+    df = timer('filters', filter_fixes, df, settings)
+    df = timer('add_end_date', add_end_date, df)
+    dfs.append(df)
+
+  # merge: join the files and sort them again, like run_all()
+  df = timer('merge', merge, dfs)
+  del dfs
+  df = timer('merge', sort_by, df, sort_columns, sort_orders)
+  df.index = pd.RangeIndex(len(df))
+  df = timer('add_end_date', add_end_date, df)
+
+  grouper = timer('Grouper', Grouper, df, settings.group_by_columns)
+  timer('save_to_files', grouper.save_to_files, out_path)
+  return timer.seconds
+
+
+def run_benchmark(rows: int, args, settings: Settings) -> dict:
+  """Best time of each stage in args.repeat runs with rows generated rows split in args.files files."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    in_file_paths = []
+    for index in range(args.files):
+      file_rows = rows // args.files + (1 if index < rows % args.files else 0)
+      in_file_paths.append(write_collar_csv(
+        os.path.join(tmp_dir, f'collar_{index}.csv'), file_rows, devices=args.devices, interval_minutes=args.interval,
+        seed=args.seed + index, mixed_dates=args.mixed_dates, enum_variants=args.enum_variants, invalid_rows=args.invalid_rows,
+      ))
+
+    best = {stage: float('inf') for stage in stages}
+    for _ in range(args.repeat):
+      seconds = run_pipeline(in_file_paths, os.path.join(tmp_dir, 'out'), settings)
+      best = {stage: min(best[stage], seconds[stage]) for stage in stages}
+
+  total = sum(best.values())
+  return {'rows': rows, 'seconds': best, 'total': total, 'rows_per_second': rows / total if total > 0 else None}
+
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def show_result(result: dict, previous: dict | None = None):
+  print_colorized(f"{result['rows']} rows: {result['total']:.3f}s ({result['rows_per_second']:.0f} rows/s)", 'green')
+  for stage, seconds in result['seconds'].items():
+    line = f"\t{stage:<14}{seconds:.3f}s"
+    if previous is not None and previous['seconds'].get(stage):
+      line += f"\t(x{seconds / previous['seconds'][stage]:.2f} vs {previous['commit']})"
+    print(line)
+
+
+def main():
+  argparser = argparse.ArgumentParser(description='Benchmark of each stage of the pipeline with generated collar data')
+  argparser.add_argument('--rows', type=int, nargs='+', default=default_rows)
+  argparser.add_argument('--files', type=int, default=4, help='Input files the rows are split in')
+  argparser.add_argument('--devices', type=int, default=50)
+  argparser.add_argument('--interval', type=int, default=15, help='Minutes between the fixes of a device')
+  argparser.add_argument('--mixed-dates', type=float, default=0.01, help='Share of rows with dates in other formats')
+  argparser.add_argument('--enum-variants', type=float, default=0.1, help='Share of rows with other spellings of the enums')
+  argparser.add_argument('--invalid-rows', type=float, default=0.02, help='Share of rows with null or garbage values or sent twice')
+  argparser.add_argument('--seed', type=int, default=0)
+  argparser.add_argument('--repeat', type=int, default=1)
+  argparser.add_argument('--output', help='JSON file to save the results')
+  argparser.add_argument('--compare', help='JSON file with the results of another commit, to compare each stage')
+  args = argparser.parse_args()
+
+  settings = Config.settings()
+  previous = None
+  if args.compare:
+    with open(args.compare) as f:
+      previous = json.load(f)
+
+  report = {
+    'commit': git_commit(),
+    'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'pandas': pd.__version__,
+    'csv_engine': fast_csv_engine,
+    'cpus': os.cpu_count(),
+    'generator': {name: getattr(args, name) for name in ['files', 'devices', 'interval', 'mixed_dates', 'enum_variants', 'invalid_rows', 'seed']},
+    'results': [],
+  }
+
+  for rows in args.rows:
+    result = run_benchmark(rows, args, settings)
+    report['results'].append(result)
+
+    previous_result = None
+    if previous is not None:
+      previous_result = next((previous_rows for previous_rows in previous['results'] if previous_rows['rows'] == rows), None)
+      if previous_result is not None:
+        previous_result = {**previous_result, 'commit': previous['commit']}
+    show_result(result, previous_result)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print_colorized(f"Results saved in {args.output}", 'blue')
+
+
+if __name__ == '__main__':
+  main()
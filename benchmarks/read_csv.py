@@ -0,0 +1,39 @@
+import os, sys, time, tempfile, argparse
+
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+from utils.file_manager import read_csv, read_csv_python, fast_csv_engine
+from utils.utils import print_colorized
+from benchmarks.collar_data import write_collar_csv
+
+# Compara el lector antiguo (engine python, detecta el separador en cada lectura)
+# con read_csv (separador detectado de la cabecera + pyarrow o engine C con los tipos de las columnas)
+# Uso: python -m benchmarks.read_csv --rows 1000000
+
+def time_reader(reader, file_path: str, repeat: int) -> float:
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    reader(file_path)
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def main():
+  argparser = argparse.ArgumentParser(description='Benchmark of the CSV readers with generated collar data')
+  argparser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+  argparser.add_argument('--repeat', type=int, default=3)
+  args = argparser.parse_args()
+  
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for rows in args.rows:
+      file_path = write_collar_csv(os.path.join(tmp_dir, f'collar_{rows}.csv'), rows)
+      
+      old_time = time_reader(read_csv_python, file_path, args.repeat)
+      new_time = time_reader(read_csv, file_path, args.repeat)
+      
+      print_colorized(f"{rows} rows:\tpython engine {old_time:.3f}s\t{fast_csv_engine} {new_time:.3f}s\t(x{old_time / new_time:.1f})", 'green')
+
+
+if __name__ == '__main__':
+  main()
@@ -24,6 +24,8 @@ setup(
             'sort_by=src.main:sort_only',
             'merge=src.main:merge_only',
             'group-by=src.main:group_by_only',
+            'extract=src.main:extract_only',
+            'geo-export=src.main:geo_export_only',
         ],
     },
 )
@@ -1,25 +1,210 @@
+import numpy as np
 import pandas as pd
+from typing import Callable, Iterable, Iterator
 from data_operations.group_by import GroupBy
 from data_operations.merge import merge
 
 #region ====================== END DATE ======================
 
+# Si no hay siguiente mensaje del collar, la fecha de fin es su sent_time + 15 mins
+end_date_default_duration = pd.Timedelta(minutes=15)
+
+def device_keys(devices: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+  """device_id as an array that can be compared with ==, and the mask of the rows with a device_id."""
+  if isinstance(devices.dtype, pd.CategoricalDtype):
+    keys = devices.cat.codes.to_numpy()
+    return keys, keys >= 0
+  if isinstance(devices.dtype, np.dtype) and devices.dtype.kind in 'iub':
+    keys = devices.to_numpy()
+    return keys, np.ones(len(keys), dtype=bool)
+  if isinstance(devices.dtype, np.dtype) and devices.dtype.kind == 'f':
+    keys = devices.to_numpy()
+    return keys, ~np.isnan(keys)
+  keys, _ = pd.factorize(devices)
+  return keys, keys >= 0
+
+
+def same_device_as_next(df: pd.DataFrame) -> np.ndarray | None:
+  """
+  Mask of the rows followed by a row of the same device.
+  None if the rows of a device are not contiguous (df not sorted by device_id first),
+  then the next row of the device is not the next row of df.
+  """
+  keys, valid = device_keys(df['device_id'])
+  if len(keys) == 0:
+    return np.zeros(0, dtype=bool)
+
+  # Contiguous if each device starts only 1 run of rows
+  starts = np.r_[True, keys[1:] != keys[:-1]] & valid
+  run_keys = keys[starts]
+  if len(pd.unique(run_keys)) != len(run_keys):
+    return None
+
+  return np.r_[(keys[1:] == keys[:-1]) & valid[1:], False]
+
+
+def next_fix(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+  """
+  Values of columns in the next row of the same device (null in the last row of each device).
+
+  df sorted by device_id first (like sort_by with the settings): compares each device_id with the next one,
+  without grouping. If not, the rows of each device are grouped to find the next one.
+  """
+  same_device = same_device_as_next(df)
+  if same_device is None:
+    return df.groupby('device_id')[columns].shift(-1)
+  return df[columns].shift(-1).where(np.broadcast_to(same_device[:, None], (len(df), len(columns))))
+
+
+def insert_end_date(df: pd.DataFrame, next_rows: pd.DataFrame):
+  """Insert end_date (next sent_time or sent_time + 15 mins) after sent_time, replacing it if df already has it."""
+  end_date = next_rows['sent_time'].fillna(df['sent_time'] + end_date_default_duration)
+  if 'end_date' in df.columns:
+    del df['end_date']
+  df.insert(df.columns.get_loc('sent_time') + 1, 'end_date', end_date)
+
+
 # Añade la fecha de fin como la fecha del proximo mensaje del mismo collar
 # Esto después permite animarlo en QGIS para ver la trayectoria de los collares mas claramente
-def add_end_date(df: pd.DataFrame):
-  
-  # Add end_date col with the time of the next message
-  df['end_date'] = df.groupby('device_id')['sent_time'].shift(-1)
-  
-  # Reorder end_date after sent_time
-  columns = df.columns.tolist()
-  sent_index = columns.index('sent_time')
-  columns.insert(sent_index + 1, columns.pop(columns.index('end_date')))
-  df = df[columns]
-  
-  # Fill empty end_date with his sent_time + 15 mins
-  df['end_date'] = df['end_date'].fillna(df['sent_time'] + pd.Timedelta(minutes=15))
-  
+def add_end_date(df: pd.DataFrame) -> pd.DataFrame:
+  """
+  Add end_date after sent_time: the sent_time of the next row of the same device (next_fix).
+  Modifies df (no copy of the whole DataFrame) and returns it.
+  """
+  insert_end_date(df, next_fix(df, ['sent_time']))
+  return df
+
+#endregion
+
+
+#region ====================== TRAJECTORY ======================
+
+# Métricas del paso de cada posición a la siguiente del mismo collar
+# Para analizar el movimiento sin recalcularlo por grupo en QGIS
+
+earth_radius_m = 6_371_008.8
+
+trajectory_columns = ['step_distance', 'step_time', 'speed', 'bearing']
+
+def haversine_distance(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+  """Distance in meters between the points (in radians)."""
+  haversine = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+  return 2 * earth_radius_m * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def insert_trajectory_metrics(df: pd.DataFrame, next_rows: pd.DataFrame):
+  """
+  Add (or replace) the columns of the step to the next fix of the device (next_rows: its lat, lon and sent_time):
+  - step_distance: haversine distance in meters
+  - step_time: seconds
+  - speed: m/s (null if the step takes 0 seconds)
+  - bearing: initial bearing in degrees, 0 = north, clockwise [0, 360)
+  Null in the last fix of each device.
+  """
+  lat1, lon1 = np.radians(df['lat'].to_numpy(dtype=float)), np.radians(df['lon'].to_numpy(dtype=float))
+  lat2, lon2 = np.radians(next_rows['lat'].to_numpy(dtype=float)), np.radians(next_rows['lon'].to_numpy(dtype=float))
+  delta_lon = lon2 - lon1
+  distance = haversine_distance(lat1, lon1, lat2, lon2)
+
+  seconds = (next_rows['sent_time'] - df['sent_time']).dt.total_seconds().to_numpy()
+  with np.errstate(divide='ignore', invalid='ignore'):
+    speed = np.where(seconds > 0, distance / seconds, np.nan)
+
+  bearing = np.degrees(np.arctan2(
+    np.sin(delta_lon) * np.cos(lat2),
+    np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon),
+  )) % 360
+
+  for column, values in zip(trajectory_columns, [distance, seconds, speed, bearing]):
+    df[column] = values
+
+
+def add_trajectory_metrics(df: pd.DataFrame) -> pd.DataFrame:
+  """Add the metrics of the step to the next fix of the same device (next_fix). Modifies df and returns it."""
+  insert_trajectory_metrics(df, next_fix(df, ['lat', 'lon', 'sent_time']))
   return df
 
-#endregion
\ No newline at end of file
+#endregion
+
+
+#region ====================== CHUNKS ======================
+
+class NextFixStream:
+  """
+  Columns computed from the next fix of the device (end_date, trajectory metrics)
+  on data read in chunks, sorted by device_id first (the rows of a device are contiguous, across chunks too).
+
+  The columns of the last row of a chunk depend on the next chunk: that row is carried to the next one.
+  add() returns the rows of the chunk with their columns (all but the carried one), close() the last row.
+  Concatenated, they are the same as computing them on all the rows.
+  Raises ValueError if a device appears again after other devices.
+  """
+
+  def __init__(self, next_columns: list[str], insert_columns: Callable[[pd.DataFrame, pd.DataFrame], None]):
+    self.next_columns = next_columns
+    self.insert_columns = insert_columns
+    self.carried: pd.DataFrame | None = None
+    self.finished_devices = set()
+
+  def add(self, chunk: pd.DataFrame) -> pd.DataFrame:
+    if self.carried is not None:
+      chunk = pd.concat([self.carried, chunk])
+    if len(chunk) == 0:
+      return chunk
+
+    same_device = same_device_as_next(chunk)
+    if same_device is None:
+      raise ValueError("The rows of each device are not contiguous, sort them by device_id first")
+
+    # Devices ended in this chunk can't appear again
+    devices = chunk['device_id']
+    ended = devices[~same_device].iloc[:-1].dropna()
+    if self.finished_devices.intersection(devices.dropna().unique()):
+      raise ValueError("The rows of each device are not contiguous between chunks, sort them by device_id first")
+    self.finished_devices.update(ended)
+
+    next_rows = chunk[self.next_columns].shift(-1).where(np.broadcast_to(same_device[:, None], (len(chunk), len(self.next_columns))))
+    self.carried = chunk.iloc[-1:]
+    chunk = chunk.iloc[:-1].copy()
+    self.insert_columns(chunk, next_rows.iloc[:-1])
+    return chunk
+
+  def close(self) -> pd.DataFrame | None:
+    """Last row, without next row."""
+    if self.carried is None:
+      return None
+    last = self.carried.copy()
+    self.carried = None
+    self.insert_columns(last, last[self.next_columns].where(np.zeros((1, len(self.next_columns)), dtype=bool)))
+    return last
+
+
+class EndDateStream(NextFixStream):
+  """add_end_date on chunks (NextFixStream)."""
+  def __init__(self):
+    super().__init__(['sent_time'], insert_end_date)
+
+
+class TrajectoryStream(NextFixStream):
+  """add_trajectory_metrics on chunks (NextFixStream)."""
+  def __init__(self):
+    super().__init__(['lat', 'lon', 'sent_time'], insert_trajectory_metrics)
+
+
+def add_next_fix_chunks(chunks: Iterable[pd.DataFrame], stream: NextFixStream) -> Iterator[pd.DataFrame]:
+  """Columns of the stream added to each chunk, only the boundary rows wait for the next chunk."""
+  for chunk in chunks:
+    chunk = stream.add(chunk)
+    if len(chunk) > 0:
+      yield chunk
+  last = stream.close()
+  if last is not None:
+    yield last
+
+def add_end_date_chunks(chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+  return add_next_fix_chunks(chunks, EndDateStream())
+
+def add_trajectory_metrics_chunks(chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+  return add_next_fix_chunks(chunks, TrajectoryStream())
+
+#endregion
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from collections import Counter
+from utils.config import Settings
+from utils.utils import print_colorized
+from data_operations.creation import next_fix, same_device_as_next, haversine_distance
+
+#region ======================== FILTERS ========================
+
+# Filtros de posiciones GPS erróneas o repetidas, aplicados a cada archivo antes del merge
+#
+# Rules, in order (the rows removed by each one are counted in filter_stats):
+#   null_position            without sent_time, or without lat/lon (with filter_null_positions)
+#   out_of_range             lat outside [-90, 90] or lon outside [-180, 180]
+#   duplicate                same device_id, sent_time, msg_type, received_time, lat and lon as a previous row:
+#                            the same message stored twice. Different messages of the same fix are kept
+#   speed_spike              speed from the previous fix AND to the next fix of the device above max_speed_kmh:
+#                            the point jumps away and comes back. A single jump is kept (the collar may have been moved)
+#   duplicate_between_files  duplicate, of a fix in several files (after the merge)
+#
+# null_position and out_of_range check each row alone. duplicate and speed_spike need the rows of each file
+# sorted by device_id and sent_time, speed_spike compares each fix with its neighbours in one pass
+# (a point removed doesn't change the speeds of the others).
+
+# The rules are configured in settings.filters (pipeline.filters of settings.yaml) and settings.filter_null_positions
+
+duplicate_columns = ['device_id', 'sent_time', 'msg_type', 'received_time', 'lat', 'lon']
+
+filter_rules = ['null_position', 'out_of_range', 'duplicate', 'speed_spike', 'duplicate_between_files']
+filter_stats = Counter()
+
+
+def drop_rows(df: pd.DataFrame, mask: np.ndarray, rule: str) -> pd.DataFrame:
+  """df without the rows of the mask, counted in filter_stats[rule]."""
+  removed = int(mask.sum())
+  if removed == 0:
+    return df
+  filter_stats[rule] += removed
+  return df[~mask]
+
+
+def drop_invalid_positions(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:
+  """null_position and out_of_range rules. Row by row, df doesn't need to be sorted."""
+  columns = ['sent_time', 'lat', 'lon'] if settings.filter_null_positions else ['sent_time']
+  df = drop_rows(df, df[columns].isna().any(axis=1).to_numpy(), 'null_position')
+
+  if settings.filters.get('out_of_range', True):
+    lat, lon = df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'):
+      df = drop_rows(df, (np.abs(lat) > 90) | (np.abs(lon) > 180), 'out_of_range')
+  return df
+
+
+def drop_duplicate_fixes(df: pd.DataFrame, settings: Settings, rule='duplicate') -> pd.DataFrame:
+  """Rows with the same duplicate_columns (the ones df has) as a previous row."""
+  if not settings.filters.get('duplicates', True):
+    return df
+  return drop_rows(df, duplicated_fixes(df), rule)
+
+
+def duplicated_fixes(df: pd.DataFrame) -> np.ndarray:
+  return df.duplicated([column for column in duplicate_columns if column in df.columns]).to_numpy()
+
+
+def fix_speed(df: pd.DataFrame, next_rows: pd.DataFrame) -> np.ndarray:
+  """Speed (m/s) to next_rows: its lat, lon and sent_time. inf if it moves in 0 seconds, null without next row."""
+  distance = haversine_distance(
+    np.radians(df['lat'].to_numpy(dtype=float)), np.radians(df['lon'].to_numpy(dtype=float)),
+    np.radians(next_rows['lat'].to_numpy(dtype=float)), np.radians(next_rows['lon'].to_numpy(dtype=float)),
+  )
+  seconds = np.abs((next_rows['sent_time'] - df['sent_time']).dt.total_seconds().to_numpy())
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return distance / seconds
+
+
+def speed_spike_mask(df: pd.DataFrame, max_speed: float) -> np.ndarray:
+  """Mask of the fixes with speed (m/s) above max_speed from the previous fix and to the next fix of the device."""
+  speed_out = fix_speed(df, next_fix(df, ['lat', 'lon', 'sent_time']))
+
+  # Speed from the previous fix = speed to the next fix of the previous row of the device
+  if same_device_as_next(df) is None:
+    speed_in = pd.Series(speed_out).groupby(df['device_id'].to_numpy()).shift(1).to_numpy()
+  else:
+    speed_in = np.r_[np.nan, speed_out[:-1]]
+
+  with np.errstate(invalid='ignore'):
+    return (speed_in > max_speed) & (speed_out > max_speed)
+
+
+def drop_speed_spikes(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:
+  max_speed_kmh = settings.filters.get('max_speed_kmh')
+  if max_speed_kmh is None or len(df) == 0:
+    return df
+  return drop_rows(df, speed_spike_mask(df, max_speed_kmh / 3.6), 'speed_spike')
+
+
+def filter_fixes(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:
+  """duplicate and speed_spike rules on the rows of a file, sorted by device_id and sent_time."""
+  return drop_speed_spikes(drop_duplicate_fixes(df, settings), settings)
+
+
+def filter_fixes_by_file(df: pd.DataFrame, files: np.ndarray, settings: Settings) -> pd.DataFrame:
+  """
+  filter_fixes on the rows of each file (files: file of each row) like before the merge,
+  for the rows of several files already merged. Keeps the order of df.
+  """
+  keep = np.zeros(len(df), dtype=bool)
+  for file in np.unique(files):
+    positions = np.flatnonzero(files == file)
+    # Index = position in df, to know which rows are kept
+    rows = filter_fixes(df.iloc[positions].set_axis(positions), settings)
+    keep[rows.index.to_numpy()] = True
+  return df[keep]
+
+
+class FileFilterStream:
+  """
+  filter_fixes_by_file on the rows of a device given in batches sorted by sent_time (sort_by with device_id and sent_time first).
+
+  add(batch, files) checks the rows of a batch (files: file of each row). The ids (id_column) of the rows removed
+  are kept in removed_ids(), to drop them when the rows are read again.
+  - duplicate: the batches must not split the rows with the same sent_time (split_runs), so the duplicates are in the same batch
+  - speed_spike: a fix is checked when the next fix of its file arrives, the last 2 fixes of each file are carried to the next batch
+  """
+
+  def __init__(self, settings: Settings, id_column: str):
+    self.settings = settings
+    self.id_column = id_column
+    self.carried: dict[int, tuple[pd.DataFrame, int]] = {}  # file -> last fixes, how many of them were checked
+    self.removed: list[np.ndarray] = []
+
+  def add(self, batch: pd.DataFrame, files: np.ndarray):
+    max_speed_kmh = self.settings.filters.get('max_speed_kmh')
+    for file in np.unique(files):
+      rows = batch[files == file]
+      if self.settings.filters.get('duplicates', True):
+        rows = self.remove(rows, duplicated_fixes(rows), 'duplicate')
+      if max_speed_kmh is None or len(rows) == 0:
+        continue
+
+      # A point removed doesn't change the speeds of the others: the carried fixes are kept to compute them
+      carried, checked = self.carried.get(file, (rows.iloc[:0], 0))
+      fixes = pd.concat([carried, rows], ignore_index=True)
+      mask = speed_spike_mask(fixes, max_speed_kmh / 3.6)
+      mask[:checked] = False
+      mask[-1] = False
+      self.remove(fixes, mask, 'speed_spike')
+      self.carried[file] = (fixes.iloc[-2:], min(len(fixes), 2) - 1)
+
+  def remove(self, rows: pd.DataFrame, mask: np.ndarray, rule: str) -> pd.DataFrame:
+    """rows without the ones of the mask, counted in filter_stats[rule]."""
+    self.removed.append(rows[self.id_column].to_numpy()[mask])
+    return drop_rows(rows, mask, rule)
+
+  def removed_ids(self) -> np.ndarray:
+    """Ids of the rows removed. The last fix of each file is never a speed_spike (no next fix)."""
+    return np.concatenate(self.removed) if self.removed else np.array([], dtype=np.int64)
+
+
+def show_filter_stats():
+  if filter_stats.total() == 0:
+    return
+  removed = ', '.join(f"{rule}: {filter_stats[rule]}" for rule in filter_rules if filter_stats[rule] > 0)
+  print_colorized(f"Fixes removed by the filters: {filter_stats.total()} ({removed})", 'blue')
+
+#endregion
@@ -0,0 +1,253 @@
+import os, re
+from typing import Iterable, Iterator
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from utils.file_writer import ParallelFileWriter, format_dates
+from utils.file_manager import remove_path
+from utils.utils import print_colorized
+from data_operations.group_by import GroupData, group_dir_name
+
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+#region ======================== GEO EXPORT ========================
+
+# Capas de puntos de cada grupo para QGIS, escritas desde los datos en memoria (sustituye a qgis_scripts/csv_to_shp.py)
+#
+#   gpkg  GeoPackage: fechas como DateTime (para el Temporal Controller de QGIS)
+#   shp   Shapefile, por compatibilidad: columnas de 10 caracteres como máximo y fechas como texto (date_format, como en los CSV)
+#
+# Each group in its own file: out/geo/group by day/day - 2024-09-01.gpkg (and .shp), written in parallel.
+# With single_gpkg, one GeoPackage for each column with a layer for each group: out/geo/group by day.gpkg
+# The geometry is built at once from lon/lat in EPSG:4326, the rows without position have a null geometry.
+
+geo_dir_name = 'geo'
+crs = 'EPSG:4326'
+
+# Format: (OGR driver, extension of the file, extensions of the files written with it)
+geo_formats = {
+  'gpkg': ('GPKG', '.gpkg', ['.gpkg']),
+  'shp': ('ESRI Shapefile', '.shp', ['.shp', '.shx', '.dbf', '.prj', '.cpg']),
+}
+
+# Shapefile field names have at most 10 characters. Other long names are cut
+shapefile_columns = {
+  'received_time': 'recv_time',
+  'collar_status': 'collar_st',
+  'fence_status': 'fence_st',
+  'step_distance': 'step_dist',
+}
+
+
+def geo_frame(df: pd.DataFrame, file_format: str = 'gpkg') -> gpd.GeoDataFrame:
+  """Point layer of df in the file_format, with the same index."""
+  lat, lon = df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float)
+  geometry = gpd.points_from_xy(lon, lat, crs=crs)
+  geometry[np.isnan(lat) | np.isnan(lon)] = None
+
+  if file_format == 'shp':
+    df = format_dates(df).rename(columns=lambda column: shapefile_columns.get(column, column[:10]))
+  if pa is None:
+    # Categories are written as text only through arrow
+    df = df.astype({column: object for column in df.select_dtypes(include='category').columns})
+  return gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def geo_layer_name(column: str, value, attrs: dict) -> str:
+  """Name of the layer (and file) of a group: '<column> - <value>', the value formatted like in the group files."""
+  return re.sub(r'[<>:"/\\|?*]', '_', f"{column} - {attrs.get('group_by_value', value)}")
+
+
+def write_geo(gdf: gpd.GeoDataFrame, file_path, layer: str, append: bool = False, **options):
+  """
+  Write the layer in the file, in the format of its extension. A GeoPackage keeps its other layers.
+  With append the rows are added to the layer already written.
+  options: passed to pyogrio, like geometry_type or creation options of the OGR driver
+  """
+  driver = next(driver for driver, extension, _ in geo_formats.values() if file_path.endswith(extension))
+  if driver == 'ESRI Shapefile':
+    # The only layer of a shapefile is named like its file, another name would be appended to a new file
+    layer = os.path.splitext(os.path.basename(file_path))[0]
+  gdf.to_file(file_path, layer=layer, driver=driver, engine='pyogrio', use_arrow=pa is not None, mode='a' if append else 'w', **options)
+
+
+def tmp_geo_path(file_path) -> str:
+  """Temp file in the same folder, renamed to file_path by replace_geo_files."""
+  dir_path, file_name = os.path.split(file_path)
+  return os.path.join(dir_path, f'.tmp.{file_name}')
+
+
+def geo_file_paths(file_path) -> list[str]:
+  """Paths of the files written with file_path (a shapefile is several files)."""
+  base, extension = os.path.splitext(file_path)
+  extensions = next(extensions for _, format_extension, extensions in geo_formats.values() if format_extension == extension)
+  return [base + file_extension for file_extension in extensions]
+
+
+def replace_geo_files(tmp_path, file_path) -> int:
+  """Rename the files written in tmp_path to file_path. Returns their size in bytes."""
+  size = 0
+  for tmp_file_path, final_path in zip(geo_file_paths(tmp_path), geo_file_paths(file_path)):
+    if os.path.exists(tmp_file_path):
+      os.replace(tmp_file_path, final_path)
+      size += os.path.getsize(final_path)
+  return size
+
+
+def remove_geo_files(file_path):
+  for path in geo_file_paths(file_path):
+    if os.path.exists(path):
+      os.remove(path)
+
+
+def write_geo_atomic(gdf: gpd.GeoDataFrame, file_path, **options) -> int:
+  """
+  write_geo to temp files in the same folder, then rename them (a shapefile is several files).
+  Returns the size of the files in bytes.
+  """
+  tmp_path = tmp_geo_path(file_path)
+  os.makedirs(os.path.dirname(file_path), exist_ok=True)
+  try:
+    write_geo(gdf, tmp_path, os.path.splitext(os.path.basename(file_path))[0], **options)
+    return replace_geo_files(tmp_path, file_path)
+  finally:
+    remove_geo_files(tmp_path)
+
+
+class GeoExporter:
+  """
+  Writes the groups of each column as point layers in root_path/geo, in each of the formats.
+
+  The files of the groups are written in parallel by a ParallelFileWriter with workers threads.
+  With single_gpkg the GeoPackage layers of a column are written one after another in the same file
+  (SQLite allows a single writer), to a temp file renamed when the column ends.
+  write_batches() writes the layer of a group given in batches instead, appending each one.
+
+  Use it with `with`:
+    with GeoExporter(out, ['gpkg', 'shp']) as exporter:
+      exporter.start_column('day')
+      exporter.submit('day', 'day - 2024-09-01', {'gpkg': layer, 'shp': shp_layer})
+  """
+
+  def __init__(self, root_path: str, formats: list[str], single_gpkg: bool = False, workers: int = None):
+    self.root_path = os.path.join(root_path, geo_dir_name)
+    self.formats = [file_format for file_format in formats if file_format in geo_formats]
+    for file_format in set(formats) - set(self.formats):
+      print_colorized(f"Unknown geo_export format '{file_format}', available: {list(geo_formats)}", 'red')
+    self.single_gpkg = single_gpkg
+    self.writer = ParallelFileWriter(workers, write=write_geo_atomic)
+    self.layers: dict[str, list[str]] = {}
+    self.gpkg_column: str | None = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def dir_path(self, column: str) -> str:
+    return os.path.join(self.root_path, group_dir_name(column))
+
+  def single_gpkg_path(self, column: str) -> str:
+    return self.dir_path(column) + geo_formats['gpkg'][1]
+
+  def start_column(self, column: str):
+    """Remove the files of the column of the last export."""
+    self.finish_column()
+    for path in [self.dir_path(column), self.single_gpkg_path(column), self.tmp_gpkg_path(column)]:
+      if os.path.exists(path):
+        remove_path(path)
+    os.makedirs(self.root_path, exist_ok=True)
+    self.layers[column] = []
+
+    if self.single_gpkg and 'gpkg' in self.formats:
+      self.gpkg_column = column
+
+  def submit(self, column: str, name: str, layers: dict[str, gpd.GeoDataFrame]):
+    """Layer of a group in each format (geo_frame of its rows)."""
+    self.layers[column].append(name)
+    for file_format in self.formats:
+      if file_format == 'gpkg' and self.gpkg_column == column:
+        write_geo(layers[file_format], self.tmp_gpkg_path(column), name)
+      else:
+        self.writer.submit(layers[file_format], os.path.join(self.dir_path(column), name + geo_formats[file_format][1]))
+
+  def write_batches(self, column: str, name: str, batches: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """
+    Layer of a group given in batches, so the group is never in memory at once: each batch is appended
+    to the layer in each format as it goes through (in this thread). Yields the same batches.
+    """
+    self.layers[column].append(name)
+    file_paths = {file_format: os.path.join(self.dir_path(column), name + geo_formats[file_format][1]) for file_format in self.formats
+                  if not (file_format == 'gpkg' and self.gpkg_column == column)}
+    os.makedirs(self.dir_path(column), exist_ok=True)
+
+    written = False
+    try:
+      for batch in batches:
+        if len(batch) > 0:
+          for file_format in self.formats:
+            if file_format in file_paths:
+              write_geo(geo_frame(batch, file_format), tmp_geo_path(file_paths[file_format]), name, append=written)
+            else:
+              write_geo(geo_frame(batch, file_format), self.tmp_gpkg_path(column), name, append=written)
+          written = True
+        yield batch
+
+      for file_path in file_paths.values():
+        replace_geo_files(tmp_geo_path(file_path), file_path)
+    finally:
+      for file_path in file_paths.values():
+        remove_geo_files(tmp_geo_path(file_path))
+
+  def tmp_gpkg_path(self, column: str) -> str:
+    return os.path.join(self.root_path, f'.tmp.{os.path.basename(self.single_gpkg_path(column))}')
+
+  def finish_column(self):
+    """Rename the GeoPackage of the column with all its layers."""
+    if self.gpkg_column is None:
+      return
+    tmp_path = self.tmp_gpkg_path(self.gpkg_column)
+    if os.path.exists(tmp_path):
+      os.replace(tmp_path, self.single_gpkg_path(self.gpkg_column))
+    self.gpkg_column = None
+
+  def close(self) -> dict[str, list[str]]:
+    """Wait for every file. Returns the layers of each column."""
+    self.finish_column()
+    self.writer.close()
+    return self.layers
+
+  def report(self):
+    if self.writer.written:
+      self.writer.report()
+    for column, layers in self.layers.items():
+      where = self.single_gpkg_path(column) if self.single_gpkg and 'gpkg' in self.formats else self.dir_path(column)
+      print_colorized(f"{len(layers)} layers of the groups by {column} ({', '.join(self.formats)}) saved in {where}", 'green')
+
+
+def export_groups(groups: dict[str, GroupData], root_path: str, formats: list[str], single_gpkg: bool = False) -> dict[str, list[str]]:
+  """
+  Export the groups (GroupData of the same dataset) as point layers.
+  The layer of the whole dataset is built once in each format and each group is a slice of it.
+  Returns the layers of each column.
+  """
+  if not groups:
+    return {}
+  dataset = next(iter(groups.values())).dataset
+
+  with GeoExporter(root_path, formats, single_gpkg) as exporter:
+    layers = {file_format: geo_frame(dataset, file_format) for file_format in exporter.formats}
+    for column, group_data in groups.items():
+      exporter.start_column(column)
+      for index in range(len(group_data)):
+        name = geo_layer_name(column, group_data.values[index], group_data.attrs(index))
+        exporter.submit(column, name, {file_format: group_data.get_df(index, layer) for file_format, layer in layers.items()})
+
+  exporter.report()
+  return exporter.layers
+
+#endregion
@@ -1,10 +1,14 @@
 import os
+from urllib.parse import quote
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from typing import List, Callable
 from utils.utils import print_colorized
-from utils.file_manager import read_csv, write_csv, ensure_dir_exists
-from src.goat_enhancer import get_goat_name
+from utils.file_manager import read_csv, ensure_dir_exists, remove_path, file_formats
+from utils.file_writer import ParallelFileWriter, format_dates
+from data_operations.incremental import hash_rows, hash_partition
+from src.goat_enhancer import get_goat_name_for
 from typing import TypedDict
 
 #region ========================= GROUP BY =========================
@@ -18,19 +22,31 @@ class GroupBy:
   def __init__(self, column: str):
       self.column = column
 
-  def group_by(self, df: pd.DataFrame) -> list[pd.DataFrame]:
-    """Basic Group By function. Groups by the given column.
-    
-    If column not exists (day, month, hour...) returns empty [].
+  def keys(self, df: pd.DataFrame) -> pd.Series:
+    """Value of the group of each row."""
+    return df[self.column]
+
+  def available(self, df: pd.DataFrame) -> bool:
+    """
+    If column not exists (day, month, hour...) it can't be grouped.
     Use another group_by function instead like group_by_day().
     Or create a new.
     """
-    
     if self.column not in df.columns:
       print_colorized(f"The column '{self.column}' is not present in {df.columns}.", 'red')
-      return []
+      return False
+    return True
+
+  def group_attrs(self, value) -> dict:
+    """Metadata stored in the attrs of each resulting DataFrame."""
+    return {}
+
+  def group_by(self, df: pd.DataFrame) -> list[pd.DataFrame]:
+    """Basic Group By function. Groups by the given column.
     
-    return [group for _, group in df.groupby([self.column], observed=False)]
+    If column not exists returns empty [].
+    """
+    return list(GroupData(self, df).dfs)
 
 
 class GroupByCalculated(GroupBy):
@@ -39,28 +55,25 @@ class GroupByCalculated(GroupBy):
   Use Strategy Pattern to implement different Group Bys as SubClasses.
   Each Group By Calculate his column with the given calculation function.
   When Grouped, the column is removed from the resulting DataFrames.
+  
+  The calculated keys are datetime64 or periods (cheap to factorize and sort),
+  only the value of each group is formatted as a string with value_format.
   """
-  def __init__(self, column: str, calculation: Callable[[pd.DataFrame], pd.DataFrame]):
+  def __init__(self, column: str, calculation: Callable[[pd.DataFrame], pd.Series], value_format: str):
     self.column = column
     self.calculation = calculation
+    self.value_format = value_format
   
-  def group_by(self, df: pd.DataFrame) -> list[pd.DataFrame]:
-    # Copy the DataFrame to avoid modifying the original to add the calculated column
-    df_copy = df.copy()
-    df_copy[self.column] = self.calculation(df_copy)
-    
-    # Group By the calculated column
-    groups = super().group_by(df_copy)
-    
-    # Drop the calculated column from the resulting DataFrames (it's redundant)
-    # Uses attributes to store metadata such as the group_by column value
-    # So we can drop the whole column to save memory
-    for group in groups:
-      group.attrs['group_by'] = self.column
-      group.attrs['group_by_value'] = group[self.column].iloc[0]
-      group.drop(columns=[self.column], inplace=True)
-    
-    return groups
+  def keys(self, df: pd.DataFrame) -> pd.Series:
+    return self.calculation(df)
+  
+  def available(self, df: pd.DataFrame) -> bool:
+    return True
+  
+  # The calculated column is never added to the resulting DataFrames (it's redundant)
+  # Uses attributes to store metadata such as the group_by column value
+  def group_attrs(self, value) -> dict:
+    return {'group_by': self.column, 'group_by_value': value.strftime(self.value_format)}
 
 
 
@@ -85,37 +98,35 @@ class GroupByHour(GroupByCalculated):
   def __init__(self):
     super().__init__('hour', 
                       lambda df: # Floor the time to the nearest hour
-                        df['sent_time'].dt.floor('h').apply(
-                          lambda date: # Format the date to a string without mins and secs
-                            date.strftime('%Y-%m-%d %H')
-                        )
+                        df['sent_time'].dt.floor('h'),
+                      # Format the date to a string without mins and secs
+                      '%Y-%m-%d %H'
                     )
 
 class GroupByDay(GroupByCalculated):
   def __init__(self):
     super().__init__('day', 
                       lambda df: # Floor the time to the nearest day
-                        df['sent_time'].dt.floor('d').apply(
-                          lambda date: # Format the date to a string without time
-                            date.strftime('%Y-%m-%d')
-                        )
+                        df['sent_time'].dt.floor('d'),
+                      # Format the date to a string without time
+                      '%Y-%m-%d'
                     )
 
 class GroupByMonth(GroupByCalculated):
   def __init__(self):
     super().__init__('month',
                       lambda df: # Floor the time to the nearest month
-                        df['sent_time'].dt.to_period('M').astype(str)
+                        df['sent_time'].dt.to_period('M'),
+                      '%Y-%m'
                     )
 
 class GroupByYear(GroupByCalculated):
   def __init__(self):
     super().__init__('year',
                       lambda df: # Floor the time to the nearest year
-                        df['sent_time'].dt.floor('Y').apply(
-                          lambda date: # Format the date to a string
-                            date.strftime('%Y')
-                        )
+                        # (floor('Y') is not valid, years don't have a fixed duration)
+                        df['sent_time'].dt.to_period('Y'),
+                      '%Y'
                     )
 
 #endregion ===============================================================
@@ -127,12 +138,67 @@ class GroupData:
   """
   Resulting Dataframes from the Group By.
   Managed by the Grouper class.
+  
+  The keys are factorized and sorted once: each group is a slice of positions of the dataset.
+  The DataFrame of a group is only built when accessed (dfs[i]), the dataset is never copied.
+  Groups are sorted by value and keep the order of the rows, like df.groupby().
   """
   
-  def __init__(self, column: str, dfs: List[pd.DataFrame], file_names: List[str]):
-    self.column = column
-    self.dfs = dfs
-    self.file_names = file_names
+  def __init__(self, group_by: GroupBy, dataset: pd.DataFrame):
+    self.column = group_by.column
+    self.group_by = group_by
+    self.dataset = dataset
+    self.file_names = []
+    
+    if group_by.available(dataset):
+      codes, self.values = pd.factorize(group_by.keys(dataset), sort=True)
+    else:
+      codes, self.values = np.array([], dtype=np.intp), []
+    
+    # Null keys (code -1) go first and are skipped
+    self.positions = np.argsort(codes, kind='stable')
+    sizes = np.bincount(codes[codes >= 0], minlength=len(self.values))
+    self.offsets = np.concatenate([[0], np.cumsum(sizes)]) + np.count_nonzero(codes < 0)
+    
+    self.dfs = GroupFrames(self)
+  
+  def __len__(self) -> int:
+    return len(self.values)
+  
+  def attrs(self, index: int) -> dict:
+    return self.group_by.group_attrs(self.values[index])
+  
+  def get_positions(self, index: int) -> np.ndarray:
+    """Positions of the rows of the group in the dataset."""
+    return self.positions[self.offsets[index]:self.offsets[index + 1]]
+  
+  def get_df(self, index: int, dataset: pd.DataFrame = None) -> pd.DataFrame:
+    """DataFrame of the group. dataset can be a copy of the grouped dataset with other values, like the formatted dates."""
+    dataset = self.dataset if dataset is None else dataset
+    group = dataset.iloc[self.get_positions(index)]
+    group.attrs = self.attrs(index)
+    return group
+
+
+class GroupFrames:
+  """List of the DataFrames of a GroupData, built one by one when accessed."""
+  
+  def __init__(self, group_data: GroupData):
+    self.group_data = group_data
+  
+  def __len__(self) -> int:
+    return len(self.group_data)
+  
+  def __getitem__(self, index: int) -> pd.DataFrame:
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError(index)
+    return self.group_data.get_df(index)
+  
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self.group_data.get_df(index)
 
 class Grouper:
   """
@@ -141,16 +207,13 @@ class Grouper:
   Saves the result GroupData by their column, with extra info like the file_path to save it to.
   """
   
-  def __init__(self, df: pd.DataFrame, column_list: List[str]):
+  def __init__(self, df: pd.DataFrame, column_list: List[str], file_format: str = 'csv'):
     self.dataset = df
+    self.file_format = file_format
     self.group_data_list = {}
     for i in tqdm(range(len(column_list)), desc=f'Grouping data into {len(column_list)} columns', unit='col', colour='cyan'):
       column = column_list[i]
-      self.group_data_list[column] = GroupData(
-        column = column,
-        dfs = get_group_by_func(column).group_by(self.dataset),
-        file_names=[]
-      )
+      self.group_data_list[column] = GroupData(get_group_by_func(column), self.dataset)
     
     # Build filenames after grouping to use first value of each group to name it
     for group_data in self.group_data_list.values():
@@ -167,33 +230,74 @@ class Grouper:
     dir_path: str
     files: List[str]
   
-  def save_to_files(self, root_path: str) -> SavedGroupResult:
+  def save_to_files(self, root_path: str, workers: int = None, partition_hashes: dict[str, str] = None) -> SavedGroupResult:
     """
-    Save the groups in CSV files under the root_path.
+    Save the groups in files under the root_path, in the file_format of the Grouper.
     Each group is saved in a different folder with the column name.
+    Parquet and feather are saved as a Hive partitioned dataset: group_by=day/value=2024-09-01/part-0.parquet
+    
+    The dates are formatted once for the whole dataset (only for CSVs) and the files are written
+    in parallel by a ParallelFileWriter with workers threads.
+    
+    Incremental save if partition_hashes ({file path relative to root_path: hash}, from the last run) is given:
+    only the files whose rows changed are written, the files of groups that don't exist anymore are removed
+    and partition_hashes is updated with the new hashes.
+    Otherwise the folders are emptied and every file is written.
     
     Devuelve un diccionario {columna: {dfs: [df1, df2...], dir_path, files}}
     """
     
     file_results = Grouper.SavedGroupResult()
+    formatted_dataset = format_dates(self.dataset) if self.file_format == 'csv' else self.dataset
+    
+    incremental = partition_hashes is not None
+    if incremental:
+      row_hashes = hash_rows(self.dataset)
+      columns = self.dataset.columns.tolist()
+      new_hashes = {}
+      skipped = 0
     
-    for i in tqdm(range(len(self.group_data_list.values())), desc='Saving groups to files', unit='col', colour='cyan'):
-      group_data = list(self.group_data_list.values())[i]
-      dir_name = f'group by {group_data.column}'
-      dir_path = os.path.join(root_path, dir_name)
-      
-      # If the folder didn't exist, create it
-      os.makedirs(dir_path, exist_ok=True)
-      
-      # Empty the folder beforehand
-      for file in os.listdir(dir_path):
-        os.remove(os.path.join(dir_path, file))
-      
-      file_results[group_data.column] = {'dfs': group_data.dfs, 'dir_path': dir_path, 'files': group_data.file_names}
-      # file_results[group_data.column] =  {'dfs': group_data.groups, 'dir_path': dir_path, 'files': group_data.file_names}
-
-      for (df, file_name) in zip(group_data.dfs, group_data.file_names):
-        write_csv(df, os.path.join(dir_path, file_name))
+    with ParallelFileWriter(workers) as writer:
+      for i in tqdm(range(len(self.group_data_list.values())), desc='Saving groups to files', unit='col', colour='cyan'):
+        group_data = list(self.group_data_list.values())[i]
+        dir_name = group_dir_name(group_data.column, self.file_format)
+        dir_path = os.path.join(root_path, dir_name)
+        
+        # If the folder didn't exist, create it
+        os.makedirs(dir_path, exist_ok=True)
+        
+        # Empty the folder beforehand
+        if not incremental:
+          for file in os.listdir(dir_path):
+            remove_path(os.path.join(dir_path, file))
+        
+        file_results[group_data.column] = {'dfs': group_data.dfs, 'dir_path': dir_path, 'files': group_data.file_names}
+        
+        # Groups with the same file name overwrite each other: only the last one is written
+        last_index = {file_name: index for index, file_name in enumerate(group_data.file_names)}
+        
+        # Groups that don't exist anymore (files or partition folders)
+        if incremental:
+          for file in set(os.listdir(dir_path)) - {file_name.split(os.sep)[0] for file_name in last_index}:
+            remove_path(os.path.join(dir_path, file))
+        
+        for file_name, index in last_index.items():
+          file_path = os.path.join(dir_path, file_name)
+          
+          if incremental:
+            key = os.path.join(dir_name, file_name)
+            new_hashes[key] = hash_partition(row_hashes[group_data.get_positions(index)], columns)
+            if partition_hashes.get(key) == new_hashes[key] and os.path.exists(file_path):
+              skipped += 1
+              continue
+          
+          writer.submit(group_data.get_df(index, formatted_dataset), file_path)
+    
+    writer.report()
+    if incremental:
+      print_colorized(f"{skipped} files didn't change since the last run and were not written", 'green')
+      partition_hashes.clear()
+      partition_hashes.update(new_hashes)
     
     return file_results
 
@@ -203,25 +307,61 @@ class Grouper:
     Pre-build the file paths for each group in the column.
     Grouped in folders by the column name.
     """
-    file_names = []
-    
-    for index, group in enumerate(self.group_data_list[column].dfs):
-      group_by_col = group.attrs.get('group_by', '')
-      group_by_value = group.attrs.get('group_by_value', '')
-      
-      if column == 'device_id':
-        group_by_col = get_goat_name(-1 if index > 10 else index)
-      
-      file_name = f"{group_by_col} - {group_by_value}.csv"
-      file_names.append(file_name)
-    
-    return file_names
+    group_data = self.group_data_list[column]
+    return [build_group_file_name(column, group_data.attrs(index), group_data.values[index], self.file_format)
+            for index in range(len(group_data))]
   
   #endregion ===============================================================
 
 #endregion =================================================================
 
 
+def build_file_name(column: str, attrs: dict, value) -> str:
+  """
+  File name of the group of value, from its attrs.
+  A device is named by its device_id (and its goat name), so its file keeps its name when other devices come or go.
+  """
+  group_by_col = attrs.get('group_by', '')
+  group_by_value = attrs.get('group_by_value', '')
+  
+  if column == 'device_id':
+    group_by_value = device_label(value)
+    group_by_col = get_goat_name_for(group_by_value)
+  
+  return f"{group_by_col} - {group_by_value}.csv"
+
+
+def device_label(device_id) -> str:
+  """device_id as text, without '.0' (int32 in memory, float in the stream partitions)."""
+  return str(int(device_id)) if float(device_id).is_integer() else str(device_id)
+
+
+def group_dir_name(column: str, file_format: str = 'csv') -> str:
+  """Folder of the groups of the column: 'group by X' for CSVs, Hive style 'group_by=X' for parquet and feather."""
+  return f'group by {column}' if file_format == 'csv' else f'group_by={column}'
+
+
+def build_group_file_name(column: str, attrs: dict, value, file_format: str = 'csv') -> str:
+  """
+  Path of the group file inside its group_dir_name.
+  Hive partition for parquet and feather: value=<group value>/part-0.parquet (value url encoded, as pyarrow reads it).
+  """
+  if file_format == 'csv':
+    return build_file_name(column, attrs, value)
+  
+  value = attrs.get('group_by_value', value)
+  return os.path.join(f"value={quote(str(value), safe='')}", f'part-0{file_formats[file_format]}')
+
+
+def read_group(root_path: str, column: str, value, file_format: str) -> pd.DataFrame:
+  """
+  Read a single group saved as a Hive partitioned dataset (parquet or feather), without reading the rest.
+  value as in the partition path: read_group(out, 'day', '2024-09-01', 'parquet')
+  """
+  file_name = build_group_file_name(column, {}, value, file_format)
+  return read_csv(os.path.join(root_path, group_dir_name(column, file_format), file_name))
+
+
 def group_by(df: pd.DataFrame, column_list: list[str]) -> dict[str, list[pd.DataFrame]]:
   """
   Do a Group By in the source data by different columns
@@ -236,20 +376,21 @@ def group_by(df: pd.DataFrame, column_list: list[str]) -> dict[str, list[pd.Data
   return {group.column: group.dfs for group in grouper.group_data_list.values()}
 
 
-def group_by_to_files(df: pd.DataFrame, column_list: list[str], root_path: str) -> Grouper.SavedGroupResult:
+def group_by_to_files(df: pd.DataFrame, column_list: list[str], root_path: str, partition_hashes: dict[str, str] = None, file_format: str = 'csv') -> Grouper.SavedGroupResult:
   """
   Do a Group By in the source data by different columns
   
   Save the resulting groups in CSVs under root_path, grouped by subfolders for each column.
   
   If rerun it will empty subfolders first !!
+  Unless partition_hashes of the last run are given, then only the changed files are written (see Grouper.save_to_files)
   """
   
   # Create root folder if not exists
   os.makedirs(root_path, exist_ok=True)
   
   # GROUP BY
-  grouper = Grouper(df, column_list)
+  grouper = Grouper(df, column_list, file_format)
   
   # SAVE
-  return grouper.save_to_files(root_path)
+  return grouper.save_to_files(root_path, partition_hashes=partition_hashes)
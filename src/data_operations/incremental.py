@@ -0,0 +1,152 @@
+import os, json, hashlib
+import numpy as np
+import pandas as pd
+from utils.cache import DataFrameCache
+
+#region ========================= HASHES =========================
+
+def hash_file(file_path) -> str:
+  with open(file_path, 'rb') as f:
+    return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def hash_files(file_paths: list[str]) -> str:
+  """One hash for the content of all the files, like the config files."""
+  digest = hashlib.sha256()
+  for file_path in file_paths:
+    digest.update(hash_file(file_path).encode())
+  return digest.hexdigest()
+
+def hash_rows(df: pd.DataFrame) -> np.ndarray:
+  """Hash of each row of df (uint64). Hash them once and slice them to hash each group."""
+  return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+def hash_partition(row_hashes: np.ndarray, columns: list[str]) -> str:
+  """Hash of a partition from the hashes of its rows, in order."""
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(','.join(columns).encode())
+  digest.update(np.ascontiguousarray(row_hashes).tobytes())
+  return digest.hexdigest()
+
+#endregion
+
+
+#region ========================= MANIFEST =========================
+
+class Manifest:
+  """
+  Record of the last run saved in the output folder (manifest.json):
+  - config_hash: hash of the config files and of the refactor (refactor_version). If they change, everything is rebuilt.
+  - inputs: {file name: {hash, size, mtime, valid}} of each input file.
+  - partitions: {file path relative to the output folder: hash of its rows} of each group file written.
+
+  The prepared data of each input (refactored, sorted, with end_date) is kept in the cache (DataFrameCache)
+  by the hash of the input and config_hash, so unchanged inputs are not read and refactored again.
+  Without a cache every input is prepared again, only the group files that didn't change are not written.
+  Input hashes are only computed again when the size or mtime of the file changed.
+  """
+  file_name = 'manifest.json'
+
+  def __init__(self, out_root: str, config_hash: str, cache: DataFrameCache | None = None):
+    self.out_root = out_root
+    self.file_path = os.path.join(out_root, Manifest.file_name)
+    self.cache = cache
+
+    data = {}
+    if os.path.exists(self.file_path):
+      with open(self.file_path, 'r') as f:
+        data = json.load(f)
+
+    self.inputs: dict[str, dict] = data.get('inputs', {})
+    self.partitions: dict[str, str] = data.get('partitions', {})
+    self.config_hash = config_hash
+
+    # Data prepared with other config is not valid
+    if data.get('config_hash') != config_hash:
+      self.clear()
+
+  def clear(self):
+    """Forget the last run, everything will be processed and written again."""
+    self.inputs = {}
+    self.partitions = {}
+
+  def save(self):
+    with open(self.file_path, 'w') as f:
+      json.dump({'config_hash': self.config_hash, 'inputs': self.inputs, 'partitions': self.partitions}, f, indent=2)
+
+  @staticmethod
+  def remove(out_root: str):
+    """The output was written without the manifest, the next run can't trust it."""
+    file_path = os.path.join(out_root, Manifest.file_name)
+    if os.path.exists(file_path):
+      os.remove(file_path)
+
+
+  #region ===================== INPUTS =====================
+
+  def update_inputs(self, in_file_paths: list[str]) -> list[str]:
+    """
+    Update the size, mtime and hash of the inputs. Forget the inputs that are not there anymore.
+    Returns the paths of the new or changed inputs, in the same order.
+    """
+    inputs = {}
+    changed = []
+    for file_path in in_file_paths:
+      name = os.path.basename(file_path)
+      stat = os.stat(file_path)
+      previous = self.inputs.get(name, {})
+
+      if previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime:
+        content_hash = previous['hash']
+      else:
+        content_hash = hash_file(file_path)
+
+      inputs[name] = {'hash': content_hash, 'size': stat.st_size, 'mtime': stat.st_mtime}
+      if previous.get('hash') == content_hash and 'valid' in previous:
+        inputs[name]['valid'] = previous['valid']
+
+      if not self.is_prepared(inputs[name]):
+        changed.append(file_path)
+
+    # Prepared data of removed or changed inputs
+    kept_hashes = {info['hash'] for info in inputs.values()}
+    for info in self.inputs.values():
+      if info['hash'] not in kept_hashes and self.cache is not None:
+        self.cache.remove(self.prepared_key(info['hash']))
+
+    self.inputs = inputs
+    return changed
+
+  def prepared_key(self, content_hash: str) -> str:
+    return f'prepared_{content_hash}_{self.config_hash[:16]}'
+
+  def is_prepared(self, info: dict) -> bool:
+    # Invalid inputs (valid: False) have nothing prepared but don't need to be read again
+    if 'valid' not in info:
+      return False
+    return not info['valid'] or (self.cache is not None and self.cache.contains(self.prepared_key(info['hash'])))
+
+  def save_prepared(self, file_path, df: pd.DataFrame | None):
+    info = self.inputs[os.path.basename(file_path)]
+    info['valid'] = df is not None
+    if df is not None and self.cache is not None:
+      self.cache.put(self.prepared_key(info['hash']), df)
+
+  def load_prepared(self, file_path) -> pd.DataFrame | None:
+    """
+    Prepared data of an input not changed (None if it's not valid).
+    If it's not in the cache anymore (evicted, unreadable) the input is not prepared anymore and None is returned.
+    """
+    info = self.inputs[os.path.basename(file_path)]
+    if not info['valid']:
+      return None
+    df = self.cache.get(self.prepared_key(info['hash'])) if self.cache is not None else None
+    if df is None:
+      del info['valid']
+    return df
+
+  def is_prepared_input(self, file_path) -> bool:
+    return self.is_prepared(self.inputs[os.path.basename(file_path)])
+
+  #endregion
+
+#endregion
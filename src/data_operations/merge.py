@@ -1,11 +1,178 @@
+import numpy as np
 import pandas as pd
-from utils.file_manager import read_csv, write_csv
+from typing import Callable, Iterable, Iterator
+from utils.file_manager import read_csv, write_csv, read_batches, write_batches
+from utils.config import Settings
+from data_operations.sort import sort_by, sort_keys, sort_key_types, keys_less
+from data_operations.schema import apply_schema
 
-def merge(dfs: list[pd.DataFrame]) -> pd.DataFrame:
-  return pd.concat(dfs)
+def merge(dfs: list[pd.DataFrame], settings: Settings) -> pd.DataFrame:
+  # pd.concat gives wider types if the files have different ones (int32 + float32 = float64)
+  return apply_schema(pd.concat(dfs), settings)
 
 # Merge CSV files, Sort and Save as 1 file
-def merge_csv_files(in_file_paths, merged_file_path) -> pd.DataFrame:
-  merged_df = merge([read_csv(file) for file in in_file_paths])
+# Parquet and feather files too, the format of each file is given by its extension
+# read_file can load each file from somewhere else, like a cache
+def merge_csv_files(in_file_paths, merged_file_path, settings: Settings, read_file = read_csv) -> pd.DataFrame:
+  merged_df = merge([read_file(file) for file in in_file_paths], settings)
   write_csv(merged_df, merged_file_path)
-  return merged_df
\ No newline at end of file
+  return merged_df
+
+
+#region ======================== K-WAY MERGE ========================
+
+class SortedSource:
+  """Rows of a sorted source read but not merged yet, with their sort keys."""
+
+  def __init__(self, batches: Iterable[pd.DataFrame], columns: list[str], orders: list[str]):
+    self.batches = iter(batches)
+    self.columns = columns
+    self.orders = orders
+    self.df = None
+    self.keys = None
+    self.key_types = None
+    self.exhausted = False
+
+  def __len__(self) -> int:
+    return 0 if self.df is None else len(self.df)
+
+  def load(self):
+    """Append the next batch to the pending rows. Raises ValueError if the rows are not sorted."""
+    batch = next(self.batches, None)
+    if batch is None:
+      self.exhausted = True
+      return
+
+    key_types = sort_key_types(batch, self.columns)
+    if self.key_types is not None and key_types != self.key_types:
+      raise ValueError(f"Sort columns with different types between batches: {self.key_types} != {key_types}")
+    self.key_types = key_types
+
+    batch_keys = sort_keys(batch, self.columns, self.orders)
+    if len(self) > 0:
+      batch = pd.concat([self.df, batch])
+      batch_keys = [np.concatenate([pending, new]) for pending, new in zip(self.keys, batch_keys)]
+
+    # Each row must not go before the previous one
+    if len(batch) > 1 and keys_less([key[1:] for key in batch_keys], tuple(key[:-1] for key in batch_keys)).any():
+      raise ValueError("The rows are not sorted")
+
+    self.df, self.keys = batch, batch_keys
+
+  def last_key(self) -> tuple:
+    return tuple(key[-1] for key in self.keys)
+
+  def take_before(self, bound: tuple | None) -> pd.DataFrame:
+    """Remove and return the pending rows that go before bound (all of them if None)."""
+    count = len(self) if bound is None else int(np.count_nonzero(keys_less(self.keys, bound)))
+    taken = self.df.iloc[:count]
+    self.df = self.df.iloc[count:]
+    self.keys = [key[count:] for key in self.keys]
+    return taken
+
+
+def merge_sorted(sources: list[Iterable[pd.DataFrame]], columns: list[str], orders: list[str]) -> Iterator[pd.DataFrame]:
+  """
+  K-way merge of sources already sorted by columns/orders, each one given as batches of rows.
+
+  Yields sorted batches: concatenated they are the same as sort_by(pd.concat(all the rows), columns, orders),
+  ties included (in order of source and then of row, like the stable sort).
+  Only the pending batch of each source is kept in memory (more if a run of ties spans several batches).
+
+  The rows before the smallest last key of the pending batches can't be preceded by any row not read yet,
+  so they are merged (sort_by of just those rows) and yielded.
+  Raises ValueError if a source is not sorted or can't be compared (sort columns with strings).
+  """
+  sources = [SortedSource(batches, columns, orders) for batches in sources]
+
+  while True:
+    for source in sources:
+      while len(source) == 0 and not source.exhausted:
+        source.load()
+
+    open_sources = [source for source in sources if not source.exhausted]
+
+    # Types of the keys must be the same in every source to compare them
+    key_types = [source.key_types for source in sources if source.key_types is not None]
+    if any(types != key_types[0] for types in key_types):
+      raise ValueError(f"Sort columns with different types between sources: {key_types}")
+
+    bound = min(source.last_key() for source in open_sources) if open_sources else None
+    parts = [source.take_before(bound) for source in sources if len(source) > 0]
+    parts = [part for part in parts if len(part) > 0]
+
+    if parts:
+      yield sort_by(pd.concat(parts), columns, orders)
+    elif open_sources:
+      # Every pending row is a tie with the bound: read more rows of the sources that end in it
+      for source in open_sources:
+        if source.last_key() == bound:
+          source.load()
+
+    if not open_sources and all(len(source) == 0 for source in sources):
+      return
+
+
+class RunSplitter:
+  """
+  Sorted rows given in batches, in parts that don't split a run of rows with the same keys
+  (keys(batch): arrays that can be compared with ==, like the device_id and sent_time of each row).
+
+  add() returns the rows of the batch before its last run, that waits for the next batch. close() returns the last run.
+  """
+
+  def __init__(self, keys: Callable[[pd.DataFrame], list[np.ndarray]]):
+    self.keys = keys
+    self.pending: pd.DataFrame | None = None
+
+  def add(self, batch: pd.DataFrame) -> pd.DataFrame:
+    if self.pending is not None:
+      batch = pd.concat([self.pending, batch])
+    if len(batch) == 0:
+      return batch
+
+    # The rows of the last run are at the end (the rows are sorted by the keys)
+    last_run = np.ones(len(batch), dtype=bool)
+    for key in self.keys(batch):
+      last_run &= key == key[-1]
+    start = 0 if last_run.all() else len(batch) - int(np.argmin(last_run[::-1]))
+
+    self.pending = batch.iloc[start:]
+    return batch.iloc[:start]
+
+  def close(self) -> pd.DataFrame | None:
+    pending, self.pending = self.pending, None
+    return pending
+
+
+def split_runs(batches: Iterable[pd.DataFrame], keys: Callable[[pd.DataFrame], list[np.ndarray]]) -> Iterator[pd.DataFrame]:
+  """Same rows in batches that don't split a run of rows with the same keys (RunSplitter)."""
+  splitter = RunSplitter(keys)
+  for batch in batches:
+    part = splitter.add(batch)
+    if len(part) > 0:
+      yield part
+  last = splitter.close()
+  if last is not None and len(last) > 0:
+    yield last
+
+
+def merge_sorted_files(in_file_paths: list[str], merged_file_path, columns: list[str], orders: list[str], batch_rows: int, settings: Settings, write = write_batches) -> int:
+  """
+  Merge files already sorted by columns/orders into merged_file_path, reading and writing them in batches (merge_sorted).
+  Memory depends on batch_rows and the number of files, not on their size.
+
+  Every batch has the columns and types that pd.concat of all the files would give.
+  Except the categories, each batch keeps the categories it was read with (the values written are the same).
+  write(batches, merged_file_path) writes them, like write_batches. Returns the number of rows written.
+  """
+  # Columns and types of the merged data, from the first rows of each file
+  samples = [next(read_batches(file_path, 1), None) for file_path in in_file_paths]
+  schema = apply_schema(pd.concat([sample for sample in samples if sample is not None]), settings)
+  dtypes = {column: dtype for column, dtype in schema.dtypes.items() if not isinstance(dtype, pd.CategoricalDtype)}
+
+  sources = [read_batches(file_path, batch_rows) for file_path in in_file_paths]
+  batches = (batch.reindex(columns=schema.columns).astype(dtypes) for batch in merge_sorted(sources, columns, orders))
+  return write(batches, merged_file_path)
+
+#endregion
@@ -0,0 +1,226 @@
+import os, shutil, pickle
+from itertools import count
+from threading import Lock
+from typing import Callable, Iterator, NamedTuple
+import numpy as np
+import pandas as pd
+from data_operations.sort import sort_by, sort_key_types
+from data_operations.merge import merge_sorted
+from data_operations.time_index import rebatch
+
+#region ========================= PARTITION STORE =========================
+
+class Run(NamedTuple):
+  """Rows [start, end) of a spill file: the rows of a partition written at once."""
+  path: str
+  start: int
+  end: int
+  tag: str
+
+
+class PartitionStore:
+  """
+  Spills DataFrames to disk partitioned by a key, so they don't have to be kept in memory.
+
+  Rows are buffered in memory and written when buffer_rows is reached, all the partitions of a flush
+  in a single spill file: grouped by key in the order of keys() and pickled (so dtypes are kept) in batches of batch_rows rows.
+  The rows of a partition in a spill file are a run. Reading a partition gives its rows in order of arrival.
+
+  Null keys are kept in their own partition (key None) unless dropna.
+
+  With sort_columns the rows of each run are sorted too when written (a single sort of the whole flush),
+  so read_sorted() merges the runs of a partition (merge_sorted) without loading it whole.
+  A partition of buffer_rows rows or less is read and sorted at once instead.
+  Without sort_columns read_sorted() gives the rows in order of arrival, in batches.
+
+  Reading the partitions in the order of keys() reads each spill file from start to end: the last batch read
+  of each one (up to cached_files) is kept, so a batch with the runs of several partitions is unpickled once.
+  The runs merged into a bigger one stay in their files until clear().
+  """
+  # Runs merged at once: each one is read in batches of batch_rows, about buffer_rows rows in memory
+  merge_width = 16
+  min_batch_rows = 1000
+  cached_files = 64
+  # Position of the key of each row (in the order of keys()) while the flush is sorted
+  key_column = '_partition'
+
+  def __init__(self, root_path: str, buffer_rows: int, dropna: bool = True, sort_columns: list[str] | None = None, sort_orders: list[str] | None = None):
+    self.root_path = root_path
+    self.buffer_rows = buffer_rows
+    self.dropna = dropna
+    self.sort_columns = sort_columns
+    self.sort_orders = sort_orders
+    self.batch_rows = max(self.min_batch_rows, buffer_rows // self.merge_width)
+
+    self.partitions: dict[object, list[Run]] = {}   # key -> runs, in order of arrival
+    self.offsets: dict[str, list[int]] = {}         # spill file -> position of each batch
+    self.buffers: dict[str, list[tuple[pd.DataFrame, pd.Series]]] = {}   # tag -> rows and their keys
+    self.buffered_rows = 0
+    self.file_count = count()   # next() is atomic, partitions can be merged from different threads
+    self.cache: dict[str, tuple[int, pd.DataFrame]] = {}   # spill file -> last batch read
+    self.cache_lock = Lock()
+
+    os.makedirs(root_path, exist_ok=True)
+
+  def append(self, df: pd.DataFrame, keys: pd.Series, tag: str = ''):
+    """Append the rows of df to the partition of their key. Runs are written with the tag to discard them later."""
+    if self.dropna:
+      df, keys = df[keys.notna().to_numpy()], keys[keys.notna().to_numpy()]
+    if len(df) == 0:
+      return
+    self.buffers.setdefault(tag, []).append((df, keys))
+    self.buffered_rows += len(df)
+
+    if self.buffered_rows >= self.buffer_rows:
+      self.flush()
+
+  def flush(self):
+    for tag, parts in self.buffers.items():
+      piece = pd.concat([df for df, _ in parts])
+      codes, uniques = pd.factorize(pd.concat([keys for _, keys in parts], ignore_index=True), use_na_sentinel=False)
+      uniques = [None if pd.isna(key) else key for key in uniques]
+
+      # Grouped by key in the order of keys(), each one sorted by sort_columns (stable: ties keep their order of arrival)
+      order = sorted(range(len(uniques)), key=lambda code: (uniques[code] is None, uniques[code]))
+      positions = np.empty(len(uniques), dtype=np.int64)
+      positions[order] = np.arange(len(uniques))
+      piece = piece.assign(**{self.key_column: positions[codes]})
+      if self.sort_columns is None:
+        piece = piece.iloc[np.argsort(piece[self.key_column].to_numpy(), kind='stable')]
+      else:
+        piece = sort_by(piece, [self.key_column] + self.sort_columns, ['asc'] + self.sort_orders)
+      positions = piece[self.key_column].to_numpy()
+      starts = np.flatnonzero(np.diff(positions, prepend=-1))
+
+      path = self.write_spill([piece.drop(columns=[self.key_column])], tag)
+      for start, end in zip(starts, np.append(starts[1:], len(piece))):
+        self.partitions.setdefault(uniques[order[positions[start]]], []).append(Run(path, int(start), int(end), tag))
+
+    self.buffers = {}
+    self.buffered_rows = 0
+
+  def discard(self, tag: str):
+    """Remove the rows appended with the tag (buffered or already written)."""
+    self.buffered_rows -= sum(len(df) for df, _ in self.buffers.pop(tag, []))
+
+    for key, runs in list(self.partitions.items()):
+      runs = [run for run in runs if run.tag != tag]
+      if runs:
+        self.partitions[key] = runs
+      else:
+        del self.partitions[key]
+
+    for path in [path for path in self.offsets if path.endswith(f"_{tag}.pkl")]:
+      os.remove(path)
+      del self.offsets[path]
+      self.cache.pop(path, None)
+
+  def keys(self) -> list:
+    """Keys sorted like groupby does, null key last."""
+    self.flush()
+    return sorted(self.partitions, key=lambda key: (key is None, key))
+
+  def rows(self, key) -> int:
+    self.flush()
+    return sum(run.end - run.start for run in self.partitions[key])
+
+  def read(self, key) -> pd.DataFrame:
+    self.flush()
+    return pd.concat([batch for run in self.partitions[key] for batch in self.read_run(run)])
+
+  def read_sorted(self, key, transform: Callable[[pd.DataFrame], pd.DataFrame] | None = None) -> Iterator[pd.DataFrame]:
+    """
+    Rows of the partition sorted by sort_columns, in batches (merge_sorted of its runs).
+    Ties keep the order of arrival. transform is applied to each batch read (types...) before merging it.
+
+    Runs are merged merge_width at a time: if there are more, the first ones are merged into a bigger run on disk first.
+    A partition of buffer_rows rows or less, or whose sort columns can't be compared as numbers (strings),
+    is sorted at once instead.
+    Partitions of different keys can be read at the same time from different threads.
+    """
+    self.flush()
+    runs = self.partitions[key]
+    transform = transform or (lambda df: df)
+
+    if self.sort_columns is None:
+      yield from rebatch((batch for run in runs for batch in self.read_run(run, transform)), self.batch_rows)
+      return
+
+    sample = transform(next(self.read_run(runs[0])))
+    if self.rows(key) <= self.buffer_rows or not comparable_keys(sample, self.sort_columns):
+      yield sort_by(pd.concat([transform(batch) for run in runs for batch in self.read_run(run)]), self.sort_columns, self.sort_orders)
+      return
+
+    while len(runs) > self.merge_width:
+      # The merged run goes in the place of the first one, so it keeps the order of arrival of the ties
+      merged = merge_sorted([self.read_run(run, transform) for run in runs[:self.merge_width]], self.sort_columns, self.sort_orders)
+      path = self.write_spill(merged)
+      runs = [Run(path, 0, sum(run.end - run.start for run in runs[:self.merge_width]), '')] + runs[self.merge_width:]
+      self.partitions[key] = runs
+
+    yield from merge_sorted([self.read_run(run, transform) for run in runs], self.sort_columns, self.sort_orders)
+
+  def read_run(self, run: Run, transform: Callable[[pd.DataFrame], pd.DataFrame] | None = None) -> Iterator[pd.DataFrame]:
+    """Rows of the run, in the batches of its spill file."""
+    for index in range(run.start // self.batch_rows, (run.end - 1) // self.batch_rows + 1):
+      first = index * self.batch_rows
+      batch = self.read_batch(run.path, index).iloc[max(run.start - first, 0):run.end - first]
+      yield batch if transform is None else transform(batch)
+
+  def read_batch(self, path: str, index: int) -> pd.DataFrame:
+    cached = self.cache.get(path)
+    if cached is not None and cached[0] == index:
+      return cached[1]
+
+    with open(path, 'rb') as file:
+      file.seek(self.offsets[path][index])
+      batch = pickle.load(file)
+
+    with self.cache_lock:
+      if path in self.cache or len(self.cache) < self.cached_files:
+        self.cache[path] = (index, batch)
+    return batch
+
+  def write_spill(self, batches, tag: str = '') -> str:
+    """Write the sorted batches in a new spill file, in batches of batch_rows rows. Returns its path."""
+    path = os.path.join(self.root_path, f"{next(self.file_count):010d}_{tag}.pkl")
+    offsets = []
+    with open(path, 'wb') as file:
+      for batch in rebatch(batches, self.batch_rows):
+        offsets.append(file.tell())
+        pickle.dump(batch, file, protocol=pickle.HIGHEST_PROTOCOL)
+    self.offsets[path] = offsets
+    return path
+
+  def clear(self):
+    shutil.rmtree(self.root_path, ignore_errors=True)
+    self.partitions = {}
+    self.offsets = {}
+    self.buffers = {}
+    self.buffered_rows = 0
+    self.cache = {}
+
+
+class SortedPartition:
+  """
+  Rows of a partition of the store sorted (read_sorted), only read when iterated. len() is its number of rows.
+  Can be given to a ParallelFileWriter like a DataFrame to write the partition in another thread.
+  """
+
+  def __init__(self, store: PartitionStore, key, transform: Callable[[pd.DataFrame], pd.DataFrame] | None = None):
+    self.store = store
+    self.key = key
+    self.transform = transform
+
+  def __len__(self) -> int:
+    return self.store.rows(self.key)
+
+  def __iter__(self) -> Iterator[pd.DataFrame]:
+    return self.store.read_sorted(self.key, self.transform)
+
+
+def comparable_keys(df: pd.DataFrame, columns: list[str]) -> bool:
+  """True if the columns can be compared as numbers by merge_sorted (not strings)."""
+  return all(isinstance(key_type, pd.CategoricalDtype) or key_type in ('datetime', 'number') for key_type in sort_key_types(df, columns))
+
+#endregion ===============================================================
@@ -1,10 +1,18 @@
-import os, json
+import os, json, hashlib
+from collections import Counter
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from utils.config import Config
+from utils.config import Settings
+from utils.cache import DataFrameCache
 from utils.file_manager import read_csv, write_csv
-from utils.utils import print_colorized, str_to_time
+from utils.metrics import pipeline_metrics
+from utils.utils import print_colorized, str_to_time, series_to_time, sniff_time_format, strip_tz_offset
 from data_operations.sort import sort_by
 from data_operations.creation import add_end_date
+from data_operations.incremental import hash_file
+from data_operations.schema import unknown_msg, empty_msg, enum_dtype, apply_schema
+from data_operations.filters import drop_invalid_positions, filter_fixes, filter_stats
 
 #region ======================== DELETE ========================
 
@@ -33,28 +41,70 @@ def has_required_columns(df):
 #region ======================== TIME ========================
 
 
-cached_time_formats = {}
+# LRU cache string -> Timestamp, only for the values with an unknown format (the slow path of series_to_time)
+time_cache_size = 100_000
+
+@lru_cache(maxsize=time_cache_size)
+def cached_str_to_time(value: str) -> pd.Timestamp:
+  return str_to_time(value)
 
 def fix_time_format(value: str | pd.Timestamp) -> pd.Timestamp | None:
   if type(value) == pd.Timestamp:
     return value
   
-  # Cached values
-  if value in cached_time_formats:
-    return cached_time_formats[value]
+  try:
+    return cached_str_to_time(value)
+  except TypeError:
+    # Unhashable values can't be cached
+    return str_to_time(value)
+
+
+# FORMATS LEARNED for each time column of the file being refactored
+# The first chunk sniffs the format, the next ones use it directly
+learned_time_formats: dict[str, str] = {}
+
+def forget_time_formats():
+  """Call it before refactoring a new file, each file can have its own formats."""
+  learned_time_formats.clear()
+
+
+# Rows parsed with the learned format and with fix_time_format (and its cache hits/misses)
+time_parse_stats = Counter()
+
+def fix_time_column(column: pd.Series) -> pd.Series:
+  """Whole column at once. Only the values with an unknown format go through fix_time_format."""
+  date_format = learned_time_formats.get(column.name)
+  if date_format is None and (pd.api.types.is_object_dtype(column.dtype) or pd.api.types.is_string_dtype(column.dtype)):
+    date_format = sniff_time_format(strip_tz_offset(column))
+    if date_format is not None:
+      learned_time_formats[column.name] = date_format
+  
+  cache_info = cached_str_to_time.cache_info()
+  times = series_to_time(column, fallback=fix_time_format, date_format=date_format, stats=time_parse_stats)
   
-  time = str_to_time(value)
-  cached_time_formats[value] = time
-  return time
+  new_cache_info = cached_str_to_time.cache_info()
+  time_parse_stats['cache_hits'] += new_cache_info.hits - cache_info.hits
+  time_parse_stats['cache_misses'] += new_cache_info.misses - cache_info.misses
+  return times
+
+def show_time_parse_stats():
+  stats = time_parse_stats
+  if stats['format_rows'] + stats['fallback_rows'] == 0:
+    return
+  print_colorized(f"Dates parsed: {stats['format_rows']} with the format of their column, "
+                  f"{stats['fallback_rows']} one by one "
+                  f"(cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, "
+                  f"{cached_str_to_time.cache_info().currsize}/{time_cache_size} values)", 'blue')
 
 #endregion
 
 
 #region ====================== LAT LON ========================
 
-def fix_lat(lat):  return fix_lat_lon_format(lat, 2)
-def fix_lon(lon):  return fix_lat_lon_format(lon, 1)
+def fix_lat(column: pd.Series):  return fix_lat_lon_column(column, 2)
+def fix_lon(column: pd.Series):  return fix_lat_lon_column(column, 1)
 
+# Single value version
 def fix_lat_lon_format(value, integer_digits):
   if value == '':
     return value
@@ -67,6 +117,67 @@ def fix_lat_lon_format(value, integer_digits):
     return 'nan'
   return value
 
+# Python writes floats without exponent between these values (str(value) == '38.3843833')
+positional_float_range = (1e-4, 1e16)
+powers_of_ten = 10.0 ** np.arange(17)
+
+def fix_lat_lon_column(column: pd.Series, integer_digits: int) -> pd.Series:
+  """
+  fix_lat_lon_format for the whole column at once.
+  
+  Returns float64 with NaN for the values that can't be converted.
+  
+  Values that already have integer_digits digits before the dot are returned as they are:
+  dividing its digits by 10^(decimal digits) gives back the same float,
+  as long as str(value) has at most 15 digits (checked rounding the value to 15 digits).
+  The rest of values count its digits from their text, like fix_lat_lon_format.
+  """
+  if not pd.api.types.is_float_dtype(column.dtype):
+    return fix_lat_lon_text(column, integer_digits)
+  
+  values = column.to_numpy(dtype=float)
+  fixed = values.copy()
+  
+  with np.errstate(all='ignore'):
+    abs_values = np.abs(values)
+    value_integer_digits = np.maximum(1, np.searchsorted(powers_of_ten, np.floor(abs_values), side='right'))
+    scale = 10.0 ** (15 - value_integer_digits)
+    
+    well_formed = (
+      (value_integer_digits == integer_digits) &
+      ((abs_values >= positional_float_range[0]) | (values == 0)) &
+      (abs_values < positional_float_range[1]) &
+      (np.rint(values * scale) / scale == values)
+    )
+  
+  to_fix = ~well_formed & ~np.isnan(values)
+  if to_fix.any():
+    fixed[to_fix] = fix_lat_lon_text(column[to_fix], integer_digits).to_numpy()
+  
+  return pd.Series(fixed, index=column.index, name=column.name)
+
+def fix_lat_lon_text(column: pd.Series, integer_digits: int) -> pd.Series:
+  """Counts the digits of str(value) for every value of the column and rescales them."""
+  text = column.astype(str)
+  without_dot = text.str.replace('.', '', regex=False)
+  
+  total_digits = without_dot.str.replace('-', '', regex=False).str.len()
+  decimal_digits = (total_digits - integer_digits).to_numpy(dtype=float)
+  
+  # float() parses the digits exactly, pd.to_numeric can be 1 ulp away
+  try:
+    digits = without_dot.astype(float).to_numpy()
+  except ValueError:
+    digits = without_dot.map(str_to_float).to_numpy(dtype=float)
+  
+  return pd.Series(digits / np.power(10.0, decimal_digits), index=column.index, name=column.name)
+
+def str_to_float(value: str) -> float:
+  try:
+    return float(value)
+  except ValueError:
+    return np.nan
+
 #endregion
 
 
@@ -74,19 +185,11 @@ def fix_lat_lon_format(value, integer_digits):
 
 # Use /config/enum_identifiers.json to substitute similar values with the one correct enum value
 # This makes enum values consistent and easier to work with in the data
-
-identifiers: dict = Config.config_file('enum_identifiers.json')
-
-def fix_msg_type(value: str):       return fix_enum('msg_type', value, identifiers['msg_type'])
-def fix_mode(value: str):           return fix_enum('mode', value, identifiers['mode'])
-def fix_collar_status(value: str):  return fix_enum('collar_status', value, identifiers['collar_status'])
-def fix_fence_status(value: str):   return fix_enum('fence_status', value, identifiers['fence_status'])
+# (identifiers, unknown_msg and empty_msg are in schema.py, with the categories of each enum)
 
 # UNKNOWN VALUES:
 # All unknown values found will be stored in unknown_enum_found
 # For future analysis and correction in /config/enum_identifiers.json
-unknown_msg = 'unknown'
-empty_msg = ''
 unknown_enum_found = {
   "msg_type": set(),
   "collar_status": set(),
@@ -100,21 +203,63 @@ def show_unknown_enum_found():
       print_colorized(f"Unknown {column} found: {unknown_msgs}", 'yellow')
 
 
-def fix_enum(column_name: str, value: str, enum_values: dict):
-  if value == '' or value is None or pd.isna(value):
-    return ''
+class EnumNormalizer:
+  """
+  Normalizes an enum column with the identifiers of /config/enum_identifiers.json.
   
-  if type(value) != str:
-    unknown_enum_found[column_name].add(f"{value} ({type(value)})")
-    return unknown_msg
+  The identifiers are lowercased once when built.
+  Each distinct value of the column is fixed only once and the whole column
+  is mapped in one pass to a category dtype with a fixed set of categories:
+  the enum values + unknown_msg + empty_msg.
+  So the cost depends on the number of distinct values, not on the number of rows.
+  """
+  def __init__(self, column_name: str, enum_values: dict[str, list[str]]):
+    self.column_name = column_name
+    
+    # (identifier, enum value) in priority order
+    self.rules = [(identifier.lower(), enum_value)
+                  for enum_value, identifiers in enum_values.items()
+                  for identifier in identifiers]
+    
+    self.dtype = enum_dtype(enum_values)
   
-  for enum_value, identifiers in enum_values.items():
-    for identifier in identifiers:
-      if identifier.lower() in value.lower():
+  def fix_value(self, value: str) -> str:
+    if value == '' or value is None or pd.isna(value):
+      return empty_msg
+    
+    if type(value) != str:
+      unknown_enum_found[self.column_name].add(f"{value} ({type(value)})")
+      return unknown_msg
+    
+    value_lower = value.lower()
+    for identifier, enum_value in self.rules:
+      if identifier in value_lower:
         return enum_value
+    
+    unknown_enum_found[self.column_name].add(value)
+    return unknown_msg
   
-  unknown_enum_found[column_name].add(value)
-  return unknown_msg
+  def __call__(self, column: pd.Series) -> pd.Series:
+    # codes point to the distinct values, -1 for null values
+    codes, distinct_values = pd.factorize(column)
+    
+    categories = self.dtype.categories
+    distinct_codes = [categories.get_loc(self.fix_value(value)) for value in distinct_values]
+    distinct_codes.append(categories.get_loc(empty_msg))
+    
+    codes = np.array(distinct_codes)[codes]
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=self.dtype), index=column.index, name=column.name)
+
+
+# Built once for each settings, the first time they are used
+@lru_cache(maxsize=4)
+def enum_normalizers(settings: Settings) -> dict[str, EnumNormalizer]:
+  return {column: EnumNormalizer(column, enum_values) for column, enum_values in settings.identifiers.items()}
+
+def fix_msg_type(column: pd.Series, settings: Settings):       return enum_normalizers(settings)['msg_type'](column)
+def fix_mode(column: pd.Series, settings: Settings):           return enum_normalizers(settings)['mode'](column)
+def fix_collar_status(column: pd.Series, settings: Settings):  return enum_normalizers(settings)['collar_status'](column)
+def fix_fence_status(column: pd.Series, settings: Settings):   return enum_normalizers(settings)['fence_status'](column)
 
 #endregion
 
@@ -122,10 +267,11 @@ def fix_enum(column_name: str, value: str, enum_values: dict):
 #region ====================== REFACTOR ======================
 
 # FIXES => Apply fix function to each column
+# Each fix receives the whole column (and the settings, the enum fixes) and returns the fixed column
 fixes = {
   'device_id': None,
-  'position_time': fix_time_format,
-  'time': fix_time_format,
+  'position_time': fix_time_column,
+  'time': fix_time_column,
   'msg_type': fix_msg_type,
   'lon': fix_lon,
   'lat': fix_lat,
@@ -134,7 +280,20 @@ fixes = {
   'fence_status': fix_fence_status,
 }
 
-def refactor(df: pd.DataFrame) -> pd.DataFrame:  
+# Bump it when a fix gives different results, so the cached refactored data is not used anymore
+fixes_version = 2
+
+def refactor_version(settings: Settings) -> str:
+  """Version of the refactor: fixes_version, the fix of each column, the enum identifiers and the schema."""
+  version = {
+    'fixes_version': fixes_version,
+    'fixes': {column: fix.__name__ if fix else None for column, fix in fixes.items()},
+    'identifiers': settings.identifiers,
+    'float32_positions': settings.float32_positions,
+  }
+  return hashlib.sha256(json.dumps(version, sort_keys=True).encode()).hexdigest()[:16]
+
+def refactor(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:  
   if not has_required_columns(df):
     print_colorized(f"DATA INVALID. The required columns are not present in the file. {required_columns}", 'red')
     return
@@ -142,14 +301,7 @@ def refactor(df: pd.DataFrame) -> pd.DataFrame:
   # FIXES => Apply fix function to each column
   for column, fix_function in fixes.items():
     if column in df.columns and fix_function:
-      df[column] = df[column].apply(fix_function)
-  
-  # Convert each column to its correct data type
-  for col in df.columns:    
-    if col in ['lat', 'lon']:
-      df[col] = df[col].astype(float)
-    elif col in ['msg_type', 'mode', 'collar_status', 'fence_status']:
-      df[col] = df[col].astype('category')
+      df[column] = fix_function(df[column], settings) if column in settings.identifiers else fix_function(df[column])
   
   # Rename columns
   df.rename(
@@ -169,16 +321,81 @@ def refactor(df: pd.DataFrame) -> pd.DataFrame:
   
   df = df[required_columns + optional_columns]
   
-  return df
+  return apply_schema(df, settings)
 
 
-def refactor_data_file(in_path, out_path, do_add_end_date=False):
+def read_refactored(in_path, settings: Settings, cache: DataFrameCache | None = None) -> pd.DataFrame | None:
+  """
+  read_csv + refactor of a raw data file.
+  
+  With a cache, the refactored data is stored by the hash of the file content and the refactor_version,
+  so the file is only parsed and refactored again when it or the fixes change.
+  """
+  forget_time_formats()
+  
+  if cache is None:
+    df = read_csv(in_path)
+    return refactor(df, settings) if df is not None else None
+  
+  key = refactor_cache_key(in_path, settings)
+  df = cache.get(key)
+  if df is not None:
+    return df
+  
   df = read_csv(in_path)
-  df = refactor(df)
+  if df is None:
+    return None
+  
+  df = refactor(df, settings)
+  if df is not None:
+    cache.put(key, df)
+  return df
+
+
+def refactor_cache_key(in_path, settings: Settings) -> str:
+  return f'{hash_file(in_path)}_{refactor_version(settings)}'
+
+
+def refactor_data_file(in_path, out_path, settings: Settings, do_add_end_date=False, cache: DataFrameCache | None = None):
+  df = read_refactored(in_path, settings, cache)
   
   out_path = os.path.join(out_path, os.path.basename(in_path))
   write_csv(df, out_path)
   return out_path
 
+
+def prepare_data_file(in_path, settings: Settings, cache: DataFrameCache | None = None) -> pd.DataFrame | None:
+  """Read, refactor (or load it from the cache), filter the invalid and repeated positions, sort and add end_date to a raw data file."""
+  with pipeline_metrics.stage('prepare', file=in_path) as stage:
+    df = read_refactored(in_path, settings, cache)
+    if df is None:
+      return None
+    stage.rows_in = len(df)
+    
+    df = drop_invalid_positions(df, settings)
+    df = sort_by(df, settings.sort_by_columns, settings.sort_by_orders)
+    df = filter_fixes(df, settings)
+    df = add_end_date(df)
+    stage.rows_out = len(df)
+    return df
+
+
+def prepare_data_file_worker(in_path, settings: Settings, cache: DataFrameCache | None = None) -> tuple[pd.DataFrame | None, dict[str, set], Counter, Counter, list[dict]]:
+  """
+  prepare_data_file to run in a worker process.
+  
+  unknown_enum_found, time_parse_stats, filter_stats and pipeline_metrics only live in the worker,
+  so the unknown values found, the dates parsed, the rows filtered and the metrics of this file are returned with the data.
+  The DataFrame is returned pickled as it is (enums as categories, dates as datetime64), it's already compact.
+  """
+  for unknown_values in unknown_enum_found.values():
+    unknown_values.clear()
+  time_parse_stats.clear()
+  filter_stats.clear()
+  pipeline_metrics.clear()
+  
+  df = prepare_data_file(in_path, settings, cache)
+  return df, {column: set(unknown_values) for column, unknown_values in unknown_enum_found.items()}, Counter(time_parse_stats), Counter(filter_stats), pipeline_metrics.clear()
+
 #endregion
 
@@ -0,0 +1,108 @@
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from utils.config import Config, Settings
+from utils.utils import print_colorized
+
+#region ======================== SCHEMA ========================
+
+# Tipos compactos de los datos de collares en memoria
+#
+# Bytes per row of the processed data:
+#   device_id           int64 -> int32 (float64 -> float32 if it has nulls)     8 -> 4
+#   lat, lon            float64, float32 with schema.float32_positions          16 -> 8
+#   msg_type, mode...   category with the fixed categories of the enums         1 each
+#   sent_time, received_time, end_date   datetime64[ns]                         24
+#
+# float32 keeps ~7 significant digits: lat/lon with an error < 4e-6 degrees (< 0.5 m),
+# but the values written to the CSVs have less decimals (38.384384 instead of 38.3843833).
+
+unknown_msg = 'unknown'
+empty_msg = ''
+
+def enum_dtype(enum_values: dict[str, list[str]]) -> pd.CategoricalDtype:
+  """Fixed categories of an enum column: the enum values + unknown_msg + empty_msg."""
+  # Sorted like the categories astype('category') infers, so sorting and grouping keep their order
+  return pd.CategoricalDtype(sorted({*enum_values.keys(), unknown_msg, empty_msg}))
+
+@lru_cache(maxsize=4)
+def enum_dtypes(settings: Settings) -> dict[str, pd.CategoricalDtype]:
+  """enum_dtype of each enum column of the settings (enum_identifiers.json)."""
+  return {column: enum_dtype(enum_values) for column, enum_values in settings.identifiers.items()}
+
+position_columns = ['lat', 'lon']
+
+
+def compact_device_id(column: pd.Series) -> np.dtype | None:
+  """Smaller type that keeps every device_id exactly, None if there isn't."""
+  if column.dtype == np.int64:
+    info = np.iinfo(np.int32)
+    if len(column) == 0 or (info.min <= column.min() and column.max() <= info.max):
+      return np.dtype(np.int32)
+  elif column.dtype == np.float64:
+    values = column.to_numpy()
+    with np.errstate(all='ignore'):
+      exact = values.astype(np.float32).astype(np.float64) == values
+    if (exact | np.isnan(values)).all():
+      return np.dtype(np.float32)
+  return None
+
+
+def compact_enum(column: pd.Series, dtype: pd.CategoricalDtype) -> pd.CategoricalDtype | None:
+  """Fixed categories of the enum if every value of the column is one of them (read from a CSV they are inferred)."""
+  if column.dtype == dtype:
+    return None
+  values = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column.dropna().unique()
+  if set(values) <= set(dtype.categories):
+    return dtype
+  return None
+
+
+def apply_schema(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:
+  """
+  df with the compact types of the schema. Only the columns with other types are converted.
+  Call it after every operation that can change the types (pd.concat of int32 and float32 gives float64,
+  categories read from a CSV only have the values of the file...).
+  """
+  dtypes = {}
+
+  if 'device_id' in df.columns:
+    dtypes['device_id'] = compact_device_id(df['device_id'])
+
+  if settings.float32_positions:
+    for column in position_columns:
+      if column in df.columns and df[column].dtype == np.float64:
+        dtypes[column] = np.dtype(np.float32)
+
+  for column, dtype in enum_dtypes(settings).items():
+    if column in df.columns:
+      dtypes[column] = compact_enum(df[column], dtype)
+
+  dtypes = {column: dtype for column, dtype in dtypes.items() if dtype is not None}
+  return df.astype(dtypes, copy=False) if dtypes else df
+
+#endregion
+
+
+#region ====================== MEMORY REPORT ======================
+
+# Bytes of the data at each stage of the last run (df.memory_usage(deep=True))
+memory_by_stage: dict[str, int] = {}
+
+def memory_usage(*dfs: pd.DataFrame) -> int:
+  return sum(int(df.memory_usage(deep=True).sum()) for df in dfs if df is not None)
+
+def memory_report(stage: str, *dfs: pd.DataFrame):
+  """Save the memory used by the data at the stage, printed with --memory-report."""
+  memory_by_stage[stage] = memory_usage(*dfs)
+  if Config.memory_report:
+    rows = sum(len(df) for df in dfs if df is not None)
+    print_colorized(f"Memory {stage}: {memory_by_stage[stage] / 2**20:.1f} MB ({memory_by_stage[stage] / max(rows, 1):.1f} bytes/row)", 'gray')
+
+def show_memory_report():
+  if not Config.memory_report or not memory_by_stage:
+    return
+  stage, peak = max(memory_by_stage.items(), key=lambda item: item[1])
+  print_colorized(f"Peak memory of the data: {peak / 2**20:.1f} MB at {stage}", 'blue')
+
+#endregion
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from utils.utils import print_colorized
 
@@ -23,8 +24,64 @@ def sort_by(df: pd.DataFrame, columns: list[str] | str = ['device_id', 'sent_tim
           df[col] = df[col].cat.as_ordered()
 
   # Sorting
+  # Stable: rows with the same values keep their order, so results don't depend on how the data was split
   ascending = [ord == 'asc' for ord in valid_order]
-  return df.sort_values(by=valid_columns, ascending=ascending)
+  return df.sort_values(by=valid_columns, ascending=ascending, kind='stable')
+
+def sort_keys(df: pd.DataFrame, columns: list[str], order: list[str]) -> list[np.ndarray]:
+  """
+  Numeric keys of each row that sort like sort_by(df, columns, order):
+  2 arrays per column (is null, value), compared lexicographically. Nulls go last, like sort_values.
+  
+  Keys of different DataFrames can be compared if they have the same columns
+  and the same categories in the categorical ones.
+  Raises ValueError for columns that can't be compared as numbers (strings).
+  """
+  keys = []
+  for col, ord in zip(columns, order):
+    values = df[col]
+    
+    if isinstance(values.dtype, pd.CategoricalDtype):
+      numbers = values.cat.codes.to_numpy(dtype=np.int64)
+      nulls = numbers < 0
+    elif pd.api.types.is_datetime64_any_dtype(values.dtype):
+      # int64, float64 would lose the nanoseconds
+      nulls = values.isna().to_numpy()
+      numbers = values.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    elif pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+      numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)
+      nulls = np.isnan(numbers)
+    else:
+      raise ValueError(f"Column {col} ({values.dtype}) can't be compared as numbers")
+    
+    numbers = np.where(nulls, 0, numbers if ord == 'asc' else -numbers)
+    keys += [nulls.astype(np.int8), numbers]
+  
+  return keys
+
+def sort_key_types(df: pd.DataFrame, columns: list[str]) -> list:
+  """Type of each sort key. Keys of DataFrames with the same types can be compared."""
+  types = []
+  for col in columns:
+    dtype = df[col].dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+      types.append(dtype)
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+      types.append('datetime')
+    elif pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+      types.append('number')
+    else:
+      types.append(str(dtype))
+  return types
+
+def keys_less(keys: list[np.ndarray], bound: tuple) -> np.ndarray:
+  """Mask of the rows whose keys (sort_keys) go before the bound keys."""
+  less = np.zeros(len(keys[0]), dtype=bool)
+  equal = np.ones(len(keys[0]), dtype=bool)
+  for key, bound_key in zip(keys, bound):
+    less |= equal & (key < bound_key)
+    equal &= key == bound_key
+  return less
 
 def sort_by_id(df: pd.DataFrame):
     return sort_by(df, ['device_id'], ['asc'])
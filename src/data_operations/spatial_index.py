@@ -0,0 +1,280 @@
+import os, json, shutil
+import numpy as np
+import pandas as pd
+from typing import Iterable, Sequence
+from data_operations.sort import sort_by
+
+#region ======================== SPATIAL INDEX ========================
+
+# Índice espacial de las posiciones procesadas, para consultar por zona (cercado), fechas y collares
+# sin leer todos los archivos agrupados
+#
+# The points are split in a grid of cells of cell_size degrees, ordered by cell and sent_time.
+# Each column is saved as a binary array (memory mapped when queried): a query only reads
+# the rows of the cells inside its area, and inside each cell only the rows of its time range.
+#
+#   spatial_index/
+#     index.json        cell_size, rows, type (and categories) of each column
+#     cells.npy         key of each cell with points, sorted
+#     offsets.npy       first row of each cell (+ the total rows at the end)
+#     <column>.bin      values of the column (categories as int16 codes, datetimes as int64 ns)
+
+spatial_index_dir = 'spatial_index'
+
+BBox = tuple[float, float, float, float]  # (min_lon, min_lat, max_lon, max_lat)
+
+
+def cell_keys(lat: np.ndarray, lon: np.ndarray, cell_size: float) -> np.ndarray:
+  """Key of the cell of each point: row (lat) * cells per row + column (lon)."""
+  lon_cells = int(np.ceil(360 / cell_size))
+  rows = np.floor((np.asarray(lat, dtype=float) + 90) / cell_size).astype(np.int64)
+  columns = np.floor((np.asarray(lon, dtype=float) + 180) / cell_size).astype(np.int64)
+  return rows * lon_cells + columns
+
+
+def polygon_points(polygon) -> np.ndarray:
+  """(lon, lat) vertices of a polygon given as a list of points or a shapely Polygon (its exterior)."""
+  if hasattr(polygon, 'exterior'):
+    polygon = polygon.exterior.coords
+  return np.asarray(polygon, dtype=float)
+
+
+def points_in_polygon(lon: np.ndarray, lat: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+  """Mask of the points inside the polygon (even-odd rule), one pass over the points per edge."""
+  inside = np.zeros(len(lon), dtype=bool)
+  x1, y1 = vertices[-1]
+  for x2, y2 in vertices:
+    crosses = (y1 > lat) != (y2 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      x_cross = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+    inside ^= crosses & (lon < x_cross)
+    x1, y1 = x2, y2
+  return inside
+
+
+class SpatialIndexWriter:
+  """
+  Writes a spatial index appending the points in order of cell (and of sent_time inside each cell).
+  The data can be appended at once (build_spatial_index) or cell by cell, like in stream mode.
+
+  Written to a temp folder that replaces the old index on close(), the index is either complete or the old one.
+  """
+
+  def __init__(self, root_path: str, cell_size: float):
+    self.root_path = root_path
+    self.tmp_path = os.path.join(os.path.dirname(root_path), f'.tmp.{os.path.basename(root_path)}')
+    self.cell_size = cell_size
+
+    self.columns: dict[str, dict] = {}  # column -> {'dtype', 'categories'}
+    self.files = {}
+    self.cells: list[np.ndarray] = []
+    self.offsets: list[np.ndarray] = []
+    self.rows = 0
+    self.last_key = None
+
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+    os.makedirs(self.tmp_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.discard()
+
+  def append(self, df: pd.DataFrame):
+    """Append points sorted by cell and sent_time, with cells after the ones already appended."""
+    if len(df) == 0:
+      return
+
+    keys = cell_keys(df['lat'].to_numpy(), df['lon'].to_numpy(), self.cell_size)
+    if (keys[1:] < keys[:-1]).any() or (self.last_key is not None and keys[0] < self.last_key):
+      raise ValueError("The points are not sorted by cell")
+
+    # Start of each cell (a cell continues if it's the last one appended)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if self.last_key == keys[0]:
+      starts = starts[1:]
+    self.cells.append(keys[starts])
+    self.offsets.append(starts + self.rows)
+    self.last_key = keys[-1]
+
+    for column in df.columns:
+      self.write_column(column, df[column])
+    self.rows += len(df)
+
+  def write_column(self, column: str, values: pd.Series):
+    if column not in self.columns:
+      if self.rows > 0:
+        raise ValueError(f"Column {column} not in the first points appended")
+      self.columns[column] = self.column_type(values)
+      self.files[column] = open(os.path.join(self.tmp_path, f'{column}.bin'), 'wb')
+
+    column_type = self.columns[column]
+    if column_type['categories'] is not None:
+      # Same codes in every append: new categories are added at the end
+      categories = column_type['categories']
+      new_categories = [category for category in values.cat.categories if category not in categories]
+      categories += new_categories
+      array = pd.Categorical(values, categories=categories).codes.astype(np.int16)
+    else:
+      array = values.to_numpy().astype(column_type['dtype'], copy=False)
+
+    self.files[column].write(np.ascontiguousarray(array).tobytes())
+
+  @staticmethod
+  def column_type(values: pd.Series) -> dict:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+      return {'dtype': 'int16', 'categories': values.cat.categories.tolist()}
+    if not isinstance(values.dtype, np.dtype) or values.dtype.kind not in 'biufM':
+      raise ValueError(f"Column {values.name} of type {values.dtype} can't be indexed")
+    return {'dtype': values.dtype.str, 'categories': None}
+
+  def close(self):
+    for file in self.files.values():
+      file.close()
+
+    cells = np.concatenate(self.cells) if self.cells else np.array([], dtype=np.int64)
+    offsets = np.concatenate(self.offsets + [np.array([self.rows])]).astype(np.int64)
+    np.save(os.path.join(self.tmp_path, 'cells.npy'), cells)
+    np.save(os.path.join(self.tmp_path, 'offsets.npy'), offsets)
+
+    with open(os.path.join(self.tmp_path, 'index.json'), 'w') as f:
+      json.dump({'cell_size': self.cell_size, 'rows': self.rows, 'columns': self.columns}, f, indent=2)
+
+    shutil.rmtree(self.root_path, ignore_errors=True)
+    os.replace(self.tmp_path, self.root_path)
+
+  def discard(self):
+    for file in self.files.values():
+      file.close()
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def sort_by_cell(df: pd.DataFrame, cell_size: float) -> pd.DataFrame:
+  """Points sorted by cell and sent_time (stable, rows with the same cell and time keep their order)."""
+  keys = cell_keys(df['lat'].to_numpy(), df['lon'].to_numpy(), cell_size)
+  times = df['sent_time'].to_numpy().view(np.int64)
+  return df.iloc[np.lexsort((times, keys))]
+
+
+def build_spatial_index(df: pd.DataFrame, root_path: str, cell_size: float):
+  """Spatial index of the points of df (without null positions) in root_path."""
+  df = df.dropna(subset=['lat', 'lon', 'sent_time'])
+  with SpatialIndexWriter(root_path, cell_size) as writer:
+    writer.append(sort_by_cell(df, cell_size))
+
+
+class SpatialIndex:
+  """
+  Query the points of a spatial index by area (bbox or polygon), time range and devices.
+
+    index = SpatialIndex('./data/out/spatial_index')
+    df = index.query((-2.70, 38.37, -2.68, 38.39), ('2024-09-01', '2024-09-08'), [229175])
+  """
+
+  def __init__(self, root_path: str):
+    self.root_path = root_path
+    with open(os.path.join(root_path, 'index.json')) as f:
+      meta = json.load(f)
+
+    self.cell_size: float = meta['cell_size']
+    self.rows: int = meta['rows']
+    self.columns: dict[str, dict] = meta['columns']
+    self.cells = np.load(os.path.join(root_path, 'cells.npy'))
+    self.offsets = np.load(os.path.join(root_path, 'offsets.npy'))
+    self.arrays = {column: self.load_column(column) for column in self.columns}
+
+  def load_column(self, column: str) -> np.ndarray:
+    if self.rows == 0:
+      return np.array([], dtype=self.columns[column]['dtype'])
+    return np.memmap(os.path.join(self.root_path, f'{column}.bin'), dtype=self.columns[column]['dtype'], mode='r', shape=(self.rows,))
+
+  def query(self, area: BBox | Sequence | None = None, time_range: tuple | None = None, device_ids: Iterable | None = None) -> pd.DataFrame:
+    """
+    Points inside area, with sent_time in time_range and of device_ids. None to not filter by it.
+
+    area: bbox (min_lon, min_lat, max_lon, max_lat) or polygon: list of (lon, lat) or shapely Polygon.
+    time_range: (start, end) dates, start included and end excluded. Any of them can be None.
+
+    Returns the points sorted by device_id and sent_time.
+    """
+    vertices = None
+    if area is not None and len(area) == 4 and np.isscalar(area[0]):
+      bbox = tuple(float(value) for value in area)
+    elif area is not None:
+      vertices = polygon_points(area)
+      bbox = (*vertices.min(axis=0), *vertices.max(axis=0))
+    else:
+      bbox = None
+
+    positions = self.positions(bbox, time_range)
+
+    df = pd.DataFrame({column: self.column_values(column, positions) for column in self.columns})
+
+    # Only the points of the cells in the border can be outside the area
+    mask = np.ones(len(df), dtype=bool)
+    if bbox is not None:
+      lon, lat = df['lon'].to_numpy(), df['lat'].to_numpy()
+      mask &= (bbox[0] <= lon) & (lon <= bbox[2]) & (bbox[1] <= lat) & (lat <= bbox[3])
+      if vertices is not None:
+        mask[mask] = points_in_polygon(lon[mask], lat[mask], vertices)
+    if device_ids is not None:
+      mask &= df['device_id'].isin(list(device_ids)).to_numpy()
+
+    df = df[mask].reset_index(drop=True)
+    return sort_by(df, ['device_id', 'sent_time'], ['asc', 'asc']).reset_index(drop=True)
+
+  def cell_ranges(self, bbox: BBox | None) -> list[tuple[int, int]]:
+    """Ranges [first, last) of the cells with points inside bbox, one per row of cells."""
+    if bbox is None:
+      return [(0, len(self.cells))]
+
+    lon_cells = int(np.ceil(360 / self.cell_size))
+    min_key, max_key = cell_keys([bbox[1], bbox[3]], [bbox[0], bbox[2]], self.cell_size)
+    min_row, min_column = divmod(int(min_key), lon_cells)
+    max_row, max_column = divmod(int(max_key), lon_cells)
+
+    ranges = []
+    for row in range(min_row, max_row + 1):
+      first, last = np.searchsorted(self.cells, [row * lon_cells + min_column, row * lon_cells + max_column + 1])
+      if first < last:
+        ranges.append((int(first), int(last)))
+    return ranges
+
+  def positions(self, bbox: BBox | None, time_range: tuple | None) -> np.ndarray:
+    """Rows of the cells inside bbox, only the ones in time_range of each cell."""
+    if time_range is None:
+      slices = [(self.offsets[first], self.offsets[last]) for first, last in self.cell_ranges(bbox)]
+    else:
+      start = np.iinfo(np.int64).min if time_range[0] is None else pd.Timestamp(time_range[0]).value
+      end = np.iinfo(np.int64).max if time_range[1] is None else pd.Timestamp(time_range[1]).value
+      times = self.arrays['sent_time'].view(np.int64)
+
+      slices = []
+      for first, last in self.cell_ranges(bbox):
+        for cell in range(first, last):
+          cell_start, cell_end = self.offsets[cell], self.offsets[cell + 1]
+          cell_times = times[cell_start:cell_end]
+          slices.append((cell_start + np.searchsorted(cell_times, start), cell_start + np.searchsorted(cell_times, end)))
+
+    slices = [(first, last) for first, last in slices if first < last]
+    if not slices:
+      return np.array([], dtype=np.int64)
+    return np.concatenate([np.arange(first, last) for first, last in slices])
+
+  def column_values(self, column: str, positions: np.ndarray):
+    values = np.asarray(self.arrays[column][positions])
+    categories = self.columns[column]['categories']
+    if categories is not None:
+      return pd.Categorical.from_codes(values, categories=categories)
+    return values
+
+
+def query_positions(out_root: str, area=None, time_range=None, device_ids=None) -> pd.DataFrame:
+  """SpatialIndex(out_root/spatial_index).query(...)"""
+  return SpatialIndex(os.path.join(out_root, spatial_index_dir)).query(area, time_range, device_ids)
+
+#endregion
@@ -0,0 +1,193 @@
+import os, json
+import numpy as np
+import pandas as pd
+from typing import Iterable, Iterator
+from utils.file_manager import get_file_format, write_batches, read_csv_ranges, pa, pa_parquet
+
+#region ======================== TIME INDEX ========================
+
+# Índice por sent_time y collar del archivo merged, para extraer una ventana de tiempo
+# leyendo solo los bloques necesarios (rangos de bytes en CSV, row groups en parquet, record batches en feather)
+#
+# The merged file is written in blocks of block_rows rows. For each block the index keeps
+# its first row, its rows, the min/max device_id and sent_time and its location in the file.
+# Saved next to the merged file: merged_data.csv -> merged_data.index.json
+
+def time_index_path(file_path) -> str:
+  return os.path.splitext(file_path)[0] + '.index.json'
+
+
+def rebatch(batches: Iterable[pd.DataFrame], batch_rows: int) -> Iterator[pd.DataFrame]:
+  """Same rows in batches of exactly batch_rows rows (the last one can be smaller)."""
+  pending = []
+  pending_rows = 0
+  for batch in batches:
+    pending.append(batch)
+    pending_rows += len(batch)
+    if pending_rows < batch_rows:
+      continue
+
+    df = concat_batches(pending)
+    for start in range(0, len(df) - batch_rows + 1, batch_rows):
+      yield df.iloc[start:start + batch_rows]
+    rest = df.iloc[len(df) - len(df) % batch_rows:]
+    pending, pending_rows = [rest], len(rest)
+
+  if pending_rows > 0:
+    yield concat_batches(pending)
+
+
+def concat_batches(batches: list[pd.DataFrame]) -> pd.DataFrame:
+  """pd.concat, keeping as categories the columns that pd.concat gives as objects (batches with different categories)."""
+  if len(batches) == 1:
+    return batches[0]
+  df = pd.concat(batches)
+  for column, dtype in batches[0].dtypes.items():
+    if isinstance(dtype, pd.CategoricalDtype) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+      df[column] = df[column].astype('category')
+  return df
+
+
+def value_range(values: pd.Series) -> tuple:
+  """(min, max) of the values as JSON numbers, None if all are null."""
+  values = values.dropna()
+  if len(values) == 0:
+    return None, None
+  if pd.api.types.is_datetime64_any_dtype(values.dtype):
+    return int(values.min().value), int(values.max().value)
+  return float(values.min()), float(values.max())
+
+
+def write_time_indexed(batches: Iterable[pd.DataFrame], file_path, block_rows: int) -> int:
+  """
+  write_batches of the sorted batches in blocks of block_rows rows, and their TimeIndex.
+  Returns the number of rows written.
+  """
+  blocks = {column: [] for column in ['first_row', 'rows', 'min_device', 'max_device', 'min_time', 'max_time']}
+  locations = []
+
+  def indexed_blocks():
+    first_row = 0
+    for block in rebatch(batches, block_rows):
+      min_device, max_device = value_range(block['device_id'])
+      min_time, max_time = value_range(block['sent_time'])
+      for column, value in zip(blocks, [first_row, len(block), min_device, max_device, min_time, max_time]):
+        blocks[column].append(value)
+      first_row += len(block)
+      yield block
+
+  index_path = time_index_path(file_path)
+  if os.path.exists(index_path):
+    os.remove(index_path)
+
+  rows = write_batches(indexed_blocks(), file_path, locations)
+  if rows == 0:
+    return rows
+
+  stat = os.stat(file_path)
+  blocks['start'] = [start for start, _ in locations]
+  blocks['end'] = [end for _, end in locations]
+  index = {
+    'file': os.path.basename(file_path),
+    'format': get_file_format(file_path),
+    'size': stat.st_size,
+    'mtime_ns': stat.st_mtime_ns,
+    'rows': rows,
+    'block_rows': block_rows,
+    'blocks': blocks,
+  }
+  with open(index_path, 'w') as f:
+    json.dump(index, f)
+  return rows
+
+
+class TimeIndex:
+  """
+  Extract rows of a file written with write_time_indexed by time range and devices,
+  reading only the blocks that can have them.
+
+    index = TimeIndex('./data/out/merged/merged_data.csv')
+    df = index.extract('2024-09-01 10:00', '2024-09-01 12:00', [229175])
+  """
+
+  def __init__(self, file_path):
+    self.file_path = file_path
+    with open(time_index_path(file_path)) as f:
+      index = json.load(f)
+
+    stat = os.stat(file_path)
+    if (stat.st_size, stat.st_mtime_ns) != (index['size'], index['mtime_ns']):
+      raise ValueError(f"The time index of {file_path} is outdated, the file changed after it was written")
+
+    self.file_format: str = index['format']
+    self.rows: int = index['rows']
+    # Blocks without dates never overlap a time range
+    blocks = index['blocks']
+    int64 = np.iinfo(np.int64)
+    blocks['min_time'] = [int64.max if time is None else time for time in blocks['min_time']]
+    blocks['max_time'] = [int64.min if time is None else time for time in blocks['max_time']]
+    self.blocks = pd.DataFrame(blocks).astype({'min_time': np.int64, 'max_time': np.int64, 'min_device': float, 'max_device': float})
+
+  def select_blocks(self, start=None, end=None, device_ids: Iterable | None = None) -> pd.DataFrame:
+    """Blocks that can have rows with sent_time in [start, end) of device_ids."""
+    blocks = self.blocks
+    mask = np.ones(len(blocks), dtype=bool)
+
+    if start is not None:
+      mask &= (blocks['max_time'] >= pd.Timestamp(start).value).to_numpy()
+    if end is not None:
+      mask &= (blocks['min_time'] < pd.Timestamp(end).value).to_numpy()
+
+    if device_ids is not None:
+      device_ids = np.asarray(list(device_ids), dtype=float)
+      min_device, max_device = blocks['min_device'].to_numpy(), blocks['max_device'].to_numpy()
+      mask &= ((min_device[:, None] <= device_ids) & (device_ids <= max_device[:, None])).any(axis=1)
+
+    return blocks[mask]
+
+  def read_blocks(self, blocks: pd.DataFrame) -> pd.DataFrame:
+    """Rows of the blocks, in order."""
+    ranges = merge_ranges(blocks['start'].to_numpy(), blocks['end'].to_numpy())
+
+    if self.file_format == 'csv':
+      return read_csv_ranges(self.file_path, ranges)
+
+    parts = [part for start, end in ranges for part in range(start, end)]
+    if self.file_format == 'parquet':
+      parquet_file = pa_parquet.ParquetFile(self.file_path)
+      if not parts:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+      return parquet_file.read_row_groups(parts).to_pandas()
+
+    with pa.memory_map(self.file_path) as source:
+      reader = pa.ipc.open_file(source)
+      if not parts:
+        return reader.schema.empty_table().to_pandas()
+      return pa.Table.from_batches([reader.get_batch(part) for part in parts]).to_pandas()
+
+  def extract(self, start=None, end=None, device_ids: Iterable | None = None) -> pd.DataFrame:
+    """Rows with sent_time in [start, end) (None to not limit it) of device_ids (None for all), in the order of the file."""
+    device_ids = list(device_ids) if device_ids is not None else None
+    df = self.read_blocks(self.select_blocks(start, end, device_ids))
+
+    mask = np.ones(len(df), dtype=bool)
+    if start is not None:
+      mask &= (df['sent_time'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+      mask &= (df['sent_time'] < pd.Timestamp(end)).to_numpy()
+    if device_ids is not None:
+      mask &= df['device_id'].isin(device_ids).to_numpy()
+    return df[mask].reset_index(drop=True)
+
+
+def merge_ranges(starts: np.ndarray, ends: np.ndarray) -> list[tuple[int, int]]:
+  """Contiguous ranges joined, to read them at once."""
+  ranges = []
+  for start, end in zip(starts.tolist(), ends.tolist()):
+    if ranges and ranges[-1][1] == start:
+      ranges[-1] = (ranges[-1][0], end)
+    else:
+      ranges.append((start, end))
+  return ranges
+
+#endregion
@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from utils.file_writer import format_dates
+from utils.utils import print_colorized
+from data_operations.group_by import get_group_by_func
+from data_operations.creation import haversine_distance, earth_radius_m
+from data_operations.geo_export import geo_dir_name, geo_formats, crs, shapefile_columns, write_geo_atomic, pa
+
+#region ======================== TRAJECTORIES ========================
+
+# Trayectorias para QGIS: una línea por collar (device_id) y por día u hora, en vez de un punto por fix
+#
+# Built at once from the rows with position sorted by device_id and sent_time:
+#   - a line starts where the device or the bucket (the value of group by day/hour of sent_time) changes
+#   - Douglas-Peucker simplification of all the lines at once, with a tolerance in meters
+#   - measures: the sent_time of each vertex (seconds since 1970) as M (LineStringM)
+# Attributes: device_id, bucket, start_time, end_time (for the Temporal Controller of QGIS), fixes, vertices, distance (m)
+#
+# The M values are written by pyogrio through Arrow (WKB with M, the layer keeps its spatial index), only in the GeoPackage,
+# in a layer declared as LineStringM.
+# The shapefile has XY lines.
+
+trajectory_buckets = ['hour', 'day', 'month', 'year']
+
+
+def trajectories_name(bucket: str) -> str:
+  return f'trajectories by {bucket}'
+
+
+def trajectory_lines(df: pd.DataFrame, bucket: str = 'day', tolerance_m: float = 0, measures: bool = True) -> gpd.GeoDataFrame:
+  """
+  A line for each device and bucket of df, sorted by device_id and start_time.
+  The fixes of a device in a bucket are the vertices, simplified with Douglas-Peucker if tolerance_m > 0.
+  Buckets with a single fix have no line.
+  """
+  positions = df.dropna(subset=['device_id', 'sent_time', 'lat', 'lon'])
+  positions = positions.sort_values(['device_id', 'sent_time'], kind='stable')
+
+  group_by = get_group_by_func(bucket)
+  keys = group_by.keys(positions).to_numpy()
+  devices = positions['device_id'].to_numpy()
+  times = positions['sent_time'].to_numpy()
+  lat = np.radians(positions['lat'].to_numpy(dtype=float))
+  lon = np.radians(positions['lon'].to_numpy(dtype=float))
+
+  # A line for each run of rows with the same device and bucket, if it has 2 fixes or more
+  new_line = np.ones(len(positions), dtype=bool)
+  new_line[1:] = (devices[1:] != devices[:-1]) | (keys[1:] != keys[:-1])
+  starts = np.flatnonzero(new_line)
+  counts = np.diff(np.append(starts, len(positions)))
+  line_starts = np.repeat(starts, counts)
+  in_line = np.repeat(counts > 1, counts)
+  starts, ends = starts[counts > 1], (starts + counts - 1)[counts > 1]
+
+  # Distance of each step inside a line (all the fixes, not only the vertices)
+  steps = haversine_distance(lat[:-1], lon[:-1], lat[1:], lon[1:])
+  steps[new_line[1:]] = 0
+  cumulative = np.concatenate([[0], np.cumsum(steps)])
+
+  if tolerance_m > 0:
+    # Meters from the start of each line (equirectangular, enough for the distance to a segment)
+    x = earth_radius_m * (lon - lon[line_starts]) * np.cos(lat[line_starts])
+    y = earth_radius_m * (lat - lat[line_starts])
+    keep = simplify_mask(x, y, starts, ends, tolerance_m)
+  else:
+    keep = in_line
+
+  vertex_rows = np.flatnonzero(keep)
+  vertex_lines = np.searchsorted(starts, vertex_rows, side='right') - 1
+  vertices = np.bincount(vertex_lines, minlength=len(starts))
+
+  lines = pd.DataFrame({
+    'device_id': devices[starts],
+    'bucket': pd.Series(keys[starts]).dt.strftime(group_by.value_format).to_numpy(),
+    'start_time': times[starts],
+    'end_time': times[ends],
+    'fixes': ends - starts + 1,
+    'vertices': vertices,
+    'distance': cumulative[ends] - cumulative[starts],
+  })
+
+  if measures and not hasattr(shapely, 'has_m'):
+    print_colorized('The M values of the trajectories need shapely 2.1 or newer, saving them without measures', 'yellow')
+    measures = False
+
+  xy = np.column_stack([np.degrees(lon[vertex_rows]), np.degrees(lat[vertex_rows])])
+  if measures:
+    seconds = times[vertex_rows].astype('datetime64[ns]').astype(np.int64) / 1e9
+    geometry = linestrings_m(np.column_stack([xy, seconds]), vertex_lines)
+  else:
+    geometry = shapely.linestrings(xy, indices=vertex_lines) if len(starts) else np.array([], dtype=object)
+
+  lines = gpd.GeoDataFrame(lines, geometry=gpd.GeoSeries(geometry, crs=crs))
+  return lines.sort_values(['device_id', 'start_time'], kind='stable', ignore_index=True)
+
+
+def simplify_mask(x: np.ndarray, y: np.ndarray, starts: np.ndarray, ends: np.ndarray, tolerance: float) -> np.ndarray:
+  """
+  Douglas-Peucker of every line (rows starts[i]..ends[i] of x, y) at once: True for the vertices kept.
+  Each iteration splits every range whose farthest interior point is farther than tolerance from its segment
+  (the first farthest point, like GEOS). The first and last point of each line are always kept.
+  """
+  keep = np.zeros(len(x), dtype=bool)
+  keep[starts] = keep[ends] = True
+  range_starts, range_ends = starts, ends
+
+  while True:
+    interior = range_ends - range_starts - 1
+    active = interior > 0
+    range_starts, range_ends, interior = range_starts[active], range_ends[active], interior[active]
+    if len(range_starts) == 0:
+      return keep
+
+    # Interior points of each range
+    offsets = np.cumsum(interior) - interior
+    points = np.repeat(range_starts + 1 - offsets, interior) + np.arange(interior.sum())
+    ax, ay = np.repeat(x[range_starts], interior), np.repeat(y[range_starts], interior)
+    dx, dy = np.repeat(x[range_ends], interior) - ax, np.repeat(y[range_ends], interior) - ay
+
+    # Distance to the segment (to its start if the segment has length 0)
+    length2 = dx * dx + dy * dy
+    t = np.divide((x[points] - ax) * dx + (y[points] - ay) * dy, length2, out=np.zeros_like(length2), where=length2 > 0)
+    t = np.clip(t, 0, 1)
+    distances = np.hypot(x[points] - ax - t * dx, y[points] - ay - t * dy)
+
+    max_distances = np.maximum.reduceat(distances, offsets)
+    farthest = np.flatnonzero(distances == np.repeat(max_distances, interior))
+    range_ids = np.repeat(np.arange(len(range_starts)), interior)[farthest]
+    farthest = points[farthest[np.unique(range_ids, return_index=True)[1]]]
+
+    split = max_distances > tolerance
+    farthest = farthest[split]
+    keep[farthest] = True
+    range_starts, range_ends = np.concatenate([range_starts[split], farthest]), np.concatenate([farthest, range_ends[split]])
+
+
+def linestrings_m(coords: np.ndarray, indices: np.ndarray) -> np.ndarray:
+  """
+  LineStringM geometries of the x, y, m coords, indices like shapely.linestrings (sorted, 0 to the number of lines - 1).
+  shapely.linestrings only builds XY and XYZ: the lines are written as ISO WKB (little endian, type 2002) and read by shapely.from_wkb.
+  """
+  if len(coords) == 0:
+    return np.array([], dtype=object)
+  counts = np.bincount(indices)
+  ends = np.cumsum(9 + 24 * counts)
+  starts = ends - (9 + 24 * counts)
+
+  # Header of each line: byte order, geometry type and number of points, then its points
+  wkb = np.empty(ends[-1], dtype=np.uint8)
+  header = (starts[:, None] + np.arange(9)).ravel()
+  wkb[header] = np.column_stack([
+    np.ones((len(counts), 1), dtype=np.uint8),
+    np.full(len(counts), 2002, dtype='<u4').view(np.uint8).reshape(-1, 4),
+    counts.astype('<u4').view(np.uint8).reshape(-1, 4),
+  ]).ravel()
+  points = np.ones(len(wkb), dtype=bool)
+  points[header] = False
+  wkb[points] = np.ascontiguousarray(coords, dtype='<f8').view(np.uint8).ravel()
+
+  return shapely.from_wkb(np.array([wkb[start:end].tobytes() for start, end in zip(starts, ends)], dtype=object))
+
+
+def trajectory_frame(lines: gpd.GeoDataFrame, file_format: str = 'gpkg', measures: bool = True) -> gpd.GeoDataFrame:
+  """lines in the file_format. Only the GeoPackage keeps the M values (with measures), the other formats have XY lines."""
+  layer = lines
+  if file_format != 'gpkg' or not measures:
+    layer = lines.set_geometry(shapely.force_2d(lines.geometry.to_numpy()), crs=crs)
+  if file_format == 'shp':
+    layer = gpd.GeoDataFrame(format_dates(layer).rename(columns=lambda column: shapefile_columns.get(column, column[:10])), geometry='geometry')
+  return layer
+
+
+def write_trajectories(lines: gpd.GeoDataFrame, root_path: str, bucket: str, formats: list[str]) -> list[str]:
+  """Save the lines in root_path/geo/trajectories by <bucket> in each format. Returns the paths."""
+  name = trajectories_name(bucket)
+  measures = len(lines) > 0 and hasattr(shapely, 'has_m') and bool(shapely.has_m(lines.geometry.to_numpy()).any())
+  if measures and pa is None:
+    print_colorized('pyogrio writes the M values of the trajectories through Arrow, saving them without measures (install pyarrow)', 'yellow')
+    measures = False
+  file_paths = []
+
+  for file_format in formats:
+    if file_format not in geo_formats:
+      print_colorized(f"Unknown trajectories format '{file_format}', available: {list(geo_formats)}", 'red')
+      continue
+    file_path = os.path.join(root_path, geo_dir_name, name + geo_formats[file_format][1])
+
+    # The layer is declared as LineStringM (m = 1 in gpkg_geometry_columns), pyogrio would infer LineString
+    options = {'geometry_type': 'Measured LineString'} if file_format == 'gpkg' and measures else {}
+    write_geo_atomic(trajectory_frame(lines, file_format, measures), file_path, **options)
+    file_paths.append(file_path)
+
+  return file_paths
+
+
+def save_trajectories(lines: gpd.GeoDataFrame, root_path: str, bucket: str, formats: list[str]) -> list[str]:
+  """write_trajectories and show what was saved."""
+  file_paths = write_trajectories(lines, root_path, bucket, formats)
+  report_trajectories(lines, file_paths)
+  return file_paths
+
+
+def report_trajectories(lines: gpd.GeoDataFrame, file_paths: list[str]):
+  fixes, vertices = int(lines['fixes'].sum()), int(lines['vertices'].sum())
+  print_colorized(f"{len(lines)} trajectories ({fixes} fixes, {vertices} vertices) saved in {', '.join(file_paths)}", 'green')
+
+#endregion
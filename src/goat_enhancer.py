@@ -1,4 +1,4 @@
-import random
+import random, zlib
 
 class Goat_Factory:
   
@@ -41,6 +41,10 @@ def get_goat_name(index = -1) -> str:
   fabrica.count = (fabrica.count + 1) % len(fabrica.nombres)
   return nombre
 
+def get_goat_name_for(key: str) -> str:
+  # Siempre el mismo nombre para la misma clave (el device_id de un collar), en cualquier ejecución
+  return fabrica.nombres[zlib.crc32(key.encode()) % len(fabrica.nombres)]
+
 
 if __name__ == '__main__':
   goats = []
@@ -0,0 +1,740 @@
+import os, shutil
+from collections import Counter
+from contextlib import nullcontext
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from utils.file_writer import ParallelFileWriter, format_dates
+from utils.file_manager import get_files_by_extension, get_file_paths_by_extension, print_files, read_csv, read_csv_chunks, read_csv_python, write_csv, write_batches, remove_path, file_formats, with_file_format, csv_read_errors
+from utils.utils import print_colorized
+from utils.config import Config, Settings
+from utils.cache import DataFrameCache
+from utils.metrics import pipeline_metrics
+
+from data_operations.refactor import refactor, refactor_version, add_end_date, show_unknown_enum_found, prepare_data_file, prepare_data_file_worker, unknown_enum_found, read_refactored, refactor_cache_key, forget_time_formats, time_parse_stats, show_time_parse_stats
+from data_operations.merge import merge, merge_sorted_files, split_runs, RunSplitter
+from data_operations.group_by import group_by_to_files, get_group_by_func, group_dir_name, build_group_file_name, GroupData, GroupFrames
+from data_operations.partition import PartitionStore, SortedPartition
+from data_operations.incremental import Manifest, hash_files
+from data_operations.sort import sort_by
+from data_operations.creation import add_trajectory_metrics, add_end_date_chunks, add_trajectory_metrics_chunks, device_keys
+from data_operations.schema import apply_schema, memory_report, show_memory_report
+from data_operations.filters import drop_invalid_positions, drop_duplicate_fixes, filter_fixes_by_file, FileFilterStream, filter_stats, show_filter_stats
+from data_operations.spatial_index import build_spatial_index, SpatialIndexWriter, cell_keys, spatial_index_dir
+from data_operations.time_index import TimeIndex, write_time_indexed
+
+# Etapas del pipeline. Importarlo no lee la configuración ni escribe nada:
+# cada script recibe los Settings (Config.settings()) y prepara sus carpetas y la cache al empezar
+#
+#   from utils.config import Config
+#   from pipeline import run_all
+#   run_all(Config.settings())
+
+#region ========================= SETUP =========================
+
+def setup(settings: Settings) -> DataFrameCache | None:
+  """
+  Checks the output_format, creates the data folders and returns the cache of the refactored input files
+  (None with --no-cache).
+  """
+  # Formato de los archivos de salida: csv, parquet o feather
+  if settings.output_format not in file_formats:
+    print_colorized(f"Unknown output_format '{settings.output_format}' in {Config.settings_file}, using csv. Available: {list(file_formats)}", 'red')
+    settings.output_format = 'csv'
+
+  os.makedirs(settings.in_data_root, exist_ok=True)
+  os.makedirs(settings.out_data_root, exist_ok=True)
+  os.makedirs(os.path.dirname(merged_file_path(settings)), exist_ok=True)
+
+  print_colorized(f"Using {settings.in_data_root} as input data root", 'blue')
+
+  refactor_cache = DataFrameCache(settings.cache_path, settings.cache_max_bytes)
+  if Config.clear_cache:
+    print_colorized(f"Clearing the cache {refactor_cache.root_path}", 'yellow')
+    refactor_cache.clear()
+  return refactor_cache if Config.use_cache else None
+
+
+def merged_file_path(settings: Settings) -> str:
+  return with_file_format(os.path.join(settings.out_data_root, settings.merged_data_subpath), settings.output_format)
+
+
+def spatial_index_path(settings: Settings) -> str:
+  return os.path.join(settings.out_data_root, spatial_index_dir)
+
+#endregion ======================================================
+
+
+#region ========================= MAIN =========================
+
+@pipeline_metrics.instrumented('run-all')
+def run_all(settings: Settings):
+  refactor_cache = setup(settings)
+
+  if Config.test_mode:
+    print()
+    print_colorized('==================== Running in test mode ====================', 'blue')
+    print()
+
+  if Config.stream_mode:
+    return run_stream(settings)
+
+  in_file_paths = get_file_paths_by_extension(settings.in_data_root)
+
+  print_files([os.path.basename(file) for file in in_file_paths])
+  print()
+
+  # Only new or changed inputs since the last run are prepared again
+  # Data prepared with other config files or another version of the refactor (fixes, schema) is not valid
+  manifest = Manifest(settings.out_data_root, f'{hash_files(Config.config_file_paths())}_{refactor_version(settings)}', refactor_cache)
+  if Config.full_rebuild:
+    manifest.clear()
+
+  changed_file_paths = manifest.update_inputs(in_file_paths)
+
+  # Loaded before saving the new ones, that can evict them from the cache. The ones not in the cache anymore are prepared again
+  unchanged = {file_path: manifest.load_prepared(file_path) for file_path in in_file_paths if file_path not in changed_file_paths}
+  changed_file_paths = [file_path for file_path in in_file_paths if not manifest.is_prepared_input(file_path)]
+  print_colorized(f"{len(in_file_paths) - len(changed_file_paths)} files didn't change since the last run, {len(changed_file_paths)} new or changed files", 'blue')
+
+  # Read and clean/refactor each file
+  with pipeline_metrics.stage('prepare files') as stage:
+    if Config.workers > 1:
+      prepared = prepare_files_parallel(changed_file_paths, Config.workers, settings, refactor_cache)
+    else:
+      prepared = prepare_files(changed_file_paths, settings, refactor_cache)
+    stage.rows_out = sum(len(df) for df in prepared if df is not None)
+
+  with pipeline_metrics.stage('incremental') as stage:
+    prepared = dict(zip(changed_file_paths, prepared))
+    for file_path, df in prepared.items():
+      manifest.save_prepared(file_path, df)
+
+    # Same order of files as a full run
+    dfs = [prepared[file_path] if file_path in prepared else unchanged[file_path] for file_path in in_file_paths]
+    dfs = [df for df in dfs if df is not None]
+    stage.rows_out = sum(len(df) for df in dfs)
+  file_count = len(dfs)
+  memory_report('prepared files', *dfs)
+
+  print()
+  print_colorized(f"Merging {file_count} files into 1...", 'cyan')
+
+  # Merge all files
+  # The files are not needed anymore, only the merged data is kept in memory
+  with pipeline_metrics.stage('merge', rows_in=sum(len(df) for df in dfs)) as stage:
+    df = merge(dfs, settings)
+    del prepared, dfs
+    stage.rows_out = len(df)
+  memory_report('merged', df)
+
+  with pipeline_metrics.stage('sort_by', rows_in=len(df)) as stage:
+    df = sort_by(df, settings.sort_by_columns, settings.sort_by_orders)
+    stage.rows_out = len(df)
+
+  # The same fix in several files (each file is already filtered)
+  with pipeline_metrics.stage('filters', rows_in=len(df)) as stage:
+    df = drop_duplicate_fixes(df, settings, 'duplicate_between_files')
+    stage.rows_out = len(df)
+
+  # The index of the files is not used anymore (8 bytes per row less)
+  df.index = pd.RangeIndex(len(df))
+  with pipeline_metrics.stage('add_end_date', rows_in=len(df)) as stage:
+    df = add_end_date(df)
+    if settings.transformations.get('add_trajectory_metrics', False):
+      df = add_trajectory_metrics(df)
+    stage.rows_out = len(df)
+  memory_report('sorted with end_date', df)
+
+  if settings.time_index_enabled:
+    with pipeline_metrics.stage('write merged', rows_in=len(df)) as stage:
+      stage.rows_out = write_merged([df], settings)
+  print_colorized(f"\nMerged {file_count} files into 1:\t{merged_file_path(settings)}\n", 'green')
+
+  with pipeline_metrics.stage('group_by', rows_in=len(df)):
+    groups = group_by(df, settings, manifest.partitions)
+    manifest.save()
+
+  if settings.geo_export_enabled:
+    with pipeline_metrics.stage('geo export', rows_in=len(df)):
+      geo_export(df, settings, groups)
+
+  if settings.trajectories_enabled:
+    with pipeline_metrics.stage('trajectories', rows_in=len(df)) as stage:
+      lines = build_trajectories(df, settings)
+      save_trajectories(lines, settings)
+      stage.rows_out = len(lines)
+
+  if settings.spatial_index_enabled:
+    with pipeline_metrics.stage('spatial index', rows_in=len(df)):
+      build_spatial_index(df, spatial_index_path(settings), settings.spatial_index_cell_size)
+    print_colorized(f"Spatial index saved in {spatial_index_path(settings)}", 'green')
+
+  show_time_parse_stats()
+  show_filter_stats()
+  show_memory_report()
+
+  print_colorized(f"{len(groups)} Group By hechos:\n\t{', '.join(f"{key}: {len(group)} datasets" for key, group in groups.items())}", 'green')
+
+
+def prepare_files(in_file_paths: list[str], settings: Settings, refactor_cache: DataFrameCache | None = None) -> list[pd.DataFrame | None]:
+  """Read and clean/refactor each file, one by one. None for the invalid files."""
+  dfs = []
+
+  for i in tqdm(range(len(in_file_paths)), desc='Refactoring and preparing data', unit='file', colour='cyan'):
+    df = prepare_data_file(in_file_paths[i], settings, refactor_cache)
+
+    # Check UNKNOWN MSG TYPEs => Print unknown values to fix it later
+    if df is not None:
+      show_unknown_enum_found()
+
+    dfs.append(df)
+
+  return dfs
+
+
+def prepare_files_parallel(in_file_paths: list[str], workers: int, settings: Settings, refactor_cache: DataFrameCache | None = None) -> list[pd.DataFrame | None]:
+  """
+  Read and clean/refactor each file in a pool of worker processes. None for the invalid files.
+
+  Results are collected in the order of the files, so the merged data is the same with any number of workers.
+  """
+  dfs = []
+
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(prepare_data_file_worker, in_file_paths, repeat(settings), repeat(refactor_cache))
+
+    for df, unknown_found, time_stats, filter_counts, metrics in tqdm(results, total=len(in_file_paths), desc=f'Refactoring and preparing data ({workers} workers)', unit='file', colour='cyan'):
+      # Unknown values found and dates parsed by the worker
+      for column, unknown_values in unknown_found.items():
+        unknown_enum_found[column] |= unknown_values
+      time_parse_stats.update(time_stats)
+      filter_stats.update(filter_counts)
+      pipeline_metrics.add(metrics)
+
+      # Check UNKNOWN MSG TYPEs => Print unknown values to fix it later
+      if df is not None:
+        show_unknown_enum_found()
+
+      dfs.append(df)
+
+  return dfs
+
+#endregion ======================================================
+
+
+#region ========================= STREAM =========================
+
+# Position of each row in the input files, so rows with the same sort values keep the in-memory order
+row_order_column = '_row_order'
+
+def run_stream(settings: Settings):
+  """
+  Same results as run_all() reading the input files in chunks of Config.chunk_size rows.
+
+  1. Refactor each chunk and spill it to disk partitioned by device_id.
+  2. For each device, read sorted in batches: the filters of each file, end_date and the trajectory metrics
+     (they only depend on rows of the same device), then spill its rows partitioned by the value of each group by column.
+  3. For each group: k-way merge of its sorted pieces into its file.
+
+  Only a few chunks are in memory at once, not the whole dataset. If the data is not sorted by device_id and sent_time first,
+  each device is sorted in memory.
+  """
+  out_data_root = settings.out_data_root
+  in_file_paths = get_file_paths_by_extension(settings.in_data_root)
+
+  print_files([os.path.basename(file) for file in in_file_paths])
+  print()
+
+  spill_root = os.path.join(out_data_root, '.stream')
+
+  # Stream mode writes every file, the manifest of the last run doesn't match them anymore
+  Manifest.remove(out_data_root)
+  shutil.rmtree(spill_root, ignore_errors=True)
+
+  # Pieces sorted by time, so each device can be read sorted in batches
+  device_store = PartitionStore(os.path.join(spill_root, 'device_id'), Config.chunk_size, dropna=False, sort_columns=['sent_time', row_order_column], sort_orders=['asc', 'asc'])
+  samples = []  # First row of each chunk, to get the columns and types pd.concat would give
+  row_offset = 0
+  file_starts = []  # First row of each file, to filter the rows of each file like before the merge
+
+  # Refactor each chunk and partition it by device
+  for i in tqdm(range(len(in_file_paths)), desc=f'Refactoring data in chunks of {Config.chunk_size} rows', unit='file', colour='cyan'):
+    in_file_path = in_file_paths[i]
+    tag = str(i)
+    forget_time_formats()
+    file_starts.append(row_offset)
+
+    # Counts before the file, the chunks read before a parser error are refactored again
+    stats = Counter(filter_stats), Counter(time_parse_stats)
+
+    with pipeline_metrics.stage('refactor chunks', file=in_file_path) as stage:
+      try:
+        file_rows, file_samples = refactor_chunks(read_csv_chunks(in_file_path, Config.chunk_size), device_store, tag, row_offset, settings)
+      except csv_read_errors as e:
+        print_colorized(f"Could not read {in_file_path} in chunks, reading the whole file with the python engine: {e}", 'yellow')
+        device_store.discard(tag)
+        for counter, before in zip((filter_stats, time_parse_stats), stats):
+          counter.clear()
+          counter.update(before)
+
+        df = read_csv_python(in_file_path)
+        if df is None:
+          continue
+        file_rows, file_samples = refactor_chunks([df], device_store, tag, row_offset, settings)
+      stage.rows_in = file_rows
+
+    row_offset += file_rows
+    samples += file_samples
+
+    # Check UNKNOWN MSG TYPEs => Print unknown values to fix it later
+    show_unknown_enum_found()
+
+  # Columns in order of appearance and types of the merged data
+  schema = apply_schema(pd.concat(samples), settings)
+  columns = schema.columns.tolist()
+
+  sort_columns = settings.sort_by_columns + [row_order_column]
+  sort_orders = settings.sort_by_orders + ['asc']
+
+  group_bys = {column: get_group_by_func(column) for column in settings.group_by_columns}
+  group_bys = {column: group_by for column, group_by in group_bys.items() if group_by.available(schema)}
+  # Sorted by device_id first, the devices come in the order of the merged data (null device last, like sort_by):
+  # each group keeps the order of arrival of its rows. Otherwise each group is sorted again
+  devices_in_order = settings.sort_by_columns[:1] == ['device_id'] and settings.sort_by_orders[:1] == ['asc']
+  group_sort = {} if devices_in_order else {'sort_columns': sort_columns, 'sort_orders': sort_orders}
+  group_stores = {column: PartitionStore(os.path.join(spill_root, f'group by {column}'), Config.chunk_size, **group_sort) for column in group_bys}
+  # Like save_to_files, the dates of the CSV groups are formatted once for all the group by columns (not the ones with point layers)
+  formatted_columns = set(group_stores) - set(settings.geo_export_group_by if settings.geo_export_enabled else []) if devices_in_order and settings.output_format == 'csv' else set()
+  # Each cell sorted like the in-memory index: by sent_time, then in the order of the merged data
+  cell_store = PartitionStore(os.path.join(spill_root, 'cells'), Config.chunk_size, sort_columns=['sent_time'] + sort_columns, sort_orders=['asc'] + sort_orders) if settings.spatial_index_enabled else None
+  trajectories = []  # Lines of the rows of each batch
+
+  dtypes = schema.dtypes.to_dict()
+  to_schema = lambda df: df.reindex(columns=columns).astype(dtypes)
+  file_of = lambda df: np.searchsorted(file_starts, df[row_order_column].to_numpy(), side='right')
+  add_metrics = settings.transformations.get('add_trajectory_metrics', False)
+
+  # Sorted by device_id and sent_time first, each device is read in batches: the fixes with the same sent_time
+  # are in the same batch, and end_date and the trajectory metrics wait for the first row of the next batch
+  stream_devices = settings.sort_by_columns[:2] == ['device_id', 'sent_time'] and settings.sort_by_orders[:2] == ['asc', 'asc']
+  if not stream_devices:
+    print_colorized("Each device is sorted in memory: the data is not sorted by device_id and sent_time first (asc)", 'yellow')
+
+  def device_batches(device):
+    """Rows of the device sorted, in batches that don't split the fixes with the same sent_time."""
+    batches = split_runs(device_store.read_sorted(device, to_schema), lambda batch: [batch['sent_time'].to_numpy()])
+    return (sort_by(batch, sort_columns, sort_orders) for batch in batches)
+
+  def filtered_device(device):
+    """The batches of the device filtered like each file before the merge: first find the rows removed, then drop them."""
+    file_filter = FileFilterStream(settings, row_order_column)
+    for batch in device_batches(device):
+      file_filter.add(batch, file_of(batch))
+
+    removed = file_filter.removed_ids()
+    for batch in device_batches(device):
+      batch = batch[~np.isin(batch[row_order_column].to_numpy(), removed)]
+      yield drop_duplicate_fixes(batch, settings, 'duplicate_between_files')
+
+  def whole_device(device) -> pd.DataFrame:
+    df = sort_by(to_schema(device_store.read(device)), sort_columns, sort_orders)
+    df = filter_fixes_by_file(df, file_of(df), settings)
+    df = drop_duplicate_fixes(df, settings, 'duplicate_between_files')
+    df = add_end_date(df)
+    if add_metrics:
+      df = add_trajectory_metrics(df)
+    return df
+
+  def device_rows():
+    devices = tqdm(device_store.keys(), desc='Sorting and grouping each device', unit='device', colour='cyan')
+    if stream_devices:
+      batches = add_end_date_chunks(chain.from_iterable(filtered_device(device) for device in devices))
+      return add_trajectory_metrics_chunks(batches) if add_metrics else batches
+    return (whole_device(device) for device in devices)
+
+  # A line never joins two devices or buckets: the rows of the last ones wait for the next batch
+  if settings.trajectories_enabled:
+    bucket_by = get_group_by_func(trajectory_bucket(settings))
+    trajectory_runs = RunSplitter(lambda batch: [device_keys(batch['device_id'])[0], bucket_by.keys(batch).to_numpy()])
+
+  # Partition the sorted rows of each device by each group by column
+  def sorted_devices():
+    for df in device_rows():
+      formatted = format_dates(df) if formatted_columns else None
+      for column, store in group_stores.items():
+        store.append(formatted if column in formatted_columns else df, group_bys[column].keys(df))
+
+      if cell_store is not None:
+        positions = df.dropna(subset=['lat', 'lon', 'sent_time'])
+        cell_store.append(positions, pd.Series(cell_keys(positions['lat'], positions['lon'], settings.spatial_index_cell_size), index=positions.index))
+
+      if settings.trajectories_enabled:
+        complete = trajectory_runs.add(df)
+        if len(complete) > 0:
+          trajectories.append(build_trajectories(complete, settings))
+
+      yield df.drop(columns=[row_order_column])
+
+    if settings.trajectories_enabled:
+      last = trajectory_runs.close()
+      if last is not None and len(last) > 0:
+        trajectories.append(build_trajectories(last, settings))
+
+  with pipeline_metrics.stage('sort and group devices', rows_in=row_offset) as stage:
+    if settings.time_index_enabled and devices_in_order:
+      stage.rows_out = write_merged(sorted_devices(), settings)
+      print_colorized(f"Merged data saved in {merged_file_path(settings)}", 'green')
+    else:
+      if settings.time_index_enabled:
+        print_colorized("The merged file is only written in stream mode if the data is sorted by device_id first (asc)", 'yellow')
+      stage.rows_out = sum(len(df) for df in sorted_devices())
+
+  # The lines never join two devices, sorted like the lines of the whole dataset
+  if settings.trajectories_enabled:
+    with pipeline_metrics.stage('trajectories') as stage:
+      lines = pd.concat(trajectories, ignore_index=True) if trajectories else build_trajectories(schema.iloc[:0], settings)
+      save_trajectories(lines.sort_values(['device_id', 'start_time'], kind='stable', ignore_index=True), settings)
+      stage.rows_out = len(lines)
+
+  # Save each group (and its point layer)
+  geo_exporter = None
+  if settings.geo_export_enabled:
+    from data_operations.geo_export import GeoExporter, geo_layer_name
+    geo_exporter = GeoExporter(out_data_root, settings.geo_export_formats, settings.geo_export_single_gpkg)
+    for column in set(settings.geo_export_group_by) - set(group_stores):
+      print_colorized(f"Only the columns of group_by are exported in stream mode, not {column}", 'yellow')
+
+  # Each group is read from its pieces straight into its file, never loaded whole, in the threads of the writer
+  # The groups with point layers are written in this thread, their layers as the batches go through
+  with pipeline_metrics.stage('save groups'), geo_exporter or nullcontext(), ParallelFileWriter(write=write_sorted_group) as writer:
+    groups = {}
+    for column, store in group_stores.items():
+      dir_path = os.path.join(out_data_root, group_dir_name(column, settings.output_format))
+      os.makedirs(dir_path, exist_ok=True)
+      for file in os.listdir(dir_path):
+        remove_path(os.path.join(dir_path, file))
+
+      export_layers = geo_exporter is not None and column in settings.geo_export_group_by
+      if export_layers:
+        geo_exporter.start_column(column)
+
+      file_names = []
+      for key in tqdm(store.keys(), desc=f'Saving groups by {column}', unit='group', colour='cyan'):
+        attrs = group_bys[column].group_attrs(key)
+        file_names.append(build_group_file_name(column, attrs, key, settings.output_format))
+
+        file_path = os.path.join(dir_path, file_names[-1])
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if export_layers:
+          batches = (batch.drop(columns=[row_order_column]) for batch in store.read_sorted(key))
+          write_batches(geo_exporter.write_batches(column, geo_layer_name(column, key, attrs), batches), file_path)
+        else:
+          writer.submit(SortedPartition(store, key), file_path)
+
+      groups[column] = file_names
+
+      print()
+      print_colorized(f"Group by {column} (saved to {dir_path}):", 'blue')
+      print_files(file_names)
+      print()
+
+  if writer.written:
+    writer.report()
+  if geo_exporter is not None:
+    geo_exporter.report()
+
+  if cell_store is not None:
+    with pipeline_metrics.stage('spatial index'), SpatialIndexWriter(spatial_index_path(settings), settings.spatial_index_cell_size) as index_writer:
+      for key in tqdm(cell_store.keys(), desc='Building the spatial index', unit='cell', colour='cyan'):
+        for batch in cell_store.read_sorted(key):
+          index_writer.append(batch.drop(columns=[row_order_column]))
+    print_colorized(f"Spatial index saved in {spatial_index_path(settings)}", 'green')
+
+  shutil.rmtree(spill_root, ignore_errors=True)
+
+  show_time_parse_stats()
+  show_filter_stats()
+
+  print_colorized(f"{len(groups)} Group By hechos:\n\t{', '.join(f"{key}: {len(files)} datasets" for key, files in groups.items())}", 'green')
+
+
+def write_sorted_group(partition: SortedPartition, file_path) -> int:
+  """Write the sorted rows of a group of run_stream (without the row order) in batches. Returns the size of the file in bytes."""
+  write_batches((batch.drop(columns=[row_order_column]) for batch in partition), file_path)
+  return os.path.getsize(file_path)
+
+
+def refactor_chunks(chunks, device_store: PartitionStore, tag: str, row_offset: int, settings: Settings) -> tuple[int, list[pd.DataFrame]]:
+  """Refactor each chunk and append it to the device partitions. Returns the number of rows read and the first row of each chunk."""
+  rows = 0
+  samples = []
+
+  for chunk in chunks:
+    df = refactor(chunk, settings)
+    if df is None:
+      break
+
+    df = df.assign(**{row_order_column: np.arange(row_offset + rows, row_offset + rows + len(df))})
+    rows += len(df)
+
+    df = drop_invalid_positions(df, settings)
+    samples.append(df.iloc[:1])
+
+    device_store.append(df, df['device_id'], tag)
+
+  return rows, samples
+
+#endregion ======================================================
+
+
+#region ========================= UNIT OPERATIONS =========================
+
+def sort(df: pd.DataFrame, settings: Settings) -> pd.DataFrame:
+  return sort_by(df, settings.sort_by_columns)
+
+
+def group_by(df: pd.DataFrame, settings: Settings, partition_hashes: dict[str, str] = None) -> dict[str, list[pd.DataFrame]]:
+  """Save the groups of df. Only the changed files if the partition_hashes of the last run are given."""
+  if partition_hashes is None:
+    # All the files are written again, the manifest of the last run doesn't match them anymore
+    Manifest.remove(settings.out_data_root)
+
+  grouped_results = group_by_to_files(df, settings.group_by_columns, settings.out_data_root, partition_hashes, settings.output_format)
+
+  for column, result in grouped_results.items():
+    print()
+    print_colorized(f"Group by {column} (saved to {result['dir_path']}):", 'blue')
+    print_files(result['files'])
+    print()
+
+  return {col: group['dfs'] for col, group in grouped_results.items()}
+
+def geo_export(df: pd.DataFrame, settings: Settings, groups: dict[str, GroupFrames] | None = None) -> dict[str, list[str]]:
+  """Point layers of the groups of df by settings.geo_export_group_by. Reuses the groups already made by group_by."""
+  # geopandas is only imported when exporting
+  from data_operations.geo_export import export_groups
+
+  groups = groups or {}
+  group_datas = {column: groups[column].group_data if column in groups else GroupData(get_group_by_func(column), df) for column in settings.geo_export_group_by}
+  return export_groups(group_datas, settings.out_data_root, settings.geo_export_formats, settings.geo_export_single_gpkg)
+
+def trajectory_bucket(settings: Settings) -> str:
+  """Bucket of the trajectories in settings.yaml, day if unknown."""
+  from data_operations.trajectories import trajectory_buckets
+
+  if settings.trajectories_bucket not in trajectory_buckets:
+    print_colorized(f"Unknown trajectories bucket '{settings.trajectories_bucket}' in {Config.settings_file}, using day. Available: {trajectory_buckets}", 'red')
+    settings.trajectories_bucket = 'day'
+  return settings.trajectories_bucket
+
+def build_trajectories(df: pd.DataFrame, settings: Settings):
+  """A line for each device and bucket of df (trajectories in settings.yaml)."""
+  from data_operations.trajectories import trajectory_lines
+  return trajectory_lines(df, trajectory_bucket(settings), settings.trajectories_tolerance_m, settings.trajectories_measures)
+
+def save_trajectories(lines, settings: Settings) -> list[str]:
+  """Save the lines of build_trajectories in out/geo."""
+  from data_operations.trajectories import save_trajectories
+  return save_trajectories(lines, settings.out_data_root, settings.trajectories_bucket, settings.trajectories_formats)
+
+def write_merged(batches, settings: Settings, file_path = None) -> int:
+  """Write the sorted merged data, with its time index if enabled in settings.yaml."""
+  file_path = file_path or merged_file_path(settings)
+  if settings.time_index_enabled:
+    return write_time_indexed(batches, file_path, settings.time_index_block_rows)
+  return write_batches(batches, file_path)
+
+#region ============= Stand Alone Functions for testing =============
+
+@pipeline_metrics.instrumented('refactor')
+def run_refactor(settings: Settings):
+  refactor_cache = setup(settings)
+  in_data_root, out_data_root = settings.in_data_root, settings.out_data_root
+  in_files = get_files_by_extension(in_data_root)
+
+  print()
+  print_colorized(f"Refactoring files from {in_data_root}:", 'blue')
+  print_files([os.path.basename(file) for file in in_files])
+  print()
+
+  # Each file sorted, so merge only has to merge them (merge_sorted_files)
+  for file in in_files:
+    with pipeline_metrics.stage('refactor', file=os.path.join(in_data_root, file)) as stage:
+      df = read_refactored(os.path.join(in_data_root, file), settings, refactor_cache)
+      df = sort_by(df, settings.sort_by_columns, settings.sort_by_orders)
+      write_csv(df, with_file_format(os.path.join(out_data_root, file), settings.output_format))
+      stage.rows_out = len(df)
+
+  print_colorized(f"Refactored data saved in {out_data_root}", 'green')
+  print_files(in_files)
+  print()
+
+
+@pipeline_metrics.instrumented('merge')
+def run_merge(settings: Settings):
+  refactor_cache = setup(settings)
+  out_data_root = settings.out_data_root
+  file_path = merged_file_path(settings)
+
+  # Input: out files
+  in_files = get_files_by_extension(out_data_root, file_formats[settings.output_format])
+  in_file_paths = [os.path.join(out_data_root, file) for file in in_files]
+
+  if len(in_files) == 0:
+    print_colorized('No files to merge', 'yellow')
+    return
+
+  print_colorized(f"Merging files from {out_data_root}:", 'blue')
+  print_files(in_files)
+  print()
+
+  add_metrics = settings.transformations.get('add_trajectory_metrics', False)
+
+  def with_next_fix_columns(batches):
+    batches = add_end_date_chunks(batches)
+    return add_trajectory_metrics_chunks(batches) if add_metrics else batches
+
+  def merge_in_memory() -> int:
+    df = merge([read_refactored_output(in_file_path, settings, refactor_cache) for in_file_path in in_file_paths], settings)
+    df = add_end_date(sort_by(df, settings.sort_by_columns, settings.sort_by_orders))
+    if add_metrics:
+      df = add_trajectory_metrics(df)
+    return write_merged([df], settings)
+
+  # K-way merge of the sorted files, in batches of Config.chunk_size rows, with end_date (and the trajectory metrics) like run_all
+  # (the rows of each device are contiguous, only the last row of each batch waits for the next one)
+  # If they are not sorted (ValueError) or can't be read in batches they are merged and sorted in memory
+  with pipeline_metrics.stage('merge') as stage:
+    if settings.sort_by_columns[:1] != ['device_id']:
+      print_colorized("Merging the files in memory: end_date and the trajectory metrics need the data sorted by device_id first", 'yellow')
+      stage.rows_out = merge_in_memory()
+    else:
+      try:
+        stage.rows_out = merge_sorted_files(in_file_paths, file_path, settings.sort_by_columns, settings.sort_by_orders, Config.chunk_size, settings,
+                                            lambda batches, file_path: write_merged(with_next_fix_columns(batches), settings, file_path))
+      except csv_read_errors as e:
+        print_colorized(f"Could not merge the sorted files in batches, merging them in memory: {e}", 'yellow')
+        stage.rows_out = merge_in_memory()
+
+  print_colorized(f"Merged data saved in {file_path}", 'green')
+  print_files([os.path.basename(file_path)])
+  print()
+
+
+def read_refactored_output(file_path, settings: Settings, refactor_cache: DataFrameCache | None = None) -> pd.DataFrame | None:
+  """
+  Refactored file written by run_refactor.
+  Loaded from the cache if its input file (same name in in_data_root) is cached, without parsing the file again.
+  """
+  in_file_path = os.path.join(settings.in_data_root, os.path.splitext(os.path.basename(file_path))[0] + '.csv')
+
+  if refactor_cache is not None and os.path.exists(in_file_path):
+    df = refactor_cache.get(refactor_cache_key(in_file_path, settings))
+    if df is not None:
+      return df
+
+  return read_csv(file_path)
+
+
+@pipeline_metrics.instrumented('sort_by')
+def run_sort(settings: Settings):
+  setup(settings)
+
+  # Input: merged file
+  file_path = merged_file_path(settings)
+
+  if not os.path.exists(file_path):
+    print_colorized(f'File not found to sort: {file_path}', 'yellow')
+    return
+
+  print_colorized(f"Sorting file {file_path}", 'blue')
+  print()
+
+  with pipeline_metrics.stage('read_csv', file=file_path) as stage:
+    df = read_csv(file_path)
+    stage.rows_out = len(df)
+  with pipeline_metrics.stage('sort_by', rows_in=len(df)) as stage:
+    df = sort(df, settings)
+    stage.rows_out = len(df)
+  with pipeline_metrics.stage('write merged', rows_in=len(df)) as stage:
+    stage.rows_out = write_merged([df], settings)
+
+  print_colorized(f"Sorted data saved in file {file_path}", 'green')
+  print()
+
+
+@pipeline_metrics.instrumented('extract')
+def run_extract(settings: Settings):
+  """Rows of the merged file between --from and --to of the --device given, read with its time index."""
+  setup(settings)
+
+  try:
+    index = TimeIndex(merged_file_path(settings))
+  except (FileNotFoundError, ValueError) as e:
+    print_colorized(f"No time index of the merged file, run run-all or merge with time_index enabled in settings.yaml first: {e}", 'yellow')
+    return
+
+  with pipeline_metrics.stage('extract', rows_in=index.rows) as stage:
+    df = index.extract(Config.extract_from, Config.extract_to, Config.extract_devices)
+    stage.rows_out = len(df)
+
+  out_path = Config.extract_out or os.path.join(settings.out_data_root, 'extract', f'extract{file_formats[settings.output_format]}')
+  os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+  write_csv(df, out_path)
+
+  print_colorized(f"Extracted {len(df)} rows (from {Config.extract_from or 'the start'} to {Config.extract_to or 'the end'}"
+                  f"{f', devices {Config.extract_devices}' if Config.extract_devices else ''}) to {out_path}", 'green')
+
+
+@pipeline_metrics.instrumented('group-by')
+def run_group_by(settings: Settings):
+  setup(settings)
+  file_path = merged_file_path(settings)
+
+  if not os.path.exists(file_path):
+    print_colorized('No merged file to split', 'yellow')
+    return
+
+  print_colorized(f"Splitting file {file_path} by:", 'blue')
+  with pipeline_metrics.stage('read_csv', file=file_path) as stage:
+    df = apply_schema(read_csv(file_path), settings)
+    stage.rows_out = len(df)
+
+  with pipeline_metrics.stage('group_by', rows_in=len(df)):
+    group_by(df, settings)
+
+
+@pipeline_metrics.instrumented('geo-export')
+def run_geo_export(settings: Settings):
+  """
+  Point layers of the groups of the merged file (geo_export in settings.yaml), without the QGIS console.
+  Also its trajectories if enabled.
+  """
+  setup(settings)
+  file_path = merged_file_path(settings)
+
+  if not os.path.exists(file_path):
+    print_colorized('No merged file to export, run run-all or merge first', 'yellow')
+    return
+
+  print_colorized(f"Exporting the groups of {file_path} by {', '.join(settings.geo_export_group_by)} as point layers", 'blue')
+  with pipeline_metrics.stage('read_csv', file=file_path) as stage:
+    df = apply_schema(read_csv(file_path), settings)
+    stage.rows_out = len(df)
+
+  with pipeline_metrics.stage('geo export', rows_in=len(df)):
+    geo_export(df, settings)
+
+  if settings.trajectories_enabled:
+    with pipeline_metrics.stage('trajectories', rows_in=len(df)) as stage:
+      lines = build_trajectories(df, settings)
+      save_trajectories(lines, settings)
+      stage.rows_out = len(lines)
+
+#endregion ======================================================
+
+#endregion ======================================================
@@ -0,0 +1,97 @@
+import os, shutil, pickle
+import pandas as pd
+from utils.file_manager import pa
+from utils.utils import print_colorized
+
+# Errors reading an entry written partially or by another version (FileNotFoundError is a miss, not an error)
+read_errors = (OSError, EOFError, pickle.UnpicklingError) + ((pa.ArrowInvalid,) if pa is not None else ())
+
+#region ========================= DATAFRAME CACHE =========================
+
+class DataFrameCache:
+  """
+  DataFrames saved on disk by key, with a size cap and LRU eviction.
+
+  Saved as parquet (columnar, keeps categories and datetimes) if pyarrow is installed, as pickle if not.
+  Each read touches the file (mtime), when the cache is bigger than max_bytes
+  the least recently used files are removed.
+
+  Safe to use from several processes: files are written with a temp name and renamed,
+  and files removed by another process are just a miss. Files that can't be read are removed and are a miss too.
+  """
+  def __init__(self, root_path: str, max_bytes: int):
+    self.root_path = root_path
+    self.max_bytes = max_bytes
+    self.extension = '.parquet' if pa is not None else '.pkl'
+
+  def path(self, key: str) -> str:
+    return os.path.join(self.root_path, f'{key}{self.extension}')
+
+  def get(self, key: str) -> pd.DataFrame | None:
+    """The DataFrame of the key, None if it's not cached. An entry that can't be read (truncated, corrupt) is removed."""
+    path = self.path(key)
+    try:
+      df = pd.read_parquet(path) if self.extension == '.parquet' else pd.read_pickle(path)
+      os.utime(path)
+      return df
+    except FileNotFoundError:
+      return None
+    except read_errors as e:
+      print_colorized(f"Could not read {key} from the cache {self.root_path}, removing it: {e}", 'yellow')
+      self.remove(key)
+      return None
+
+  def contains(self, key: str) -> bool:
+    return os.path.exists(self.path(key))
+
+  def remove(self, key: str):
+    try:
+      os.remove(self.path(key))
+    except FileNotFoundError:
+      pass
+
+  def put(self, key: str, df: pd.DataFrame):
+    os.makedirs(self.root_path, exist_ok=True)
+    path = self.path(key)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    try:
+      if self.extension == '.parquet':
+        df.to_parquet(tmp_path)
+      else:
+        df.to_pickle(tmp_path)
+      os.replace(tmp_path, path)
+    except Exception as e:
+      # Not cached, it will be computed again next time
+      print_colorized(f"Could not save {key} in the cache {self.root_path}: {e}", 'yellow')
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      return
+
+    self.evict()
+
+  def evict(self):
+    """Remove the least recently used files until the cache fits in max_bytes."""
+    entries = []
+    for file in os.listdir(self.root_path):
+      if file.endswith(self.extension):
+        try:
+          stat = os.stat(os.path.join(self.root_path, file))
+          entries.append((stat.st_mtime, stat.st_size, file))
+        except FileNotFoundError:
+          continue
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, file in sorted(entries):
+      if total_bytes <= self.max_bytes:
+        break
+      try:
+        os.remove(os.path.join(self.root_path, file))
+      except FileNotFoundError:
+        pass
+      total_bytes -= size
+
+  def clear(self):
+    shutil.rmtree(self.root_path, ignore_errors=True)
+
+#endregion
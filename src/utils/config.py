@@ -1,20 +1,69 @@
 import argparse
-import os, json, yaml
-from .utils import print_colorized
+import os, json
+
+# No pandas or yaml on import: the CLI reads the arguments (and '--help') without loading them
+# The settings are read only when used (Config.settings()) and passed to each stage
 
 class Config:
   
   test_mode: bool = False
+  stream_mode: bool = False
+  chunk_size: int = 100_000
+  workers: int = 1
+  full_rebuild: bool = False
+  use_cache: bool = True
+  clear_cache: bool = False
+  memory_report: bool = False
+  extract_from: str | None = None
+  extract_to: str | None = None
+  extract_devices: list[int] | None = None
+  extract_out: str | None = None
+  profile_stages: list[str] | None = None
+  
+  # Description and groups of options of each script (console_scripts of setup.py), the other options keep their defaults
+  scripts = {
+    'run-all': ('Clean and split collar data', ['cache', 'run', 'chunks']),
+    'refactor': ('Refactor each input file', ['cache']),
+    'merge': ('Merge the refactored files into one', ['cache', 'chunks']),
+    'sort_by': ('Sort the merged file', []),
+    'group-by': ('Split the merged file in the groups of settings.yaml', []),
+    'extract': ('Rows of the merged file in a time window, read with its time index', ['extract']),
+    'geo-export': ('Point layers (and trajectories) of the groups of the merged file for QGIS', []),
+  }
   
-  def parse_args() -> dict[str, any]:
-    # -t o --test to run the script in test mode
-    argparser = argparse.ArgumentParser(description='Clean and split collar data')
-    argparser.add_argument('-t', '--test', action='store_true', help='Run the script in test mode')
-    Config.test_mode = argparser.parse_args().test
+  def parse_args(script: str = 'run-all'):
+    """Read the arguments of the script into Config. A script fails on the options of the other scripts."""
+    description, groups = Config.scripts[script]
+    argparser = argparse.ArgumentParser(prog=script, description=description)
+    argparser.add_argument('-t', '--test', dest='test_mode', action='store_true', help='Run the script in test mode')
+    argparser.add_argument('--profile', dest='profile_stages', action='append', metavar='STAGE', help="Run the stage in cProfile and save its stats in out/profile ('all' for every stage, repeat it for more stages)")
+    if 'cache' in groups:
+      argparser.add_argument('--no-cache', dest='use_cache', action='store_false', help="Don't load or save the refactored input files in the cache")
+      argparser.add_argument('--clear-cache', action='store_true', help='Empty the cache of refactored input files before running')
+    if 'run' in groups:
+      argparser.add_argument('-s', '--stream', dest='stream_mode', action='store_true', help='Process the input files in chunks, memory depends on the chunk size and not on the whole dataset')
+      argparser.add_argument('-w', '--workers', type=int, default=Config.workers, help='Processes to refactor the input files in parallel')
+      argparser.add_argument('-f', '--full', dest='full_rebuild', action='store_true', help='Ignore the manifest of the last run and process every input file again')
+      argparser.add_argument('--memory-report', action='store_true', help='Print the memory used by the data at each stage')
+    if 'chunks' in groups:
+      argparser.add_argument('--chunk-size', type=int, default=Config.chunk_size, help='Rows per chunk in stream mode and in the merge of sorted files')
+    if 'extract' in groups:
+      # Window of the merged data read with its time index
+      argparser.add_argument('--from', dest='extract_from', help="Rows with sent_time from this date (included), e.g. '2024-09-01 10:00'")
+      argparser.add_argument('--to', dest='extract_to', help='Rows with sent_time before this date (excluded)')
+      argparser.add_argument('--device', dest='extract_devices', type=int, action='append', help='Rows of this device_id (repeat it for more devices)')
+      argparser.add_argument('--out', dest='extract_out', help='File to save the rows (format by extension), out/extract/extract.csv by default')
+    
+    for name, value in vars(argparser.parse_args()).items():
+      setattr(Config, name, value)
   
   config_dir = './config'
+  settings_file = 'settings.yaml'
+  identifiers_file = 'enum_identifiers.json'
   
   def config_file(filename) -> dict | str :
+    from .utils import print_colorized
+    
     file_path = os.path.join(Config.config_dir, filename)
     with open(file_path, 'r') as f:
       
@@ -26,8 +75,76 @@ class Config:
       if ext == '.json':
         return json.loads(data)
       elif ext == '.yaml':
+        import yaml
         return yaml.load(data, Loader=yaml.FullLoader)
       
       return data
   
+  _settings: 'Settings | None' = None
+  
+  def settings() -> 'Settings':
+    """Settings of settings.yaml and enum_identifiers.json, read the first time they are used."""
+    if Config._settings is None:
+      Config._settings = Settings(Config.config_file(Config.settings_file), Config.config_file(Config.identifiers_file), Config.test_mode)
+    return Config._settings
+  
+  def config_file_paths() -> list[str]:
+    """If any of these change, the incremental runs process everything again."""
+    return [os.path.join(Config.config_dir, file) for file in [Config.settings_file, Config.identifiers_file]]
+
+
+class Settings:
+  """
+  settings.yaml and enum_identifiers.json as typed attributes.
+  Built once by Config.settings() and passed to each stage of the pipeline.
+  """
+  
+  def __init__(self, settings: dict, identifiers: dict[str, dict[str, list[str]]], test_mode: bool = False):
+    # PATHS
+    paths = settings['paths']
+    self.in_data_root: str = paths['test_raw_data'] if test_mode else paths['raw_data']
+    self.out_data_root: str = paths['test_processed_data'] if test_mode else paths['processed_data']
+    self.merged_data_subpath: str = paths['merged_data_subpath']
+    
+    # CACHE of the refactored input files
+    cache = settings.get('cache', {})
+    self.cache_path: str = cache.get('path', './data/.cache/refactor')
+    self.cache_max_bytes: int = cache.get('max_size_mb', 2048) * 2**20
+    
+    # Spatial and time indexes
+    spatial_index = settings.get('spatial_index', {})
+    self.spatial_index_enabled: bool = spatial_index.get('enabled', False)
+    self.spatial_index_cell_size: float = spatial_index.get('cell_size', 0.005)
+    time_index = settings.get('time_index', {})
+    self.time_index_enabled: bool = time_index.get('enabled', False)
+    self.time_index_block_rows: int = time_index.get('block_rows', 10_000)
+    
+    # Point layers and trajectories for QGIS
+    geo_export = settings.get('geo_export', {})
+    self.geo_export_enabled: bool = geo_export.get('enabled', False)
+    self.geo_export_formats: list[str] = geo_export.get('formats', ['gpkg'])
+    self.geo_export_single_gpkg: bool = geo_export.get('single_gpkg', False)
+    trajectories = settings.get('trajectories', {})
+    self.trajectories_enabled: bool = trajectories.get('enabled', False)
+    self.trajectories_bucket: str = trajectories.get('bucket', 'day')
+    self.trajectories_measures: bool = trajectories.get('measures', True)
+    self.trajectories_tolerance_m: float = trajectories.get('simplify_tolerance_m', 0)
+    self.trajectories_formats: list[str] = trajectories.get('formats', ['gpkg'])
+    
+    # PIPELINE
+    pipeline = settings['pipeline']
+    self.output_format: str = pipeline.get('output_format', 'csv')
+    self.float32_positions: bool = pipeline.get('schema', {}).get('float32_positions', False)
+    self.transformations: dict[str, bool] = {name: enabled for transformation in pipeline['active_transformations'] for name, enabled in transformation.items()}
+    # The rows without position were always removed
+    self.filter_null_positions: bool = self.transformations.get('filter_null_positions', True)
+    self.filters: dict = pipeline.get('filters', {})
+    self.group_by_columns: list[str] = pipeline['group_by']
+    self.sort_by_columns: list[str] = [by['column'] for by in pipeline['sort_by']]
+    self.sort_by_orders: list[str] = [by['order'] for by in pipeline['sort_by']]
+    self.geo_export_group_by: list[str] = geo_export.get('group_by') or self.group_by_columns
+    
+    # ENUMS
+    self.identifiers: dict[str, dict[str, list[str]]] = identifiers
+  
 
@@ -1,6 +1,21 @@
-import os
+import os, io, csv, shutil, warnings
+import numpy as np
 import pandas as pd
-from utils.utils import colorize, str_to_time
+from utils.utils import colorize, str_to_time, series_to_time
+
+# pyarrow is optional: faster CSV reader if installed, C engine if not
+try:
+  import pyarrow as pa
+  import pyarrow.csv as pa_csv
+  import pyarrow.parquet as pa_parquet
+except ImportError:
+  pa = None
+
+fast_csv_engine = 'pyarrow' if pa is not None else 'c'
+
+# Errors of the readers when a file doesn't fit the known column types or can't be parsed
+# (a NaN in an int column, a broken line...). Only these fall back to the python engine
+csv_read_errors = (pd.errors.ParserError, ValueError) + ((pa.ArrowInvalid,) if pa is not None else ())
 
 # Full Path of each file in dir with given extension
 def get_file_paths_by_extension(dir_path: str, extension = '.csv') -> list[str]:
@@ -17,6 +32,13 @@ def print_files(files: list[str], max_files = 5):
   if len(files) > max_files:
     print(f"\t... ({len(files) - max_files} more)")
 
+def remove_path(path: str):
+  """Remove a file or a folder with all its content."""
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  else:
+    os.remove(path)
+
 def ensure_dir_exists(paths: list[str] | str):
   
   if isinstance(paths, str):
@@ -33,7 +55,172 @@ def ensure_dir_exists(paths: list[str] | str):
 
 date_format = '%d/%m/%Y %H:%M:%S'
 
+# Known columns of the NoFence collar data (raw and processed)
+# Columns not listed here are inferred by pandas
+csv_dtypes = {
+  'device_id': 'int64',
+  'lat': 'float64',
+  'lon': 'float64',
+  'msg_type': 'category',
+  'mode': 'category',
+  'collar_status': 'category',
+  'fence_status': 'category',
+  
+  # Raw dates, parsed in refactor
+  'time': 'str',
+  'position_time': 'str',
+  
+  # Processed dates (written with date_format), parsed after reading
+  'sent_time': 'str',
+  'received_time': 'str',
+  'end_date': 'str',
+}
+csv_date_columns = ['sent_time', 'received_time', 'end_date']
+
+csv_separators = ',;\t|'
+
+# Output formats (pipeline.output_format in settings.yaml) and the extension of their files
+# parquet and feather (Arrow IPC) keep the categories and datetimes as they are. They need pyarrow
+file_formats = {
+  'csv': '.csv',
+  'parquet': '.parquet',
+  'feather': '.feather',
+}
+
+def get_file_format(file_path) -> str:
+  """Format of the file by its extension, csv if unknown."""
+  extension = os.path.splitext(file_path)[1].lower()
+  for file_format, format_extension in file_formats.items():
+    if extension == format_extension:
+      return file_format
+  return 'csv'
+
+def with_file_format(file_path, file_format: str) -> str:
+  """Same path with the extension of file_format."""
+  return os.path.splitext(file_path)[0] + file_formats[file_format]
+
 def read_csv(file_path) -> pd.DataFrame | None:
+  """
+  Read a CSV with pyarrow (or the C engine if not installed) and the known column types.
+  
+  Files that can't be read with that schema
+  (other types, a NaN in device_id...) are read with the python engine.
+  
+  Parquet and feather files (by extension) are read as they are, the types are stored in the file.
+  """
+  file_format = get_file_format(file_path)
+  if file_format == 'parquet':
+    return pd.read_parquet(file_path)
+  if file_format == 'feather':
+    return pd.read_feather(file_path)
+  
+  try:
+    return read_csv_fast(file_path)
+  except csv_read_errors as e:
+    print(colorize(f"Fast CSV read failed, retrying with the python engine: {e}", 'yellow'))
+  
+  df = read_csv_python(file_path)
+  if df is not None:
+    parse_csv_dates(df)
+  return df
+
+
+def read_csv_fast(file_path) -> pd.DataFrame:
+  separator, columns = read_csv_header(file_path)
+  dtypes = {column: dtype for column, dtype in csv_dtypes.items() if column in columns}
+  
+  if fast_csv_engine == 'pyarrow':
+    df = read_csv_pyarrow(file_path, separator, dtypes)
+  else:
+    # round_trip parses floats exactly like float(), the default C parser can be 1 ulp away
+    df = pd.read_csv(file_path, sep=separator, engine='c', dtype=dtypes, float_precision='round_trip')
+  
+  parse_csv_dates(df)
+  return df
+
+
+def parse_csv_dates(df: pd.DataFrame):
+  """Parse the processed dates (csv_date_columns) of a DataFrame read from a CSV."""
+  for column in csv_date_columns:
+    if column in df.columns:
+      df[column] = series_to_time(df[column])
+
+
+def read_csv_chunks(file_path, chunk_size: int):
+  """
+  Read a CSV in chunks of chunk_size rows with the C engine and the known column types.
+  
+  Raises if the file can't be read with that schema (like read_csv_fast).
+  """
+  separator, columns = read_csv_header(file_path)
+  dtypes = {column: dtype for column, dtype in csv_dtypes.items() if column in columns}
+  
+  with pd.read_csv(file_path, sep=separator, engine='c', dtype=dtypes, float_precision='round_trip', chunksize=chunk_size) as reader:
+    for chunk in reader:
+      parse_csv_dates(chunk)
+      yield chunk
+
+
+def read_csv_ranges(file_path, ranges: list[tuple[int, int]]) -> pd.DataFrame:
+  """
+  Rows of a CSV in the byte ranges [start, end) given, parsed with its header like read_csv_chunks.
+  Each range must start and end at the start of a line (the positions of write_batches).
+  """
+  separator, columns = read_csv_header(file_path)
+  dtypes = {column: dtype for column, dtype in csv_dtypes.items() if column in columns}
+  
+  with open(file_path, 'rb') as f:
+    data = bytearray(f.readline())
+    for start, end in ranges:
+      f.seek(start)
+      data += f.read(end - start)
+  
+  try:
+    # The C parser warns before failing to read '229034.0' as int64
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning)
+      df = pd.read_csv(io.BytesIO(data), sep=separator, engine='c', dtype=dtypes, float_precision='round_trip')
+  except ValueError:
+    # Other types (a NaN in device_id...), inferred by pandas
+    df = pd.read_csv(io.BytesIO(data), sep=separator, engine='c', float_precision='round_trip')
+  
+  parse_csv_dates(df)
+  return df
+
+
+def read_csv_pyarrow(file_path, separator: str, dtypes: dict[str, str]) -> pd.DataFrame:
+  arrow_types = {
+    'int64': pa.int64(),
+    'float64': pa.float64(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'str': pa.string(),
+  }
+  
+  table = pa_csv.read_csv(
+    file_path,
+    parse_options=pa_csv.ParseOptions(delimiter=separator),
+    # Explicit types so pyarrow doesn't parse (and convert to UTC) the raw dates
+    convert_options=pa_csv.ConvertOptions(
+      column_types={column: arrow_types[dtype] for column, dtype in dtypes.items()},
+      strings_can_be_null=True,
+    ),
+  )
+  
+  # Dictionaries become categories and strings object columns, like the C engine
+  df = table.to_pandas()
+  
+  # Null strings as NaN (pyarrow gives None)
+  for column in df.select_dtypes(include='object').columns:
+    df[column] = df[column].fillna(np.nan)
+  
+  # Sorted categories, pyarrow keeps them in order of appearance
+  for column in df.select_dtypes(include='category').columns:
+    df[column] = df[column].cat.reorder_categories(sorted(df[column].cat.categories))
+  
+  return df
+
+
+def read_csv_python(file_path) -> pd.DataFrame | None:
   try:
     return pd.read_csv(file_path, sep=None, engine='python', parse_dates=True)
   except Exception as e:
@@ -41,9 +228,114 @@ def read_csv(file_path) -> pd.DataFrame | None:
     return None
 
 
+def read_csv_header(file_path) -> tuple[str, list[str]]:
+  """Detect the separator from the header line. Returns the separator and the column names."""
+  with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+    header = f.readline()
+  
+  separator = csv.Sniffer().sniff(header, delimiters=csv_separators).delimiter
+  columns = next(csv.reader([header], delimiter=separator))
+  return separator, columns
+
+
 def write_csv(df: pd.DataFrame, file_path, separator = ','):
+  # Parquet and feather by extension: categories and datetimes stored natively
+  file_format = get_file_format(file_path)
+  if file_format == 'parquet':
+    df.to_parquet(file_path, index=False)
+    return
+  if file_format == 'feather':
+    # Feather doesn't store the index, it must be the default one
+    df.reset_index(drop=True).to_feather(file_path)
+    return
+  
   # Save the cleaned data to a new file
   # Ensure datetime columns are formatted correctly in out_format
   df.to_csv(file_path, sep = separator, index=False, date_format=date_format)
 
+def read_batches(file_path, batch_rows: int):
+  """
+  Read a file in DataFrames of about batch_rows rows, in the format of its extension.
+  CSVs are read like read_csv_chunks. Parquet by row batches and feather by its record batches.
+  """
+  file_format = get_file_format(file_path)
+  
+  if file_format == 'csv':
+    yield from read_csv_chunks(file_path, batch_rows)
+  
+  elif file_format == 'parquet':
+    for batch in pa_parquet.ParquetFile(file_path).iter_batches(batch_size=batch_rows):
+      yield pa.Table.from_batches([batch]).to_pandas()
+  
+  elif file_format == 'feather':
+    with pa.memory_map(file_path) as source:
+      reader = pa.ipc.open_file(source)
+      for i in range(reader.num_record_batches):
+        yield pa.Table.from_batches([reader.get_batch(i)]).to_pandas()
+
+
+def write_batches(batches, file_path, locations: list[tuple[int, int]] | None = None) -> int:
+  """
+  Write DataFrames one after another in the same file, like write_csv of all of them concatenated.
+  Only one batch is in memory at once. All the batches must have the same columns and types.
+  
+  If locations is given, the location of each batch in the file is appended to it, to read it alone later:
+  its byte range [start, end) in CSVs, its row group (parquet) or record batches (feather) [first, last).
+  
+  Written to a temp file and renamed at the end. Returns the number of rows written.
+  """
+  file_format = get_file_format(file_path)
+  dir_path, file_name = os.path.split(file_path)
+  tmp_path = os.path.join(dir_path, f'.tmp.{file_name}')
+  
+  rows = 0
+  parts = 0
+  writer = None
+  schema = None
+  try:
+    for batch in batches:
+      if file_format == 'csv':
+        if rows == 0:
+          # Header alone, so the rows of every batch start after it
+          batch.iloc[:0].to_csv(tmp_path, mode='w', index=False)
+        start = os.path.getsize(tmp_path)
+        batch.to_csv(tmp_path, mode='a', header=False, index=False, date_format=date_format)
+        location = (start, os.path.getsize(tmp_path))
+      else:
+        # Same arrow schema as the first batch for all of them
+        table = pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+        if writer is None:
+          schema = table.schema
+          writer = pa_parquet.ParquetWriter(tmp_path, schema) if file_format == 'parquet' else pa.ipc.new_file(tmp_path, schema)
+        
+        # 1 row group per batch in parquet, its record batches in feather
+        if file_format == 'parquet':
+          written_parts = 1 if len(table) > 0 else 0
+          if written_parts:
+            writer.write_table(table, row_group_size=len(table))
+        else:
+          record_batches = table.to_batches()
+          for record_batch in record_batches:
+            writer.write_batch(record_batch)
+          written_parts = len(record_batches)
+        location = (parts, parts + written_parts)
+        parts += written_parts
+      
+      if locations is not None:
+        locations.append(location)
+      rows += len(batch)
+    
+    if writer is not None:
+      writer.close()
+      writer = None
+    if rows > 0:
+      os.replace(tmp_path, file_path)
+  finally:
+    if writer is not None:
+      writer.close()
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  
+  return rows
+
 #endregion =================================================
\ No newline at end of file
@@ -0,0 +1,131 @@
+import os, time
+from typing import TypedDict, Callable
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import pandas as pd
+from utils.file_manager import write_csv, date_format
+from utils.utils import print_colorized
+
+#region ===================== PARALLEL WRITER =====================
+
+def format_dates(df: pd.DataFrame) -> pd.DataFrame:
+  """
+  Copy of df with the datetime columns already formatted as strings with date_format.
+
+  Format them once on the whole dataset before slicing it in groups,
+  instead of formatting them again in every to_csv of every group.
+  """
+  formatted = df.copy(deep=False)
+  for column in df.select_dtypes(include='datetime').columns:
+    formatted[column] = df[column].dt.strftime(date_format)
+  return formatted
+
+
+def write_csv_atomic(df: pd.DataFrame, file_path) -> int:
+  """
+  write_csv to a temp file in the same folder, then rename it to file_path.
+  The file is either complete or not there, even if the run is interrupted.
+  The temp file keeps the extension, so it's written in the same format.
+
+  Returns the size of the file in bytes.
+  """
+  dir_path, file_name = os.path.split(file_path)
+  os.makedirs(dir_path, exist_ok=True)
+  tmp_path = os.path.join(dir_path, f'.tmp.{file_name}')
+  try:
+    write_csv(df, tmp_path)
+    os.replace(tmp_path, file_path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  return os.path.getsize(file_path)
+
+
+class WrittenFile(TypedDict):
+  file_path: str
+  rows: int
+  bytes: int
+  seconds: float
+
+
+class ParallelFileWriter:
+  """
+  Writes DataFrames to files in a pool of threads, atomically.
+
+  write(df, file_path) writes each file and returns its size in bytes: write_csv_atomic by default
+  (the format of each file given by its extension, like write_csv), write_geo_atomic for the QGIS layers.
+
+  submit() returns as soon as the file is queued. At most max_pending files wait in memory,
+  submit() blocks until one of them is written when the queue is full.
+  Files submitted to the same path are written in order, the last one wins like with write_csv.
+
+  Use it with `with`: on exit waits for every file and raises the first error found.
+  The time of each file is kept in written, report() prints the totals.
+  """
+
+  def __init__(self, workers: int = None, max_pending: int = None, write: Callable[[pd.DataFrame, str], int] = write_csv_atomic):
+    self.workers = workers or min(8, os.cpu_count() or 1)
+    self.write = write
+    self.max_pending = max_pending or self.workers * 4
+    self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='file_writer')
+    self.pending: set[Future] = set()
+    self.last_by_path: dict[str, Future] = {}
+    self.written: list[WrittenFile] = []
+    self.start_time = time.perf_counter()
+    self.elapsed = 0.0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def submit(self, df: pd.DataFrame, file_path):
+    if len(self.pending) >= self.max_pending:
+      done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+      self._collect(done)
+
+    # Never write the same file from 2 threads at once
+    previous = self.last_by_path.get(file_path)
+    if previous is not None and previous in self.pending:
+      wait([previous])
+      self.pending.discard(previous)
+      self._collect([previous])
+
+    future = self.executor.submit(self._write, df, file_path)
+    self.pending.add(future)
+    self.last_by_path[file_path] = future
+
+  def close(self) -> list[WrittenFile]:
+    """Wait for every pending file. Returns the times of every file written."""
+    done, self.pending = wait(self.pending), set()
+    self.executor.shutdown()
+    self.last_by_path.clear()
+    self.elapsed = time.perf_counter() - self.start_time
+    self._collect(done.done)
+    return self.written
+
+  def _collect(self, futures):
+    for future in futures:
+      # Raises the error of the thread if the file couldn't be written
+      self.written.append(future.result())
+
+  def _write(self, df: pd.DataFrame, file_path) -> WrittenFile:
+    start = time.perf_counter()
+    size = self.write(df, file_path)
+    return {'file_path': file_path, 'rows': len(df), 'bytes': size, 'seconds': time.perf_counter() - start}
+
+  def report(self, max_files = 5):
+    """Print the write throughput and the slowest files."""
+    total_bytes = sum(file['bytes'] for file in self.written)
+    total_rows = sum(file['rows'] for file in self.written)
+    elapsed = max(self.elapsed, 1e-9)
+
+    print_colorized(f"Written {len(self.written)} files ({total_rows} rows, {total_bytes / 2**20:.1f} MB) "
+                    f"in {self.elapsed:.2f}s with {self.workers} threads: "
+                    f"{total_bytes / 2**20 / elapsed:.1f} MB/s, {len(self.written) / elapsed:.0f} files/s", 'green')
+
+    slowest = sorted(self.written, key=lambda file: file['seconds'], reverse=True)[:max_files]
+    for file in slowest:
+      print_colorized(f"\t{file['seconds']:.3f}s\t{file['rows']} rows\t{os.path.join(*file['file_path'].split(os.sep)[-2:])}", 'gray')
+
+#endregion ======================================================
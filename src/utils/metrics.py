@@ -0,0 +1,205 @@
+import os, sys, json, time, cProfile, pstats, functools
+from contextlib import contextmanager
+from datetime import datetime
+from utils.config import Config
+from utils.utils import print_colorized
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+#region ======================== METRICS ========================
+
+# Métricas de cada etapa del pipeline, guardadas en out/metrics-<script>.json al terminar
+#
+# For each stage (and each file in the stages done file by file):
+#   wall_seconds, cpu_seconds      time.perf_counter / process CPU (+ the worker processes finished in the stage)
+#   rows_in, rows_out              set by the code of the stage
+#   peak_rss                       peak resident memory of the process at the end of the stage (bytes)
+#   bytes_read, bytes_written      bytes read and written by the process (/proc/self/io or psutil), null if unknown
+# With --profile STAGE (or --profile all) the stage runs in cProfile: out/profile/<script>-<stage>.prof
+
+def cpu_seconds() -> float:
+  """CPU time of the process and of its finished child processes (the workers)."""
+  if resource is None:
+    return time.process_time()
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return time.process_time() + children.ru_utime + children.ru_stime
+
+def peak_rss() -> int | None:
+  """Peak resident memory of the process in bytes."""
+  if resource is not None:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB in Linux, bytes in macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+  if psutil is not None:
+    memory = psutil.Process().memory_info()
+    return getattr(memory, 'peak_wset', memory.rss)
+  return None
+
+def io_bytes() -> tuple[int, int] | None:
+  """(bytes read, bytes written) by the process until now: every read/write, from disk or from the OS cache."""
+  try:
+    with open('/proc/self/io') as f:
+      counters = dict(line.split(': ') for line in f.read().splitlines())
+    return int(counters['rchar']), int(counters['wchar'])
+  except (OSError, KeyError, ValueError):
+    pass
+  if psutil is not None:
+    try:
+      counters = psutil.Process().io_counters()
+      return counters.read_chars if hasattr(counters, 'read_chars') else counters.read_bytes, \
+             counters.write_chars if hasattr(counters, 'write_chars') else counters.write_bytes
+    except (AttributeError, psutil.Error):
+      pass
+  return None
+
+
+class Stage:
+  """Metrics of a running stage. The stage sets rows_in and rows_out."""
+
+  def __init__(self, name: str, file: str | None = None, rows_in: int | None = None):
+    self.name = name
+    self.file = file
+    self.rows_in = rows_in
+    self.rows_out: int | None = None
+
+  def start(self):
+    self.start_wall = time.perf_counter()
+    self.start_cpu = cpu_seconds()
+    self.start_io = io_bytes()
+
+  def stop(self) -> dict:
+    end_io = io_bytes()
+    io = (end_io[0] - self.start_io[0], end_io[1] - self.start_io[1]) if end_io and self.start_io else (None, None)
+    return {
+      'stage': self.name,
+      'file': self.file,
+      'wall_seconds': time.perf_counter() - self.start_wall,
+      'cpu_seconds': cpu_seconds() - self.start_cpu,
+      'rows_in': self.rows_in,
+      'rows_out': self.rows_out,
+      'peak_rss': peak_rss(),
+      'bytes_read': io[0],
+      'bytes_written': io[1],
+    }
+
+
+class PipelineMetrics:
+  """
+  Records of the stages of a script (run-all, refactor...).
+
+    @pipeline_metrics.instrumented('run-all')
+    def run_all(settings):
+      with pipeline_metrics.stage('merge', rows_in=rows) as stage:
+        df = merge(dfs, settings)
+        stage.rows_out = len(df)
+  """
+
+  def __init__(self):
+    self.script: str | None = None
+    self.records: list[dict] = []
+    self.profile_stages: set[str] = set()
+    self.profile_dir: str | None = None
+    self.profiling = False
+
+  def start(self, script: str, profile_stages=None, profile_dir: str | None = None):
+    self.script = script
+    self.records = []
+    self.profile_stages = set(profile_stages or [])
+    self.profile_dir = profile_dir
+    self.started = datetime.now().isoformat(timespec='seconds')
+    self.run_stage = Stage(script)
+    self.run_stage.start()
+
+  @contextmanager
+  def stage(self, name: str, file: str | None = None, rows_in: int | None = None):
+    """Record the metrics of the code inside the with. Profiled if it's one of the profile_stages (not inside another profiled stage)."""
+    stage = Stage(name, file, rows_in)
+    profiler = None
+    if not self.profiling and (name in self.profile_stages or 'all' in self.profile_stages):
+      profiler = cProfile.Profile()
+      self.profiling = True
+
+    stage.start()
+    if profiler is not None:
+      profiler.enable()
+    try:
+      yield stage
+    finally:
+      if profiler is not None:
+        profiler.disable()
+        self.profiling = False
+      self.records.append(stage.stop())
+      if profiler is not None:
+        self.dump_profile(profiler, stage)
+
+  def clear(self) -> list[dict]:
+    """Records until now, removed from the list."""
+    records, self.records = self.records, []
+    return records
+
+  def add(self, records: list[dict]):
+    """Records of other processes (the workers)."""
+    self.records += records
+
+  def dump_profile(self, profiler: cProfile.Profile, stage: Stage):
+    name = f'{self.script}-{stage.name}' + (f'-{os.path.basename(stage.file)}' if stage.file else '')
+    file_path = os.path.join(self.profile_dir or '.', 'profile', name.replace(' ', '_') + '.prof')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    profiler.dump_stats(file_path)
+
+    print_colorized(f"Profile of {stage.name} saved in {file_path} (python -m pstats {file_path})", 'blue')
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+  def save(self, out_root: str) -> str:
+    """Save the records in out_root/metrics-<script>.json."""
+    report = {
+      'script': self.script,
+      'started': self.started,
+      'total': self.run_stage.stop(),
+      'stages': self.records,
+    }
+    file_path = os.path.join(out_root, f'metrics-{self.script}.json')
+    os.makedirs(out_root, exist_ok=True)
+    with open(file_path, 'w') as f:
+      json.dump(report, f, indent=2)
+    return file_path
+
+  def show(self, file_path: str, slowest: int = 3):
+    # Seconds of each stage, adding up the files of the stages done file by file
+    seconds = {}
+    for record in self.records:
+      seconds[record['stage']] = seconds.get(record['stage'], 0) + record['wall_seconds']
+    if not seconds:
+      return
+    stages = sorted(seconds.items(), key=lambda item: item[1], reverse=True)[:slowest]
+    print_colorized(f"Metrics of each stage saved in {file_path}. Slowest: " + ', '.join(f"{stage} {stage_seconds:.2f}s" for stage, stage_seconds in stages), 'blue')
+
+  def instrumented(self, script: str):
+    """
+    Decorator of a script that receives the settings first: records its stages and saves them
+    in settings.out_data_root when it ends (also if it fails). Profiles the stages of --profile.
+    """
+    def decorator(function):
+      @functools.wraps(function)
+      def wrapper(settings, *args, **kwargs):
+        self.start(script, Config.profile_stages, settings.out_data_root)
+        try:
+          return function(settings, *args, **kwargs)
+        finally:
+          self.show(self.save(settings.out_data_root))
+      return wrapper
+    return decorator
+
+
+# Metrics of the current process. The workers return theirs with the data, like the time parse stats
+pipeline_metrics = PipelineMetrics()
+
+#endregion
@@ -1,4 +1,5 @@
 import pandas as pd
+from typing import Callable
 from colorama import Back, Fore, Style
 
 #region ========================= LOGGING =========================
@@ -68,4 +69,106 @@ def unlocalize_utc_dt(time: pd.Timestamp) -> pd.Timestamp:
     return time.tz_localize(None)
   return time
 
+
+# Formats tried when parsing a whole column at once (after stripping the tz offset)
+# Day first formats only when the day has 2 digits, like str_to_time does
+column_time_formats = [
+  '%Y-%m-%d %H:%M:%S',
+  '%Y-%m-%d %H:%M:%S.%f',
+  '%Y-%m-%dT%H:%M:%S',
+  '%Y-%m-%dT%H:%M:%S.%f',
+  '%Y/%m/%d %H:%M:%S',
+  '%d/%m/%Y %H:%M:%S',
+  '%d/%m/%Y %H:%M',
+  '%d-%m-%Y %H:%M:%S',
+  '%Y-%m-%d',
+  '%d/%m/%Y',
+]
+
+# +00:00, +0200, -03:00 or Z at the end of the value
+tz_offset_pattern = r'(?:Z|[+-]\d{2}:?\d{2})$'
+
+sniff_sample_size = 100
+
+def sniff_time_format(values: pd.Series) -> str | None:
+  """
+  Guess the format of a column of date strings from a small sample.
+
+  Returns the format of column_time_formats that matches more values of the sample,
+  or None if none of them matches.
+  """
+  sample = values.dropna().head(sniff_sample_size)
+  if sample.empty:
+    return None
+
+  best_format, best_matches = None, 0
+  for fmt in column_time_formats:
+    matches = _match_time_format(sample, fmt)[1].sum()
+    if matches > best_matches:
+      best_format, best_matches = fmt, matches
+
+  return best_format
+
+def _match_time_format(values: pd.Series, date_format: str) -> tuple[pd.Series, pd.Series]:
+  """Parse the values with date_format. Returns the parsed times and the mask of matched rows."""
+  times = pd.to_datetime(values, format=date_format, errors='coerce')
+  matched = times.notna()
+
+  # pd.to_datetime accepts 1 digit days and months ('2/9/2024')
+  # but str_to_time only reads them as day first when they have 2 digits.
+  # Fixed width formats only match values with the exact width
+  if '%f' not in date_format:
+    width = len(pd.Timestamp(2000, 1, 1).strftime(date_format))
+    matched &= values.str.len() == width
+
+  return times, matched
+
+def strip_tz_offset(values: pd.Series) -> pd.Series:
+  """Drop the tz offset of date strings, keeping the local time, as unlocalize_utc_dt does."""
+  if values.dropna().head(sniff_sample_size).str.contains(tz_offset_pattern, regex=True).any():
+    return values.str.replace(tz_offset_pattern, '', regex=True)
+  return values
+
+def series_to_time(values: pd.Series, fallback: Callable[[str], pd.Timestamp] = str_to_time,
+                   date_format: str | None = None, stats: dict[str, int] | None = None) -> pd.Series:
+  """
+  Vectorized str_to_time for a whole column.
+
+  Sniffs the format from a sample (or uses date_format if it's already known)
+  and converts the whole column in one pd.to_datetime call.
+  Only the values that don't match the format are sent, once per distinct value, to the fallback.
+
+  Same results as applying str_to_time to each value: tz stripped and NaT for invalid values.
+
+  stats counts the rows parsed with the format (format_rows) and with the fallback (fallback_rows).
+  """
+  if pd.api.types.is_datetime64_any_dtype(values.dtype):
+    return values.dt.tz_localize(None) if values.dt.tz is not None else values
+
+  times = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+  pending = pd.Series(True, index=values.index)
+
+  if pd.api.types.is_object_dtype(values.dtype) or pd.api.types.is_string_dtype(values.dtype):
+    strings = strip_tz_offset(values)
+
+    if date_format is None:
+      date_format = sniff_time_format(strings)
+    if date_format is not None:
+      parsed, matched = _match_time_format(strings, date_format)
+      times[matched] = parsed[matched]
+      pending &= ~matched
+
+  # Slow path: values with other formats or invalid values
+  fallback_rows = int(pending.sum())
+  if fallback_rows > 0:
+    unmatched = values[pending]
+    fixed = {value: fallback(value) for value in unmatched.drop_duplicates()}
+    times[pending] = pd.to_datetime(unmatched.map(fixed))
+
+  if stats is not None:
+    stats['format_rows'] = stats.get('format_rows', 0) + len(values) - fallback_rows
+    stats['fallback_rows'] = stats.get('fallback_rows', 0) + fallback_rows
+
+  return times
+
 #endregion ======================================================
\ No newline at end of file
@@ -0,0 +1,65 @@
+import os, json
+import numpy as np
+import pandas as pd
+import pytest
+from data_operations.refactor import EnumNormalizer, unknown_enum_found
+from data_operations.schema import unknown_msg, empty_msg
+
+# EnumNormalizer must give the same values as the old fix_enum applied to each value, and find the same unknown values
+
+with open(os.path.join(os.path.dirname(__file__), '..', 'config', 'enum_identifiers.json'), encoding='utf-8') as file:
+  identifiers = json.load(file)
+
+
+def fix_enum(column_name: str, value, enum_values: dict, unknown: set):
+  """fix_enum before EnumNormalizer (the unknown values in unknown instead of unknown_enum_found)."""
+  if value == '' or value is None or pd.isna(value):
+    return ''
+
+  if type(value) != str:
+    unknown.add(f"{value} ({type(value)})")
+    return unknown_msg
+
+  for enum_value, value_identifiers in enum_values.items():
+    for identifier in value_identifiers:
+      if identifier.lower() in value.lower():
+        return enum_value
+
+  unknown.add(value)
+  return unknown_msg
+
+
+def variants(identifier: str) -> list[str]:
+  """Spellings of an identifier found in the exports: case, spacing, prefixes and suffixes."""
+  return [identifier, identifier.lower(), identifier.upper(), f' {identifier} ', f'{identifier}_MSG', f'Status_{identifier}', f'{identifier}_message_req']
+
+
+rng = np.random.default_rng(0)
+inputs = {}
+for column, enum_values in identifiers.items():
+  spellings = [spelling for value_identifiers in enum_values.values() for identifier in value_identifiers for spelling in variants(identifier)]
+  # Values of other columns and garbage are unknown (or match another identifier, like fix_enum)
+  others = ['strange', 'ERROR', '-', 'null', 'msg', '0', 'Unknown', 'poll msg', 'Fence Normal', 'PowerOff_Sleep']
+  values = pd.Series(rng.choice(spellings + others, 1000), dtype=object)
+  values[::17] = np.nan
+  values[::23] = ''
+  inputs[column] = values
+  inputs[f'{column} category'] = values.astype('category')
+  # Not strings, read as numbers when the column has no text
+  inputs[f'{column} numbers'] = pd.Series([1.0, np.nan, 2.5, 1.0], dtype=float)
+
+
+@pytest.mark.parametrize('name', list(inputs))
+def test_enum_normalizer_equals_fix_enum(name):
+  column_name = name.split()[0]
+  column = inputs[name]
+  expected_unknown = set()
+  expected = [fix_enum(column_name, value, identifiers[column_name], expected_unknown) for value in column]
+
+  unknown_enum_found[column_name].clear()
+  fixed = EnumNormalizer(column_name, identifiers[column_name])(column)
+
+  assert isinstance(fixed.dtype, pd.CategoricalDtype)
+  assert fixed.index.equals(column.index)
+  assert fixed.astype(object).tolist() == [empty_msg if value == '' else value for value in expected]
+  assert unknown_enum_found[column_name] == expected_unknown
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from utils.config import Settings
+from data_operations.filters import drop_invalid_positions, drop_duplicate_fixes, drop_speed_spikes, filter_fixes, filter_stats
+
+# Each filter on a small frame that only breaks its rule: the rows removed and the count in filter_stats
+
+with open(os.path.join(os.path.dirname(__file__), '..', 'config', 'settings.yaml'), encoding='utf-8') as file:
+  base_settings = yaml.safe_load(file)
+
+
+def make_settings(filters: dict | None = None, filter_null_positions: bool = True) -> Settings:
+  settings = {**base_settings, 'pipeline': {**base_settings['pipeline']}}
+  settings['pipeline']['filters'] = {'duplicates': True, 'out_of_range': True, 'max_speed_kmh': 60, **(filters or {})}
+  settings['pipeline']['active_transformations'] = [{'filter_null_positions': filter_null_positions}]
+  return Settings(settings, {})
+
+
+def fixes(device_ids: list, minutes: list, lats: list, lons: list | None = None, msg_types: list | None = None) -> pd.DataFrame:
+  """Fixes sorted by device_id and sent_time, row = position in the frame."""
+  n = len(device_ids)
+  return pd.DataFrame({
+    'device_id': np.array(device_ids, dtype=float),
+    'sent_time': pd.Timestamp('2024-09-01') + pd.to_timedelta(minutes, unit='min'),
+    'received_time': pd.Timestamp('2024-09-01') + pd.to_timedelta(minutes, unit='min'),
+    'msg_type': msg_types or ['poll_msg'] * n,
+    'lat': np.array(lats, dtype=float),
+    'lon': np.array(lons if lons is not None else [-2.69] * n, dtype=float),
+    'row': np.arange(n),
+  })
+
+
+# 0.01 degrees of latitude ~ 1.1 km: in 15 minutes 4.4 km/h. 1 degree in 15 minutes ~ 445 km/h
+near, far = 38.38, 39.38
+
+
+def removed(before: pd.DataFrame, after: pd.DataFrame) -> list[int]:
+  return sorted(set(before['row']) - set(after['row']))
+
+
+@pytest.fixture(autouse=True)
+def clear_stats():
+  filter_stats.clear()
+
+
+@pytest.mark.parametrize('filter_null_positions, expected', [(True, [1, 2, 3]), (False, [1])])
+def test_null_position(filter_null_positions, expected):
+  df = fixes([1] * 5, [0, 15, 30, 45, 60], [near, near, np.nan, near, near], [-2.69, -2.69, -2.69, np.nan, -2.69])
+  df.loc[1, 'sent_time'] = pd.NaT
+  result = drop_invalid_positions(df, make_settings(filter_null_positions=filter_null_positions))
+  assert removed(df, result) == expected
+  assert filter_stats['null_position'] == len(expected)
+
+
+def test_out_of_range():
+  df = fixes([1] * 5, [0, 15, 30, 45, 60], [near, 91, -90, near, -91], [-2.69, -2.69, 180, 181, -2.69])
+  result = drop_invalid_positions(df, make_settings())
+  assert removed(df, result) == [1, 3, 4]
+  assert filter_stats['out_of_range'] == 3
+
+  assert removed(df, drop_invalid_positions(df, make_settings({'out_of_range': False}))) == []
+
+
+def test_duplicate():
+  # The same message twice (1 and 2), and a different message of the same fix (3) that is kept
+  df = fixes([1] * 4 + [2], [0, 15, 15, 15, 15], [near] * 5, msg_types=['poll_msg'] * 3 + ['seq_msg', 'poll_msg'])
+  result = drop_duplicate_fixes(df, make_settings())
+  assert removed(df, result) == [2]
+  assert filter_stats['duplicate'] == 1
+
+  assert removed(df, drop_duplicate_fixes(df, make_settings({'duplicates': False}))) == []
+
+
+def test_speed_spike():
+  # 2 jumps away and back, a single jump that stays (the collar moved) is kept
+  df = fixes([1] * 9, [0, 15, 30, 45, 60, 75, 90, 105, 120], [near, far, near, near, far + 1, near, near, far, far])
+  result = drop_speed_spikes(df, make_settings())
+  assert removed(df, result) == [1, 4]
+  assert filter_stats['speed_spike'] == 2
+
+  assert removed(df, drop_speed_spikes(df, make_settings({'max_speed_kmh': None}))) == []
+
+
+def test_speed_spike_device_boundary():
+  # The last fix of device 1 jumps away and the next row (the first fix of device 2) is back near:
+  # not a spike, the speeds are never computed across the boundary
+  df = fixes([1, 1, 1, 2, 2, 2], [0, 15, 30, 0, 15, 30], [near, near, far, near, far, far])
+  assert removed(df, drop_speed_spikes(df, make_settings())) == []
+
+  # A spike next to the boundary is still found
+  df = fixes([1, 1, 1, 2, 2, 2], [0, 15, 30, 0, 15, 30], [near, far, near, far, near, far])
+  assert removed(df, drop_speed_spikes(df, make_settings())) == [1, 4]
+
+
+def test_speed_spike_zero_seconds():
+  # Moving in 0 seconds is infinite speed
+  df = fixes([1] * 3, [0, 0, 0], [near, far, near])
+  assert removed(df, drop_speed_spikes(df, make_settings())) == [1]
+
+
+def test_filter_fixes_duplicates_first():
+  # The duplicate of a spike is removed as duplicate, then the spike as speed_spike
+  df = fixes([1] * 4, [0, 15, 15, 30], [near, far, far, near])
+  result = filter_fixes(df, make_settings())
+  assert removed(df, result) == [1, 2]
+  assert filter_stats['duplicate'] == 1 and filter_stats['speed_spike'] == 1
@@ -0,0 +1,64 @@
+import os, shutil, subprocess, sys
+import pytest
+from benchmarks.collar_data import generate_collar_data
+
+# Incremental run-all (manifest.json): an unchanged rerun writes no group file,
+# a new input file rewrites only the group files whose rows changed
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_all(root):
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(repo_root, 'src'), repo_root]))
+  subprocess.run([sys.executable, os.path.join(repo_root, 'src', 'main.py'), '-t'], cwd=root, env=env, check=True, capture_output=True)
+
+
+def group_files(root) -> dict[str, tuple[int, int, bytes]]:
+  """Group files {relative path: (inode, mtime, content)}: a file written again (atomic rename) has another inode."""
+  out_path = os.path.join(root, 'data', 'test', 'out')
+  files = {}
+  for dir_name in os.listdir(out_path):
+    if not dir_name.startswith('group by'):
+      continue
+    for file_name in os.listdir(os.path.join(out_path, dir_name)):
+      file_path = os.path.join(out_path, dir_name, file_name)
+      with open(file_path, 'rb') as file:
+        files[os.path.join(dir_name, file_name)] = (os.stat(file_path).st_ino, os.stat(file_path).st_mtime_ns, file.read())
+  return files
+
+
+@pytest.fixture
+def root(tmp_path):
+  shutil.copytree(os.path.join(repo_root, 'config'), tmp_path / 'config')
+  in_path = tmp_path / 'data' / 'test' / 'in'
+  os.makedirs(in_path)
+  for seed in range(2):
+    generate_collar_data(600, devices=3, seed=seed).to_csv(in_path / f'collars_{seed}.csv', index=False)
+  return tmp_path
+
+
+def test_unchanged_rerun_writes_nothing(root):
+  run_all(root)
+  before = group_files(root)
+  run_all(root)
+  assert group_files(root) == before
+
+
+def test_new_file_rewrites_only_its_groups(root):
+  run_all(root)
+  before = group_files(root)
+
+  # A new device that goes before the others, a few hours of the first day
+  df = generate_collar_data(12, devices=1, seed=2)
+  df['device_id'] = 228000
+  df.to_csv(root / 'data' / 'test' / 'in' / 'collars_new.csv', index=False)
+  run_all(root)
+  after = group_files(root)
+
+  rewritten = {path for path in after if path not in before or after[path][:2] != before[path][:2]}
+  changed = {path for path in after if path not in before or after[path][2] != before[path][2]}
+  assert rewritten == changed
+  # The files of the other devices keep their names and are not written again
+  devices = {path for path in after if path.startswith('group by device_id')}
+  assert len(devices - set(before)) == 1 and devices & rewritten == devices - set(before)
+  assert len(rewritten) < len(after) / 2
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_operations.refactor import fix_lat_lon_column, fix_lat_lon_format
+
+# fix_lat_lon_column must give the same floats as applying fix_lat_lon_format to each value
+
+rng = np.random.default_rng(0)
+n = 20_000
+decimals = rng.integers(0, 9, n)
+
+inputs = {
+  'lat': pd.Series(np.round(rng.uniform(36, 39, n) * 10.0 ** decimals) / 10.0 ** decimals),
+  'lon': pd.Series(np.round(rng.uniform(-6, -1, n) * 10.0 ** decimals) / 10.0 ** decimals),
+  # Positions written without the dot ('383843833.0')
+  'integer_like': pd.Series(rng.integers(1, 10**9, n).astype(float)),
+  'integers': pd.Series(rng.integers(-10**9, 10**9, 1000)),
+  # Any magnitude, 16-17 significant digits
+  'random': pd.Series(rng.uniform(-1, 1, n) * 10.0 ** rng.integers(-8, 18, n)),
+  'long_digits': pd.Series([38.38438331234567, 9.999999999999999, 99.99999999999999, 0.12345678901234567,
+                            9999999999999998.0, 1e16, 123456789012345678901.0, 38.3843833, -2.6894614]),
+  'edge': pd.Series([0.00012345, 0.00009, -1e-4, 1e-05, 38.3, 3.0, 38.0, 0.5, -0.5, -0.0, 0.0, 5.0, np.inf, -np.inf]),
+  'nan': pd.Series([np.nan, 38.3843833, np.nan, -2.6894614, np.nan]),
+  'text': pd.Series(['38.3843833', '-2.6894614', '383843833', '', 'abc', np.nan, '3,5'], dtype=object),
+  'empty_text': pd.Series(['', '', ''], dtype=object),
+  'empty': pd.Series([], dtype=float),
+}
+inputs['lat'][::97] = np.nan
+inputs['lon'][::89] = np.nan
+
+
+def scalar_fix(column: pd.Series, integer_digits: int) -> np.ndarray:
+  """fix_lat_lon_format value by value, '' (empty values) as NaN."""
+  fixed = [fix_lat_lon_format(value, integer_digits) for value in column]
+  return np.array([np.nan if value == '' else float(value) for value in fixed], dtype=float)
+
+
+@pytest.mark.parametrize('integer_digits', [1, 2])
+@pytest.mark.parametrize('name', list(inputs))
+def test_fix_lat_lon_column_equals_scalar(name, integer_digits):
+  column = inputs[name]
+  fixed = fix_lat_lon_column(column, integer_digits)
+
+  assert fixed.dtype == np.float64
+  assert fixed.index.equals(column.index)
+  np.testing.assert_array_equal(fixed.to_numpy(), scalar_fix(column, integer_digits))
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_operations.merge import merge_sorted, split_runs
+from data_operations.sort import sort_by
+
+# merge_sorted of sorted sources (in batches) must give the same rows as sort_by of all of them, ties in the same order
+
+
+def random_rows(n: int, seed: int) -> pd.DataFrame:
+  """Few different keys, so there are many ties. row identifies each row to check the order of the ties."""
+  rng = np.random.default_rng(seed)
+  return pd.DataFrame({
+    'device_id': rng.integers(0, 4, n).astype(float),
+    'sent_time': pd.Timestamp('2024-09-01') + pd.to_timedelta(rng.integers(0, 6, n), unit='h'),
+    'row': np.arange(n) + seed * 100_000,
+  })
+
+
+def in_batches(df: pd.DataFrame, batch_rows: int) -> list[pd.DataFrame]:
+  return [df.iloc[start:start + batch_rows] for start in range(0, len(df), batch_rows)]
+
+
+def merged(sources: list[pd.DataFrame], columns, orders, batch_rows: int) -> pd.DataFrame:
+  batches = list(merge_sorted([in_batches(source, batch_rows) for source in sources], columns, orders))
+  return pd.concat(batches).reset_index(drop=True) if batches else pd.DataFrame()
+
+
+orders = {
+  'asc': (['device_id', 'sent_time'], ['asc', 'asc']),
+  'desc': (['device_id', 'sent_time'], ['asc', 'desc']),
+  'time_first': (['sent_time', 'device_id'], ['desc', 'asc']),
+}
+
+
+@pytest.mark.parametrize('sort', orders.values(), ids=orders.keys())
+# 1: every row in its own batch, 7: each source (and its runs of ties) across several batches, 1000: each source in one batch
+@pytest.mark.parametrize('batch_rows', [1, 7, 1000])
+@pytest.mark.parametrize('sizes', [[300], [200, 150, 1, 90], [50, 0, 120]])
+def test_merge_sorted_same_as_sort_by(sort, batch_rows, sizes):
+  columns, sort_orders = sort
+  sources = [sort_by(random_rows(size, seed), columns, sort_orders) for seed, size in enumerate(sizes)]
+  expected = sort_by(pd.concat(sources), columns, sort_orders).reset_index(drop=True)
+  pd.testing.assert_frame_equal(merged(sources, columns, sort_orders, batch_rows), expected)
+
+
+@pytest.mark.parametrize('batch_rows', [1, 2, 5])
+def test_merge_sorted_ties_in_order_of_source(batch_rows):
+  # Same keys in every row: the rows of the first source, then the second, each one in its order
+  sources = [random_rows(10, seed).assign(device_id=1.0, sent_time=pd.Timestamp('2024-09-01')) for seed in range(3)]
+  result = merged(sources, ['device_id', 'sent_time'], ['asc', 'asc'], batch_rows)
+  assert result['row'].tolist() == pd.concat(sources)['row'].tolist()
+
+
+def test_merge_sorted_empty():
+  columns, sort_orders = orders['asc']
+  assert list(merge_sorted([], columns, sort_orders)) == []
+  assert list(merge_sorted([[], []], columns, sort_orders)) == []
+  # Sources with only empty batches
+  empty = random_rows(0, 0)
+  assert sum(len(batch) for batch in merge_sorted([[empty], [empty, empty]], columns, sort_orders)) == 0
+
+
+def test_merge_sorted_unsorted_source():
+  columns, sort_orders = orders['asc']
+  source = sort_by(random_rows(50, 0), columns, sort_orders).iloc[::-1]
+  with pytest.raises(ValueError):
+    list(merge_sorted([in_batches(source, 10)], columns, sort_orders))
+
+
+@pytest.mark.parametrize('batch_rows', [1, 3, 7, 1000])
+def test_split_runs_keeps_runs_together(batch_rows):
+  df = sort_by(random_rows(300, 0), *orders['asc']).reset_index(drop=True)
+  keys = lambda batch: [batch['device_id'].to_numpy(), batch['sent_time'].to_numpy()]
+  parts = list(split_runs(in_batches(df, batch_rows), keys))
+
+  pd.testing.assert_frame_equal(pd.concat(parts), df)
+  # The first row of each part starts a new run
+  for previous, part in zip(parts, parts[1:]):
+    assert (previous['device_id'].iloc[-1], previous['sent_time'].iloc[-1]) != (part['device_id'].iloc[0], part['sent_time'].iloc[0])
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_operations.creation import add_end_date, add_end_date_chunks, add_trajectory_metrics, add_trajectory_metrics_chunks, trajectory_columns
+
+# end_date and the trajectory metrics computed on chunks (NextFixStream) must be the same as on the whole frame,
+# wherever the chunks split the devices
+
+rng = np.random.default_rng(0)
+n = 200
+
+# Sorted by device_id and sent_time: devices of 1 row, fixes with the same sent_time, missing positions, rows without device at the end
+devices = np.sort(np.r_[rng.integers(0, 12, n - 3), 20]).astype(float)
+fixes = pd.DataFrame({
+  'device_id': np.r_[devices, np.nan, np.nan],
+  'sent_time': pd.Timestamp('2024-09-01') + pd.to_timedelta(np.cumsum(rng.integers(0, 3, n)) * 5, unit='min'),
+  'lat': np.where(rng.random(n) < 0.05, np.nan, rng.uniform(38.2, 38.4, n)),
+  'lon': rng.uniform(-2.8, -2.6, n),
+})
+
+devices_by_type = {
+  'float': fixes,
+  'category': fixes.assign(device_id=fixes['device_id'].astype('category')),
+}
+
+streams = {
+  'end_date': (add_end_date, add_end_date_chunks, ['end_date']),
+  'trajectory_metrics': (add_trajectory_metrics, add_trajectory_metrics_chunks, trajectory_columns),
+}
+
+
+@pytest.mark.parametrize('df', devices_by_type.values(), ids=devices_by_type.keys())
+@pytest.mark.parametrize('stream', streams.values(), ids=streams.keys())
+@pytest.mark.parametrize('chunk_rows', [1, 2, 7, 64, n])
+def test_chunks_same_as_whole(df, stream, chunk_rows):
+  add_whole, add_chunks, columns = stream
+  expected = add_whole(df.copy())
+  chunks = [df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows)]
+  result = pd.concat(list(add_chunks(chunks)))
+
+  pd.testing.assert_frame_equal(result[columns], expected[columns])
+
+
+def test_chunks_device_again():
+  # A device that appears again after other devices can't be computed on chunks
+  df = fixes.iloc[:20].assign(device_id=[1.0] * 5 + [2.0] * 10 + [1.0] * 5)
+  chunks = [df.iloc[start:start + 5] for start in range(0, len(df), 5)]
+  with pytest.raises(ValueError):
+    list(add_end_date_chunks(chunks))
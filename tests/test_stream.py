@@ -0,0 +1,65 @@
+import os, shutil, subprocess, sys
+import numpy as np
+import pytest
+import yaml
+from benchmarks.collar_data import generate_collar_data
+
+# run-all in stream mode, in chunks much smaller than the files, must write the same files as in memory
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sort_bys = {
+  # The devices come in the order of the merged data: each group keeps the order of arrival of its rows
+  'device_first': [{'column': 'device_id', 'order': 'asc'}, {'column': 'sent_time', 'order': 'asc'}],
+  # Each group is merged again from its sorted pieces
+  'time_first': [{'column': 'sent_time', 'order': 'desc'}, {'column': 'device_id', 'order': 'asc'}],
+}
+
+# Not the same in both modes: times of each stage, hashes of the run
+skipped_files = {'manifest.json'}
+
+
+def make_root(root, sort_by):
+  shutil.copytree(os.path.join(repo_root, 'config'), os.path.join(root, 'config'))
+  settings_path = os.path.join(root, 'config', 'settings.yaml')
+  with open(settings_path, encoding='utf-8') as file:
+    settings = yaml.safe_load(file)
+  settings['spatial_index']['enabled'] = True
+  settings['pipeline']['sort_by'] = sort_by
+  with open(settings_path, 'w', encoding='utf-8') as file:
+    yaml.safe_dump(settings, file, allow_unicode=True, sort_keys=False)
+
+  in_path = os.path.join(root, 'data', 'test', 'in')
+  os.makedirs(in_path)
+  for seed in range(2):
+    df = generate_collar_data(1500, devices=4, seed=seed, interval_minutes=5)
+    df.loc[::50, 'position_time'] = df['position_time'].iloc[0]   # ties
+    df.loc[::70, 'lat'] = np.nan
+    df.to_csv(os.path.join(in_path, f'collars_{seed}.csv'), index=False)
+
+
+def run_all(root, *args) -> dict[str, bytes]:
+  """Run run-all in root and return the output files {relative path: content}."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(repo_root, 'src'), repo_root]))
+  subprocess.run([sys.executable, os.path.join(repo_root, 'src', 'main.py'), '-t', '--no-cache', *args], cwd=root, env=env, check=True, capture_output=True)
+
+  out_path = os.path.join(root, 'data', 'test', 'out')
+  files = {}
+  for dir_path, _, file_names in os.walk(out_path):
+    for file_name in file_names:
+      if file_name in skipped_files or file_name.startswith('metrics-'):
+        continue
+      with open(os.path.join(dir_path, file_name), 'rb') as file:
+        files[os.path.relpath(os.path.join(dir_path, file_name), out_path)] = file.read()
+  shutil.rmtree(out_path)
+  return files
+
+
+@pytest.mark.parametrize('sort_by', sort_bys.values(), ids=sort_bys.keys())
+def test_stream_same_files(tmp_path, sort_by):
+  make_root(tmp_path, sort_by)
+  in_memory = run_all(tmp_path)
+  stream = run_all(tmp_path, '--stream', '--chunk-size', '200')
+
+  assert sorted(stream) == sorted(in_memory)
+  assert [path for path in in_memory if stream[path] != in_memory[path]] == []
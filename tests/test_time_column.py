@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.utils import str_to_time
+from data_operations.refactor import fix_time_column, forget_time_formats, cached_str_to_time
+
+# fix_time_column (format learned per column, cached fallback) must give the same times as str_to_time on each value
+
+rng = np.random.default_rng(0)
+n = 500
+times = pd.Timestamp('2024-09-01') + pd.to_timedelta(rng.integers(0, 90 * 24 * 3600, n), unit='s')
+
+formats = ['%Y-%m-%d %H:%M:%S+00:00', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%d/%m/%Y %H:%M']
+
+# Values that no format (and not str_to_time) can parse
+garbage = ['', 'null', 'nan', 'NaT', '#N/A', 'ERROR', '-', '31/02/2024 10:00:00', '2024-13-01 10:00:00']
+
+inputs = {
+  **{f'only {date_format}': pd.Series(times.strftime(date_format), dtype=object) for date_format in formats},
+  # Each value in any of the formats
+  'mixed': pd.Series([time.strftime(formats[i]) for time, i in zip(times, rng.integers(0, len(formats), n))], dtype=object),
+  # Mostly the raw format, some values in others, some garbage and missing values
+  'raw_and_others': pd.Series(np.where(rng.random(n) < 0.9, times.strftime(formats[0]), times.strftime(formats[2])), dtype=object),
+  'garbage': pd.Series(list(times[:50].strftime(formats[0])) + garbage * 5 + [np.nan], dtype=object),
+  'only_garbage': pd.Series(garbage + [np.nan], dtype=object),
+  'tz_offsets': pd.Series(['2024-09-01 10:00:00+02:00', '2024-09-01 10:00:00-0300', '2024-09-01T10:00:00Z', '2024-09-01 10:00:00'], dtype=object),
+  'empty': pd.Series([], dtype=object),
+}
+inputs['raw_and_others'][::37] = np.nan
+inputs['raw_and_others'][::53] = 'ERROR'
+
+
+def scalar_times(column: pd.Series) -> pd.Series:
+  return pd.to_datetime(pd.Series([str_to_time(value) for value in column], index=column.index, dtype=object))
+
+
+@pytest.mark.parametrize('chunk_rows', [None, 100])
+@pytest.mark.parametrize('name', list(inputs))
+def test_fix_time_column_equals_scalar(name, chunk_rows):
+  column = inputs[name].rename('sent_time')
+  forget_time_formats()
+  cached_str_to_time.cache_clear()
+
+  # In chunks the format sniffed in the first one is used for the rest
+  chunks = [column] if chunk_rows is None else [column.iloc[start:start + chunk_rows] for start in range(0, len(column), chunk_rows)]
+  fixed = pd.concat([fix_time_column(chunk) for chunk in chunks]) if len(column) > 0 else fix_time_column(column)
+
+  assert fixed.dtype == 'datetime64[ns]'
+  assert fixed.index.equals(column.index)
+  pd.testing.assert_series_equal(fixed, scalar_times(column).astype('datetime64[ns]'), check_names=False)